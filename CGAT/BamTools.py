@@ -10,6 +10,10 @@ with :term:`bam` formatted files.
 import numpy
 import pysam
 
+# flags of reads ignored by pysam's pileup: unmapped, secondary,
+# qc fail and duplicate
+PILEUP_FILTER_FLAGS = 4 | 256 | 512 | 1024
+
 
 def isPaired(bamfile, alignments=1000):
     '''check if a `bamfile` contains paired end data
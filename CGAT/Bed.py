@@ -28,6 +28,7 @@ import itertools
 
 from CGAT import NCL as ncl
 from CGAT import IOTools as IOTools
+from CGAT import IndexedGenome as IndexedGenome
 
 Headers = [
     "contig", "start", "end",
@@ -237,8 +238,14 @@ class Bed(object):
             self.fields[position] = value
 
     def __getattr__(self, key):
+        # unknown attributes need to raise AttributeError, which is
+        # expected by pickle and hasattr()
         try:
-            return self.fields[self.map_key2field[key]]
+            position = self.map_key2field[key]
+        except KeyError:
+            raise AttributeError(key)
+        try:
+            return self.fields[position]
         except IndexError:
             return None
 
@@ -397,7 +404,7 @@ def blocked_iterator(iterator):
     yield _update(bed, blocks)
 
 
-def readAndIndex(infile, with_values=False, per_track=False):
+def readAndIndex(infile, with_values=False, per_track=False, cache=None):
     """read and index a bed formatted file in ``infile``.
 
     The index is not strand-aware.
@@ -411,6 +418,11 @@ def readAndIndex(infile, with_values=False, per_track=False):
        intervals are recorded and any additional fields will be ignored.
     per_track : bool
        If True build indices per track.
+    cache : string
+       If given, save the index in this directory and re-use it in
+       subsequent calls as long as `infile` has not been modified,
+       see :func:`IndexedGenome.cached`. Requires `infile` to be
+       opened from a file and can not be combined with `per_track`.
 
     Returns
     -------
@@ -442,6 +454,24 @@ def readAndIndex(infile, with_values=False, per_track=False):
                 pass
         return idx
 
+    if cache is not None:
+        if per_track:
+            raise ValueError("cache can not be used with per_track")
+
+        if with_values:
+            index_class = IndexedGenome.IndexedGenome
+        else:
+            index_class = IndexedGenome.Simple
+
+        def _buildIndex(with_values):
+            index = index_class()
+            index.mIndex = _build(iterator(infile))
+            return index
+
+        return IndexedGenome.cached(infile.name, _buildIndex, cache,
+                                    index_class=index_class,
+                                    with_values=with_values).mIndex
+
     if per_track:
         indices = {}
         for track, beds in grouped_iterator(iterator(infile)):
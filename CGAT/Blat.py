@@ -9,6 +9,11 @@ single entry and a series of iterators to iterate of :term:`PSL`
 formatted files (:func:`iterator`, :func:`iterator_target_overlap`,
 ...).
 
+Large files can be read into memory column by column with
+:func:`read_columnar`, which returns a :class:`ColumnarPSL`.
+Alignments are then selected with numpy operations on the columns,
+for example with :func:`getOverlapClusters`.
+
 Reference
 ---------
 
@@ -16,6 +21,9 @@ Reference
 import copy
 import string
 import collections
+import numpy
+import pandas
+import six
 
 try:
     import alignlib_lite
@@ -24,6 +32,7 @@ except ImportError:
 
 from CGAT import Components as Components
 from CGAT import Experiment as E
+from CGAT import IOTools as IOTools
 
 
 class Error(Exception):
@@ -231,6 +240,13 @@ class Match:
         self.mSbjctBlockStarts = list(
             map(int, sbjct_block_starts[:-1].split(",")))
 
+        self._computeStatistics()
+
+    def _computeStatistics(self):
+        '''compute coverage and percent identity.'''
+
+        nmatches, nmismatches = self.mNMatches, self.mNMismatches
+
         # this makes sure that the block positions are rescaled
         if self.mQueryLength != 0:
             self.mQueryCoverage = 100.0 * \
@@ -646,7 +662,7 @@ def iterator(infile):
     while 1:
         line = infile.readline()
         if not line:
-            raise StopIteration
+            return
         if line[0] == "#":
             continue
         if line.startswith("match"):
@@ -905,3 +921,315 @@ def getComponents(matches, max_distance=0, min_overlap=0, by_query=False):
                 components.add(x, y)
 
     return components.getComponents()
+
+
+class ColumnarPSL(object):
+    """a :term:`PSL` file stored column by column.
+
+    The numeric fields of each alignment are stored in numpy arrays
+    named after the attributes of :class:`Match`, for example
+    ``nmatches`` or ``query_from``. Query and target names as well as
+    the strand are interned: each alignment stores an integer code
+    that indexes into a list of distinct values, for example::
+
+        psl.query_ids[psl.query_codes[x]]
+
+    is the query name of the x-th alignment. Codes are assigned in the
+    order of first occurrence.
+
+    The blocks of all alignments are stored in three flat arrays
+    ``block_sizes``, ``query_block_starts`` and
+    ``sbjct_block_starts``. The blocks of alignment x are at positions
+    ``block_offsets[x]:block_offsets[x+1]``.
+
+    Indexing and iterating returns :class:`Match` objects. Use
+    :func:`read_columnar` to build an object from a file.
+    """
+
+    columns = ("nmatches", "nmismatches", "nrepmatches", "nns",
+               "query_ngaps_counts", "query_ngaps_bases",
+               "sbjct_ngaps_counts", "sbjct_ngaps_bases",
+               "strand_codes",
+               "query_codes", "query_length", "query_from", "query_to",
+               "sbjct_codes", "sbjct_length", "sbjct_from", "sbjct_to",
+               "nblocks")
+
+    block_columns = ("block_sizes", "query_block_starts",
+                     "sbjct_block_starts")
+
+    def __init__(self):
+        self.query_ids = []
+        self.sbjct_ids = []
+        self.strands = []
+        for column in self.columns + self.block_columns:
+            setattr(self, column, numpy.zeros(0, dtype=numpy.int64))
+        self.block_offsets = numpy.zeros(1, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.nmatches)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("alignment index out of range")
+
+        match = Match()
+        match.mNMatches = int(self.nmatches[index])
+        match.mNMismatches = int(self.nmismatches[index])
+        match.mNRepMatches = int(self.nrepmatches[index])
+        match.mNns = int(self.nns[index])
+        match.mQueryNGapsCounts = int(self.query_ngaps_counts[index])
+        match.mQueryNGapsBases = int(self.query_ngaps_bases[index])
+        match.mSbjctNGapsCounts = int(self.sbjct_ngaps_counts[index])
+        match.mSbjctNGapsBases = int(self.sbjct_ngaps_bases[index])
+        match.strand = self.strands[self.strand_codes[index]]
+        match.mQueryId = self.query_ids[self.query_codes[index]]
+        match.mQueryLength = int(self.query_length[index])
+        match.mQueryFrom = int(self.query_from[index])
+        match.mQueryTo = int(self.query_to[index])
+        match.mSbjctId = self.sbjct_ids[self.sbjct_codes[index]]
+        match.mSbjctLength = int(self.sbjct_length[index])
+        match.mSbjctFrom = int(self.sbjct_from[index])
+        match.mSbjctTo = int(self.sbjct_to[index])
+        match.mNBlocks = int(self.nblocks[index])
+        start, end = self.block_offsets[index], self.block_offsets[index + 1]
+        match.mBlockSizes = self.block_sizes[start:end].tolist()
+        match.mQueryBlockStarts = self.query_block_starts[start:end].tolist()
+        match.mSbjctBlockStarts = self.sbjct_block_starts[start:end].tolist()
+        match._computeStatistics()
+        return match
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def getCode(self, column, value):
+        '''return the code of *value* in the interned *column*, for
+        example ``psl.getCode("sbjct_ids", "chr1")``.
+
+        Returns -1 if *value* does not occur.
+        '''
+        try:
+            return getattr(self, column).index(value)
+        except ValueError:
+            return -1
+
+    def select(self, mask):
+        '''return a new :class:`ColumnarPSL` with the alignments
+        selected by *mask*, a boolean array or an array of indices.
+
+        The interned values are shared with this object.
+        '''
+        indices = numpy.arange(len(self))[mask]
+        result = ColumnarPSL()
+        result.query_ids = self.query_ids
+        result.sbjct_ids = self.sbjct_ids
+        result.strands = self.strands
+        for column in self.columns:
+            setattr(result, column, getattr(self, column)[indices])
+
+        starts = self.block_offsets[indices]
+        sizes = self.block_offsets[indices + 1] - starts
+        result.block_offsets = numpy.zeros(len(indices) + 1,
+                                           dtype=numpy.int64)
+        numpy.cumsum(sizes, out=result.block_offsets[1:])
+        # positions of the selected blocks in the flat arrays
+        positions = numpy.repeat(starts - result.block_offsets[:-1],
+                                 sizes) + numpy.arange(numpy.sum(sizes))
+        for column in self.block_columns:
+            setattr(result, column, getattr(self, column)[positions])
+        return result
+
+    def write(self, outfile):
+        '''write alignments in :term:`PSL` format to *outfile*.
+
+        The output is identical to writing each :class:`Match`.
+        '''
+        columns = [getattr(self, x).tolist() for x in self.columns]
+        # replace codes by interned values
+        for x, values in ((8, self.strands),
+                          (9, self.query_ids),
+                          (13, self.sbjct_ids)):
+            columns[x] = [values[c] for c in columns[x]]
+        offsets = self.block_offsets.tolist()
+        blocks = [getattr(self, x).tolist() for x in self.block_columns]
+
+        for index, row in enumerate(zip(*columns)):
+            start, end = offsets[index], offsets[index + 1]
+            outfile.write("\t".join(map(str, row)))
+            for values in blocks:
+                outfile.write(
+                    "\t" + ",".join(map(str, values[start:end])) + ",")
+            outfile.write("\n")
+
+
+def _iterateDataLines(infile):
+    '''iterate over the data lines in a :term:`PSL` file.'''
+    for line in infile:
+        if line[0] == "#":
+            continue
+        if line.startswith("match"):
+            continue
+        if line.startswith("psLayout version 3"):
+            for x in range(4):
+                next(infile)
+            continue
+        yield line
+
+
+def _parseBlocks(values, expected):
+    '''parse comma separated block lists in *values* into a flat
+    array of length *expected*.'''
+    if expected == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    # block lists end in a comma
+    values = [x for x in values.str.rstrip(",") if x]
+    result = numpy.fromstring(",".join(values), dtype=numpy.int64, sep=",")
+    if len(result) != expected:
+        raise ParsingError(
+            "parsing error: number of blocks does not match block count")
+    return result
+
+
+def read_columnar(infile, chunk_size=1000000):
+    """read a :term:`PSL` formatted file into a :class:`ColumnarPSL`.
+
+    Comment lines and headers are skipped. The file is parsed in
+    chunks of *chunk_size* alignments which are converted to arrays
+    before the next chunk is read.
+
+    Arguments
+    ---------
+    infile : string or file
+       Filename (optionally compressed) or an open file object.
+    chunk_size : int
+       Number of alignments to parse at a time.
+
+    Returns
+    -------
+    psl : :class:`ColumnarPSL`
+    """
+
+    if isinstance(infile, str):
+        with IOTools.openFile(infile) as inf:
+            return read_columnar(inf, chunk_size=chunk_size)
+
+    psl = ColumnarPSL()
+    all_columns = psl.columns + psl.block_columns
+    nfields = len(all_columns)
+    nblocks_field = psl.columns.index("nblocks")
+    # fields with strand, query and target names
+    interned = {8: {}, 9: {}, 13: {}}
+    dtypes = dict((x, str) for x in list(interned.keys()) + [18, 19, 20])
+    chunks = [[] for x in all_columns]
+
+    def _convert(lines):
+        try:
+            table = pandas.read_csv(six.StringIO("".join(lines)),
+                                    sep="\t",
+                                    header=None,
+                                    usecols=list(range(nfields)),
+                                    dtype=dtypes,
+                                    na_filter=False)
+        except ValueError as msg:
+            raise ParsingError("parsing error: %s" % msg)
+
+        for x in range(nfields):
+            column = table[x]
+            if x in interned:
+                codes, values = pandas.factorize(column)
+                # map to codes in order of first occurrence in file
+                mapping = numpy.array(
+                    [interned[x].setdefault(v, len(interned[x]))
+                     for v in values], dtype=numpy.int64)
+                values = mapping[codes]
+            elif x < len(psl.columns):
+                if column.dtype.kind != "i":
+                    raise ParsingError(
+                        "parsing error: non-numeric values in field %i" %
+                        (x + 1))
+                values = column.values.astype(numpy.int64)
+            else:
+                values = _parseBlocks(
+                    column, numpy.sum(chunks[nblocks_field][-1]))
+            chunks[x].append(values)
+
+    lines = []
+    for line in _iterateDataLines(infile):
+        lines.append(line)
+        if len(lines) >= chunk_size:
+            _convert(lines)
+            lines = []
+    if lines:
+        _convert(lines)
+
+    for column, values in zip(all_columns, chunks):
+        if values:
+            setattr(psl, column, numpy.concatenate(values))
+
+    for x, column in ((8, "strands"), (9, "query_ids"), (13, "sbjct_ids")):
+        values = [None] * len(interned[x])
+        for value, code in interned[x].items():
+            values[code] = value
+        setattr(psl, column, values)
+
+    psl.block_offsets = numpy.zeros(len(psl) + 1, dtype=numpy.int64)
+    numpy.cumsum(psl.nblocks, out=psl.block_offsets[1:])
+
+    return psl
+
+
+def getOverlapClusters(psl, merge_distance=0, by_query=False):
+    '''return cluster labels of overlapping alignments.
+
+    The clusters are the same as the blocks returned by
+    :func:`iterator_target_overlap` (or :func:`iterator_query_overlap`
+    if *by_query* is set): alignments are clustered if they are
+    on the same sequence and start before the end of the previous
+    alignments in the cluster plus *merge_distance*. The alignments
+    need to be sorted by sequence and start.
+
+    Returns an array with a cluster number for each alignment.
+    Cluster numbers are consecutive in file order.
+    '''
+
+    if merge_distance < 0:
+        raise ValueError("merge_distance must not be negative")
+
+    if by_query:
+        codes, starts, ends = psl.query_codes, psl.query_from, psl.query_to
+        name = "query"
+    else:
+        codes, starts, ends = psl.sbjct_codes, psl.sbjct_from, psl.sbjct_to
+        name = "target"
+
+    n = len(codes)
+    if n == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    new_contig = numpy.ones(n, dtype=bool)
+    new_contig[1:] = codes[1:] != codes[:-1]
+    contig_starts = numpy.flatnonzero(new_contig)
+    if len(numpy.unique(codes[contig_starts])) != len(contig_starts):
+        raise ValueError(
+            "input not sorted by %s (contig,start)" % name)
+
+    # running maximum of the end coordinate within each contig. As
+    # the input is sorted, the running maximum within a contig equals
+    # the end of the current cluster.
+    contig_index = numpy.cumsum(new_contig) - 1
+    offset = numpy.max(ends) - numpy.min(starts) + merge_distance + 1
+    shifted = ends + contig_index * offset
+    running_end = numpy.maximum.accumulate(shifted) - contig_index * offset
+
+    new_cluster = new_contig.copy()
+    new_cluster[1:] |= starts[1:] >= running_end[:-1] + merge_distance
+    clusters = numpy.cumsum(new_cluster) - 1
+
+    cluster_starts = starts[new_cluster][clusters]
+    if numpy.any(starts < cluster_starts):
+        raise ValueError(
+            "input not sorted by %s (contig,start)" % name)
+
+    return clusters
@@ -824,22 +824,22 @@ def means2idxarrays(g1, g2, i_bins, c_bins, difference):
     '''take two arrays of values and return the initial values
     and differences as numpy digitised arrays'''
 
+    g1 = np.asarray(g1, dtype=np.float64)
+    g2 = np.asarray(g2, dtype=np.float64)
+
     if difference == "relative":
         # calculate difference between mean values for group1 and group2
         # g1 and g2 always the same length
-        change = [g2[x] - g1[x] for x in range(0, len(g1))]
+        change = g2 - g1
         initial = g1
 
     elif difference == "logfold":
-        change = [np.log2((g2[x] + 1.0) / (g1[x] + 1.0))
-                  for x in range(0, len(g1))]
-        initial = [np.log2(g1[x] + 1.0) for x in range(0, len(g1))]
+        change = np.log2((g2 + 1.0) / (g1 + 1.0))
+        initial = np.log2(g1 + 1.0)
 
     elif difference == "abs_logfold":
-        change = [abs(np.log2((g2[x] + 1.0) / (g1[x] + 1.0)))
-                  for x in range(0, len(g1))]
-        initial = [max(np.log2(g1[x] + 1.0), np.log2(g2[x] + 1.0))
-                   for x in range(0, len(g1))]
+        change = np.abs(np.log2((g2 + 1.0) / (g1 + 1.0)))
+        initial = np.maximum(np.log2(g1 + 1.0), np.log2(g2 + 1.0))
 
     # return arrays of len(change) with the index position in c_bins
     # corresponding to the bin in which the value of change falls
@@ -881,13 +881,105 @@ def findClusters(df, distance, size, tracks_map, groups):
     return (cluster_dfs)
 
 
+def clusters2arrays(clusters_dict, tracks):
+    '''store the clusters in *clusters_dict* as contiguous arrays.
+
+    For each list of columns in *tracks*, the values are summed per
+    row and stored in a cumulative sum, so that the mean value in any
+    window within a cluster can be computed from two look-ups.
+
+    returns a tuple (offsets, labels, cumsums). *offsets* contains
+    the start of each cluster and the total number of rows, *labels*
+    the index labels of all rows.
+    '''
+    clusters = [clusters_dict[key] for key in sorted(clusters_dict.keys())]
+    offsets = np.zeros(len(clusters) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in clusters], out=offsets[1:])
+    df = pd.concat(clusters)
+
+    cumsums = []
+    for columns in tracks:
+        cumsum = np.zeros(len(df) + 1, dtype=np.float64)
+        np.cumsum(df.loc[:, columns].values.astype(np.float64).sum(axis=1),
+                  out=cumsum[1:])
+        cumsums.append(cumsum)
+
+    return offsets, df.index.values, cumsums
+
+
+def sampleClusterWindows(offsets, cumsum, ncolumns, size, nsamples, rng):
+    '''sample a random window of *size* + 1 rows in *nsamples*
+    randomly chosen clusters.
+
+    returns a tuple (clusters, starts, means) with the cluster
+    indices, the start row of each window and the mean value
+    in each window.
+    '''
+    nclusters = len(offsets) - 1
+    lengths = offsets[1:] - offsets[:-1]
+    if np.any(lengths <= size):
+        raise ValueError(
+            "subcluster size %i too large for clusters with %i rows" %
+            (size, lengths.min()))
+
+    clusters = rng.permutation(nclusters)[:nsamples]
+    starts = offsets[clusters] + rng.randint(
+        0, lengths[clusters] - size)
+    means = ((cumsum[starts + size + 1] - cumsum[starts]) /
+             ((size + 1) * ncolumns))
+    return clusters, starts, means
+
+
+def shuffleClusterIteration(i_bins, c_bins, s_bins, difference,
+                            clusters1, clusters2, seed):
+    '''perform a single shuffling iteration for
+    :func:`shuffleCluster`.
+
+    *clusters1* and *clusters2* are tuples (offsets, cumsum, ncolumns)
+    for the two groups.
+
+    returns a list with a tuple for each subcluster size. Each tuple
+    contains the arrays of bin coordinates, the permuted clusters and
+    window starts for either group.
+    '''
+    rng = np.random.RandomState(seed)
+    nclusters = len(clusters1[0]) - 1
+    result = []
+    for size in s_bins:
+        g1_rand, g1_starts, g1_means = sampleClusterWindows(
+            clusters1[0], clusters1[1], clusters1[2],
+            size, nclusters, rng)
+        g2_rand, g2_starts, g2_means = sampleClusterWindows(
+            clusters2[0], clusters2[1], clusters2[2],
+            size, nclusters, rng)
+        change_idx, initial_idx = means2idxarrays(
+            g1_means, g2_means, i_bins, c_bins, difference)
+        size_idx = np.digitize([size] * nclusters, s_bins)
+        result.append((np.vstack((initial_idx, change_idx, size_idx)),
+                       g1_rand, g1_starts, g2_rand, g2_starts))
+    return result
+
+
+def runShuffleClusterIteration(seed):
+    '''run a shuffling iteration in a worker process.'''
+    return shuffleClusterIteration(*E.WORKER_STATE["args"], seed=seed)
+
+
 def shuffleCluster(i_bins, c_bins, tracks_map, groups,
                    difference, s_max, i, clusters_dict,
-                   s_bins_max, s_bins_min, s_bins_width):
+                   s_bins_max, s_bins_min, s_bins_width,
+                   num_threads=1):
     '''take a dictionary containing clusters (subdataframes) and shuffle
     subregions of clusters to obtain spike in clusters.
     return indeces from which the spike in clusters can be obtained from the
     original dataframe
+
+    The clusters are stored as contiguous arrays and the window means
+    of all clusters are computed at once from cumulative sums.  Each
+    iteration uses a separate random number generator seeded from
+    python's random number generator. With *num_threads* larger than
+    1, iterations are computed by a pool of processes. The results do
+    not depend on the number of processes.
     '''
     s_bins = list(range(s_bins_min, s_bins_max + 1, s_bins_width,))
 
@@ -898,56 +990,46 @@ def shuffleCluster(i_bins, c_bins, tracks_map, groups,
                for key2 in np.digitize(c_bins, c_bins)
                for key3 in np.digitize(s_bins, s_bins)}
 
-    for iteration in range(0,  i):
+    offsets, labels, (cumsum1, cumsum2) = clusters2arrays(
+        clusters_dict, (tracks_map[groups[0]], tracks_map[groups[1]]))
+    clusters1 = (offsets, cumsum1, len(tracks_map[groups[0]]))
+    clusters2 = (offsets, cumsum2, len(tracks_map[groups[1]]))
+
+    seeds = [random.randint(0, 2 ** 32 - 1) for iteration in range(i)]
+    args = (i_bins, c_bins, s_bins, difference, clusters1, clusters2)
+
+    if num_threads > 1:
+        pool = E.getWorkerPool(num_threads, args=args)
+        results = pool.imap(runShuffleClusterIteration, seeds)
+    else:
+        pool = None
+        results = (shuffleClusterIteration(*args, seed=seed)
+                   for seed in seeds)
+
+    for iteration, result in enumerate(results):
         E.info("performing shuffling iteration number %i.." % (iteration + 1))
-        for size in s_bins:
-            group1_mean = []
-            group2_mean = []
-            g1_rand_s = []
-            g2_rand_s = []
-            g1_rand = np.random.permutation(list(clusters_dict.keys()))
-            g2_rand = np.random.permutation(list(clusters_dict.keys()))
-            for perm in range(0, len(g1_rand)):
-                cluster1 = clusters_dict[g1_rand[perm]].ix[
-                    :, tracks_map[groups[0]]]
-                cluster2 = clusters_dict[g2_rand[perm]].ix[
-                    :, tracks_map[groups[1]]]
-                c1_rand_s = random.randint(
-                    min(cluster1.index), max(cluster1.index) - size)
-                c1_e = int(c1_rand_s + size)
-                c2_rand_s = random.randint(
-                    min(cluster2.index), max(cluster2.index) - size)
-                c2_e = int(c2_rand_s + size)
-
-                c1_mean = np.mean(np.mean(cluster1.ix[c1_rand_s: c1_e]))
-                c2_mean = np.mean(np.mean(cluster2.ix[c2_rand_s: c2_e]))
-                group1_mean.append(c1_mean)
-                group2_mean.append(c2_mean)
-                g1_rand_s.append(c1_rand_s)
-                g2_rand_s.append(c2_rand_s)
-
-            change_idx, initial_idx,  = means2idxarrays(
-                group1_mean, group2_mean, i_bins,
-                c_bins,  difference)
-            size_idx = np.digitize([size] * len(initial_idx), s_bins)
-            for idx, coord in enumerate(zip(
-                    initial_idx, change_idx, size_idx)):
-                if counts[coord] < s_max:
-                    counts[coord] += 1
-                    cluster1_ix = clusters_dict[g1_rand[idx]].index.values
-                    cluster1_start = cluster1_ix[0]
-                    cluster1_end = cluster1_ix[-1]
-                    cluster2_ix = clusters_dict[g2_rand[idx]].index.values
-                    cluster2_start = cluster2_ix[0]
-                    cluster2_end = cluster2_ix[-1]
-                    c1_rand_s = g1_rand_s[idx]
-                    c1_rand_e = int(c1_rand_s + size)
-                    c2_rand_s = g2_rand_s[idx]
-                    c2_rand_e = int(c2_rand_s + size)
-                    indices[coord].append((
-                        cluster1_start, cluster1_end, cluster2_start,
-                        cluster2_end, c1_rand_s, c1_rand_e, c2_rand_s,
-                        c2_rand_e))
+        for size, (coords, g1_rand, g1_starts, g2_rand, g2_starts) in \
+                zip(s_bins, result):
+            # fill bins in order up to s_max spike-ins
+            for idx, coord in enumerate(zip(*coords.tolist())):
+                if coord not in indices or counts[coord] >= s_max:
+                    continue
+                counts[coord] += 1
+                cluster1, cluster2 = g1_rand[idx], g2_rand[idx]
+                c1_rand_s = labels[g1_starts[idx]]
+                c2_rand_s = labels[g2_starts[idx]]
+                indices[coord].append((
+                    labels[offsets[cluster1]],
+                    labels[offsets[cluster1 + 1] - 1],
+                    labels[offsets[cluster2]],
+                    labels[offsets[cluster2 + 1] - 1],
+                    c1_rand_s, int(c1_rand_s + size),
+                    c2_rand_s, int(c2_rand_s + size)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     return indices, counts
 
 
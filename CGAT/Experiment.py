@@ -278,12 +278,12 @@ import logging
 import collections
 import subprocess
 import functools
-import gzip
 import pipes
 import optparse
 import textwrap
 import random
 import uuid
+import multiprocessing
 import CGAT.IOTools as IOTools
 
 
@@ -488,7 +488,8 @@ def openFile(filename, mode="r", create_dir=False):
     will be created if it does not exist.
 
     gzip - compressed files are recognized by the
-    suffix ``.gz`` and opened transparently.
+    suffix ``.gz`` and opened transparently, see
+    :func:`IOTools.openFile`.
 
     Note that there are differences in the file
     like objects returned, for example in the
@@ -496,18 +497,7 @@ def openFile(filename, mode="r", create_dir=False):
 
     returns a file or file-like object.
     '''
-
-    _, ext = os.path.splitext(filename)
-
-    if create_dir:
-        dirname = os.path.dirname(filename)
-        if dirname and not os.path.exists(dirname):
-            os.makedirs(dirname)
-
-    if ext.lower() in (".gz", ".z"):
-        return gzip.open(filename, mode)
-    else:
-        return open(filename, mode)
+    return IOTools.openFile(filename, mode, create_dir=create_dir)
 
 
 def getHeader():
@@ -612,6 +602,15 @@ def Start(parser=None,
 
     Optional options added are:
 
+    add_pipe_options
+       ``-I/--stdin``, ``-S/--stdout``, ``-L/--log``, ``-E/--error``
+            redirect input/output to files. Files ending in ``.gz``
+            are compressed/decompressed transparently.
+       ``--compression-threads``
+            number of threads for compressed files, see
+            :func:`IOTools.setCompressionThreads`. With more than
+            one thread, output is written in BGZF format.
+
     add_csv_options
 
        ``dialect``
@@ -819,6 +818,12 @@ def Start(parser=None,
                              help="file where output is to go "
                              "[default = stdout].",
                              metavar="FILE")
+            group.add_option("--compression-threads",
+                             dest="compression_threads", type="int",
+                             help="number of threads used for reading and "
+                             "writing compressed files [%default].")
+
+            parser.set_defaults(compression_threads=1)
 
             parser.set_defaults(stderr=sys.stderr)
             parser.set_defaults(stdout=sys.stdout)
@@ -871,6 +876,7 @@ def Start(parser=None,
         random.seed(global_options.random_seed)
 
     if add_pipe_options:
+        IOTools.setCompressionThreads(global_options.compression_threads)
         if global_options.stdout != sys.stdout:
             global_options.stdout = openFile(global_options.stdout, "w")
         if global_options.stderr != sys.stderr:
@@ -1129,6 +1135,33 @@ class Counter(object):
                          for x in sorted(self._counts.items()))
 
 
+# state of worker processes started with getWorkerPool()
+WORKER_STATE = {}
+
+
+def _initWorker(state, initializer):
+    WORKER_STATE.clear()
+    WORKER_STATE.update(state)
+    if initializer is not None:
+        initializer(WORKER_STATE)
+
+
+def getWorkerPool(num_processes, initializer=None, **state):
+    '''return a :class:`multiprocessing.Pool` with *num_processes*
+    worker processes.
+
+    The keyword arguments in *state* are copied into
+    :data:`WORKER_STATE` in each worker process, where functions
+    executed in the pool can access them. If given, *initializer*
+    is called with :data:`WORKER_STATE` once it has been filled,
+    for example to open files that can not be sent to a worker.
+    *initializer* needs to be a module level function.
+    '''
+    return multiprocessing.Pool(num_processes,
+                                initializer=_initWorker,
+                                initargs=(state, initializer))
+
+
 def run(statement,
         return_stdout=False,
         return_popen=False,
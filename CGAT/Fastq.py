@@ -6,6 +6,11 @@ This module provides an iterator of :term:`fastq` formatted files
 score format (:func:`iterate_guess`) or converting them
 (:func:`iterate_convert`) while iterating through a file.
 
+:func:`iterate_batches` parses a file in batches of many records
+(:class:`RecordBatch`). Sequences and quality scores of a batch are
+stored in numpy arrays, and quality scores are converted between
+formats with lookup tables.
+
 :func:`guessFormat` inspects a fastq file to guess the quality score format
 and :func:`getOffset` returns the numeric offset for quality score conversion
 for a particular quality score format.
@@ -20,9 +25,12 @@ Reference
 '''
 
 import string
+import itertools
 
 from math import log
 
+import numpy
+
 import CGAT.Experiment as E
 import CGAT.IOTools as IOTools
 
@@ -33,8 +41,56 @@ RANGES = {
     'phred64': (64, 106),
 }
 
+# phred scores in encoding tables are stored with this offset to
+# allow for negative scores
+SCORE_OFFSET = 256
+
+
+def _decodeQuality(code, format):
+    """return phred score for ASCII *code* in *format*."""
+    if format in ("sanger", "illumina-1.8"):
+        return code - 33
+    elif format == "solexa":
+        # from -5 to 40 (i.e., can be negative)
+        log10x = log(10.0) + .499
+        return int(10.0 * log(1.0 + 10 ** (code / 10.0), 10) / log10x)
+    elif format == "phred64":
+        return code - 64
+
 
-class Record:
+def _encodeQuality(score, format):
+    """return ASCII code for phred *score* in *format*.
+
+    returns -1 if *score* can not be encoded.
+    """
+    if format in ("sanger", "illumina-1.8"):
+        code = 33 + score
+    elif format == "solexa":
+        if score <= 0:
+            return -1
+        log10x = log(10.0, 10) / 10.0
+        code = 64 + int(10.0 * (log(10 ** (score * log10x) - 1.0, 10)))
+    elif format == "phred64":
+        code = 64 + score
+    if code < 0 or code > 255:
+        return -1
+    return code
+
+
+# lookup tables from ASCII codes to phred scores
+DECODE_TABLES = dict(
+    (format, tuple(_decodeQuality(x, format) for x in range(256)))
+    for format in RANGES)
+
+# lookup tables from phred scores (+ SCORE_OFFSET) to ASCII codes
+ENCODE_TABLES = dict(
+    (format, numpy.array([_encodeQuality(x - SCORE_OFFSET, format)
+                          for x in range(2 * SCORE_OFFSET)],
+                         dtype=numpy.int16))
+    for format in RANGES)
+
+
+class Record(object):
     """A record representing a :term:`fastq` formatted record.
 
     Attributes
@@ -51,6 +107,8 @@ class Record:
 
     """
 
+    __slots__ = ("identifier", "seq", "quals", "format")
+
     def __init__(self, identifier, seq, quals, format=None):
         self.identifier, self.seq, self.quals, format = (
             identifier, seq, quals, format)
@@ -63,8 +121,7 @@ class Record:
         '''return quality score format -
         might return several if ambiguous.'''
 
-        c = [ord(x) for x in self.quals]
-        mi, ma = min(c), max(c)
+        mi, ma = ord(min(self.quals)), ord(max(self.quals))
         r = []
         for format, v in RANGES.items():
             m1, m2 = v
@@ -101,17 +158,9 @@ class Record:
     def toPhred(self):
         '''return qualities as a list of phred-scores.'''
         assert self.format is not None, "format needs to be set for conversion"
-        if self.format == "sanger":
-            return [ord(x) - 33 for x in self.quals]
-        elif self.format == "illumina-1.8":
-            return [ord(x) - 33 for x in self.quals]
-        elif self.format == "solexa":
-            # from -5 to 40 (i.e., can be negative)
-            log10x = log(10.0) + .499
-            return [int(10.0 * log(1.0 + 10 ** (ord(x) / 10.0), 10) / log10x)
-                    for x in self.quals]
-        elif self.format == "phred64":
-            return [ord(x) - 64 for x in self.quals]
+        if self.format in DECODE_TABLES:
+            table = DECODE_TABLES[self.format]
+            return [table[x] for x in bytearray(self.quals, "ascii")]
 
     def fromPhred(self, quals, format):
         '''set qualities from a list of phred-scores.'''
@@ -154,6 +203,196 @@ def iterate(infile):
         yield Record(line1[1:-1], line2[:-1], line4[:-1])
 
 
+class RecordBatch(object):
+    '''a batch of fastq records.
+
+    Sequences and quality scores of all records are stored
+    concatenated in numpy arrays of ASCII codes. The sequence and
+    quality string of record ``i`` are in the slice
+    ``offsets[i]:offsets[i+1]``.
+
+    Attributes
+    ----------
+    identifiers : list
+       Sequence identifiers
+    sequences : numpy.array
+       Concatenated sequences (uint8)
+    qualities : numpy.array
+       Concatenated quality scores (uint8)
+    offsets : numpy.array
+       Start of each record in `sequences` and `qualities`. The
+       array has one more element than there are records.
+    format : string
+       Quality score format.
+
+    '''
+
+    __slots__ = ("identifiers", "sequences", "qualities", "offsets",
+                 "format")
+
+    def __init__(self, identifiers, sequences, qualities, offsets,
+                 format=None):
+        self.identifiers = identifiers
+        self.sequences = sequences
+        self.qualities = qualities
+        self.offsets = offsets
+        self.format = format
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        record = Record(
+            self.identifiers[index],
+            self.sequences[start:end].tobytes().decode("ascii"),
+            self.qualities[start:end].tobytes().decode("ascii"))
+        record.format = self.format
+        return record
+
+    def __iter__(self):
+        for x in range(len(self)):
+            yield self[x]
+
+    def __str__(self):
+        sequences = self.sequences.tobytes().decode("ascii")
+        qualities = self.qualities.tobytes().decode("ascii")
+        offsets = self.offsets.tolist()
+        return "\n".join(
+            ["@%s\n%s\n+\n%s" % (identifier,
+                                 sequences[start:end],
+                                 qualities[start:end])
+             for identifier, start, end in zip(
+                 self.identifiers, offsets[:-1], offsets[1:])])
+
+    def write(self, outfile):
+        '''write batch in fastq format to *outfile*.'''
+        if len(self) > 0:
+            outfile.write("%s\n" % str(self))
+
+    def getLengths(self):
+        '''return array of sequence lengths.'''
+        return numpy.diff(self.offsets)
+
+    def guessFormat(self):
+        '''return quality score formats compatible with all records
+        in the batch - might return several if ambiguous.'''
+        if len(self.qualities) == 0:
+            raise ValueError("no quality scores in batch")
+        mi, ma = self.qualities.min(), self.qualities.max()
+        r = []
+        for format, v in RANGES.items():
+            m1, m2 = v
+            if mi >= m1 and ma <= m2:
+                r.append(format)
+        return r
+
+    def toPhred(self):
+        '''return qualities as an array of phred-scores.
+
+        The array is aligned with :attr:`qualities`.
+        '''
+        assert self.format is not None, "format needs to be set for conversion"
+        if self.format not in DECODE_TABLES:
+            raise ValueError("unknown quality score format '%s'" %
+                             self.format)
+        table = numpy.array(DECODE_TABLES[self.format], dtype=numpy.int16)
+        return table[self.qualities]
+
+    def fromPhred(self, quals, format):
+        '''set qualities from an array of phred-scores.
+
+        Raises
+        ------
+        ValueError
+           If the format is unknown or a score can not be
+           represented in `format`.
+        '''
+        if format not in ENCODE_TABLES:
+            raise ValueError("unknown quality score format '%s'" % format)
+        quals = numpy.asarray(quals, dtype=numpy.int64)
+        assert len(quals) == len(self.qualities)
+        index = quals + SCORE_OFFSET
+        table = ENCODE_TABLES[format]
+        if len(index) > 0 and (index.min() < 0 or
+                               index.max() >= len(table)):
+            raise ValueError("phred score out of range for format '%s'" %
+                             format)
+        codes = table[index]
+        if len(codes) > 0 and codes.min() < 0:
+            raise ValueError("phred score %i can not be encoded in '%s'" %
+                             (quals[codes < 0][0], format))
+        self.qualities = codes.astype(numpy.uint8)
+        self.format = format
+
+
+def _packLines(lines):
+    '''pack lines into an array of ASCII codes without line
+    terminators.
+
+    returns the array and the offsets of each line.
+    '''
+    text = "".join(lines)
+    if not text.endswith("\n"):
+        text += "\n"
+    data = numpy.frombuffer(text.encode("ascii"), dtype=numpy.uint8)
+    keep = (data != 10) & (data != 13)
+    newlines = numpy.flatnonzero(data == 10)
+    offsets = numpy.zeros(len(newlines) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum(keep)[newlines]
+    return data[keep], offsets
+
+
+def iterate_batches(infile, batch_size=100000):
+    '''iterate over contents of fastq file in batches.
+
+    Arguments
+    ---------
+    infile : File
+       File or file-like object to iterate over
+    batch_size : int
+       Number of records in each batch. The last batch
+       might be smaller.
+
+    Yields
+    ------
+    batch
+        An object of type :class:`RecordBatch`.
+
+    Raises
+    ------
+    ValueError
+        If the file is not in fastq format.
+    '''
+    while 1:
+        lines = list(itertools.islice(infile, 4 * batch_size))
+        if not lines:
+            break
+
+        identifiers = lines[0::4]
+        for line in identifiers:
+            if not line.startswith('@'):
+                raise ValueError(
+                    "parsing error: expected '@' in line %s" % line)
+        for line in lines[2::4]:
+            if not line.startswith('+'):
+                raise ValueError(
+                    "parsing error: expected '+' in line %s" % line)
+        if len(lines) % 4 != 0:
+            raise ValueError("incomplete entry for %s" % identifiers[-1])
+
+        sequences, offsets = _packLines(lines[1::4])
+        qualities, qual_offsets = _packLines(lines[3::4])
+        if not numpy.array_equal(offsets, qual_offsets):
+            x = numpy.flatnonzero(offsets != qual_offsets)[0] - 1
+            raise ValueError(
+                "sequence and quality lengths differ for %s" %
+                identifiers[x])
+
+        yield RecordBatch([x[1:].rstrip("\r\n") for x in identifiers],
+                          sequences, qualities, offsets)
+
+
 def iterate_guess(infile, max_tries=10000, guess=None):
     '''iterate over contents of fastq file.
 
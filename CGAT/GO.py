@@ -17,6 +17,7 @@ import collections
 import scipy
 import scipy.stats
 import scipy.special
+import scipy.sparse
 import numpy
 from CGAT import Stats as Stats
 from CGAT import Experiment as E
@@ -239,6 +240,42 @@ def readOntology(infile):
     return result
 
 
+def buildAncestors(ontology):
+    """build a dictionary mapping each term in *ontology* to
+    the set of its ancestors.
+
+    Ancestors are collected by following the ``is_a`` relationships
+    of each term.
+    """
+    parents = {}
+    for goid, entry in ontology.items():
+        parents[goid] = [x.split()[0] for x in getattr(entry, "mIsA", [])]
+
+    ancestors = {}
+    for goid in parents:
+        if goid in ancestors:
+            continue
+        visiting = set()
+        stack = [(goid, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if node in ancestors:
+                continue
+            if expanded:
+                a = set()
+                for parent in parents.get(node, []):
+                    a.add(parent)
+                    a.update(ancestors.get(parent, ()))
+                ancestors[node] = a
+            elif node not in visiting:
+                visiting.add(node)
+                stack.append((node, True))
+                stack.extend([(x, False) for x in parents.get(node, [])
+                              if x not in ancestors])
+
+    return ancestors
+
+
 class GOSample:
 
     """store results from sampling.
@@ -940,11 +977,53 @@ def buildGO2Genes(gene2gos, ancestors=None):
         for term in terms:
             go2genes[term.mGOId].add(gene_id)
             if ancestors:
-                for anc in ancestors[term.mGOId]:
+                for anc in ancestors.get(term.mGOId, ()):
                     go2genes[anc].add(gene_id)
     return go2genes
 
 
+def propagateGene2GO(gene2go, ancestors, ontology):
+    '''add ancestral terms to the GO assignments in *gene2go*.
+
+    The assignments are propagated with :func:`buildGO2Genes` using
+    the dictionary *ancestors* (see :func:`buildAncestors`). Ancestral
+    terms are described by the entries in *ontology*.
+
+    returns a new gene2go mapping.
+    '''
+    go2genes = buildGO2Genes(gene2go, ancestors)
+
+    result = dict([(gene_id, list(terms))
+                   for gene_id, terms in gene2go.items()])
+    present = dict([(gene_id, set([x.mGOId for x in terms]))
+                    for gene_id, terms in gene2go.items()])
+
+    for goid, genes in sorted(go2genes.items()):
+        if goid in ontology:
+            info = GOInfo(goid,
+                          go_type=ontology[goid].mNameSpace,
+                          description=ontology[goid].mName)
+        else:
+            info = GOInfo(goid)
+        for gene_id in sorted(genes):
+            if goid not in present[gene_id]:
+                result[gene_id].append(info)
+
+    return result
+
+
+def loadCached(filenames, build, cache_dir, **kwargs):
+    '''return the result of calling *build*, using a cache in *cache_dir*.
+
+    The cache is keyed on the absolute path, modification time and
+    size of each file in *filenames* and on the keyword arguments in
+    *kwargs*. If no up-to-date cached result exists, *build* is called
+    with *kwargs* and the result is pickled to the cache.
+    '''
+    return IOTools.cached(filenames, build, cache_dir, "go.%s.pickle",
+                          **kwargs)
+
+
 def GetCode(v):
     """return a code for over/underrepresentation."""
 
@@ -1114,56 +1193,414 @@ def outputResults(outfile,
         outfile.write("\n")
 
 
-def getSamples(gene2go, foreground, background, options, test_ontology,
-               go2info):
+def buildGOMatrix(gene2go, genes):
+    """build a sparse matrix of GO assignments for *genes*.
 
-    sample_size = options.sample
-    # List of all minimum probabilities in simulation
-    simulation_min_pvalues = []
-    E.info("sampling: calculating %i samples: " % (sample_size))
+    Returns a tuple (matrix, go_ids) with matrix a
+    :class:`scipy.sparse.csr_matrix` with a row for each gene in
+    *genes* and a column for each GO category in the sorted list
+    *go_ids*. Genes without GO assignments have empty rows.
+    """
+    rows, go_ids = [], []
+    for gene_id in genes:
+        rows.append([go.mGOId for go in gene2go.get(gene_id, [])])
+        go_ids.extend(rows[-1])
 
-    counts = {}
-    prob_overs = {}
-    prob_unders = {}
+    go_ids = sorted(set(go_ids))
+    map_go2column = dict([(y, x) for x, y in enumerate(go_ids)])
 
-    samples = {}
+    indptr = numpy.cumsum([0] + [len(x) for x in rows])
+    indices = numpy.array([map_go2column[x] for row in rows for x in row],
+                          dtype=numpy.int32)
+    matrix = scipy.sparse.csr_matrix(
+        (numpy.ones(len(indices), dtype=numpy.int32), indices, indptr),
+        shape=(len(rows), len(go_ids)))
+    # sum duplicate assignments
+    matrix.sum_duplicates()
 
-    options.stdlog.write("# ")
-    options.stdlog.flush()
+    return matrix, go_ids
 
-    for x in range(sample_size):
 
-        if options.loglevel >= 1:
-            options.stdlog.write(".")
-            options.stdlog.flush()
+def sumHypergeometricTail(k, M, n, N, direction, epsilon=1e-14):
+    """sum hypergeometric probabilities starting at *k*.
 
-        # get shuffled array of genes from background
-        sample_genes = random.sample(background, len(foreground))
+    Probabilities are summed from *k* upwards if *direction* is
+    positive and downwards otherwise. Successive probabilities are
+    computed from the ratio of neighbouring probabilities and
+    summation stops once the terms become smaller than *epsilon*
+    relative to the sum. The sum is only accurate if the terms
+    decrease monotonically, i.e., if *k* is not on the other side of
+    the mode.
 
-        go_results = AnalyseGO(gene2go, sample_genes, background)
+    All arguments are one-dimensional arrays of the same size.
+    """
+    term = numpy.exp(scipy.stats.hypergeom.logpmf(k, M, n, N))
+    total = term.copy()
+    lower = numpy.maximum(0, N - (M - n))
+    upper = numpy.minimum(n, N)
+
+    i = k.astype(numpy.float64)
+    index = numpy.nonzero(term > 0)[0]
+    term = term[index]
+
+    while len(index):
+        ii, MM, nn, NN = i[index], M[index], n[index], N[index]
+        if direction > 0:
+            term *= (nn - ii) * (NN - ii) / \
+                ((ii + 1) * (MM - nn - NN + ii + 1))
+            ii += 1
+            valid = ii <= upper[index]
+        else:
+            term *= ii * (MM - nn - NN + ii) / ((nn - ii + 1) * (NN - ii + 1))
+            ii -= 1
+            valid = ii >= lower[index]
+        term[~valid] = 0
+        i[index] = ii
+        total[index] += term
+        keep = valid & (term > total[index] * epsilon)
+        index = index[keep]
+        term = term[keep]
 
-        pairs = list(go_results.mResults.items())
+    return total
 
-        for k, v in pairs:
-            if k not in counts:
-                counts[k] = []
-                prob_overs[k] = []
-                prob_unders[k] = []
 
-            counts[k].append(v.mSampleCountsCategory)
-            prob_overs[k].append(v.mProbabilityOverRepresentation)
-            prob_unders[k].append(v.mProbabilityUnderRepresentation)
+def hypergeometricTails(k, M, n, N):
+    """compute both tails of the hypergeometric distribution.
 
-            simulation_min_pvalues.append(v.mPValue)
+    *k* is the number of observed successes in a sample of size *N*
+    drawn from a population of size *M* with *n* successes.
 
-    if options.loglevel >= 1:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+    This is a vectorised alternative to :func:`hypergeometric_P` and
+    :func:`hypergeometric_Q`. Tails are summed away from the mode of
+    the distribution, while the complementary probability is used for
+    the other side.
+
+    Returns a tuple of arrays (pover, punder) with the probabilities
+    P(X >= k) and P(X <= k), respectively.
+    """
+    k, M, n, N = numpy.broadcast_arrays(
+        *[numpy.asarray(x, dtype=numpy.float64) for x in (k, M, n, N)])
+    shape = k.shape
+    k, M, n, N = [x.ravel() for x in (k, M, n, N)]
+
+    mode = numpy.floor((N + 1) * (n + 1) / (M + 2))
+    below = k <= mode
+
+    pover = numpy.empty(len(k))
+    punder = numpy.empty(len(k))
+
+    # k at or below the mode: sum lower tail downwards
+    x = numpy.nonzero(below)[0]
+    if len(x):
+        punder[x] = sumHypergeometricTail(
+            k[x], M[x], n[x], N[x], -1)
+        pover[x] = 1.0 - sumHypergeometricTail(
+            k[x] - 1, M[x], n[x], N[x], -1)
+
+    # k above the mode: sum upper tail upwards
+    x = numpy.nonzero(~below)[0]
+    if len(x):
+        pover[x] = sumHypergeometricTail(
+            k[x], M[x], n[x], N[x], 1)
+        punder[x] = 1.0 - sumHypergeometricTail(
+            k[x] + 1, M[x], n[x], N[x], 1)
+
+    return pover.reshape(shape), punder.reshape(shape)
+
+
+def computeProbabilities(sample_counts, sample_totals,
+                         background_counts, background_total):
+    """compute probabilities of over- and under-representation.
+
+    This is a vectorised version of :meth:`GOResult.UpdateProbabilities`
+    for a matrix of *sample_counts* with a row for each sample and a
+    column for each GO category. *sample_totals* is the number of
+    genes with GO assignments in each sample and *background_counts*
+    the counts of each category in the background.
+
+    If each sample has its own background, *background_counts* is
+    a matrix of the same shape as *sample_counts* and
+    *background_total* an array with a value for each sample.
+
+    Returns a tuple of arrays (pover, punder).
+    """
+    sample_counts = numpy.asarray(sample_counts)
+    totals = numpy.asarray(sample_totals).reshape(-1, 1)
+    background_counts = numpy.asarray(background_counts)
+    if background_counts.ndim == 1:
+        background_counts = background_counts.reshape(1, -1)
+    background_total = numpy.asarray(background_total)
+    if background_total.ndim == 1:
+        background_total = background_total.reshape(-1, 1)
+
+    pover, punder = hypergeometricTails(sample_counts,
+                                        background_total,
+                                        background_counts,
+                                        totals)
+    pover[sample_counts == 0] = 1.0
+    punder[(sample_counts >= background_counts) |
+           (sample_counts >= totals)] = 1.0
+
+    return numpy.clip(pover, 0, 1), numpy.clip(punder, 0, 1)
+
+
+def sampleGOCounts(matrix, has_go, sample_size, num_samples, seed):
+    """draw random samples of genes from *matrix*.
+
+    Each sample consists of *sample_size* rows of *matrix* drawn
+    without replacement. *has_go* is a boolean array flagging
+    genes with GO assignments.
+
+    Returns a tuple (counts, totals) of the counts of each
+    GO category in each sample and the number of genes with GO
+    assignments in each sample.
+    """
+    rng = numpy.random.RandomState(seed)
+    ngenes = matrix.shape[0]
+    sample_size = min(sample_size, ngenes)
+
+    if sample_size < ngenes:
+        keys = rng.random_sample((num_samples, ngenes))
+        indices = numpy.argpartition(keys, sample_size, axis=1)
+        indices = indices[:, :sample_size]
+    else:
+        indices = numpy.tile(numpy.arange(ngenes), (num_samples, 1))
+
+    samples = scipy.sparse.csr_matrix(
+        (numpy.ones(indices.size, dtype=numpy.int32),
+         indices.ravel(),
+         numpy.arange(0, indices.size + 1, sample_size)),
+        shape=(num_samples, ngenes))
+
+    counts = samples.dot(matrix).toarray()
+    totals = has_go[indices].sum(axis=1)
+
+    return counts, totals
 
-    E.info("sampling: sorting %i P-Values" % len(simulation_min_pvalues))
 
+def sampleGOProbabilities(matrix, has_go, sample_size, num_samples, seed):
+    """draw samples from *matrix* and compute probabilities.
+
+    Returns a tuple (counts, pover, punder), see
+    :func:`sampleGOCounts` and :func:`computeProbabilities`.
+    """
+    counts, totals = sampleGOCounts(matrix, has_go, sample_size,
+                                    num_samples, seed)
+    background_counts = numpy.asarray(matrix.sum(axis=0)).ravel()
+    background_total = numpy.sum(has_go)
+    pover, punder = computeProbabilities(counts, totals,
+                                         background_counts,
+                                         background_total)
+    return counts, pover, punder
+
+
+def countGOBatch(matrix, has_go, foregrounds, backgrounds):
+    """count GO categories in several gene lists at once.
+
+    *foregrounds* and *backgrounds* are sparse matrices with a row
+    for each gene list and a column for each row in *matrix*. An
+    entry is the number of times a gene appears in a gene list.
+
+    Returns a tuple of arrays (sample_counts, sample_totals,
+    background_counts, background_totals, pover, punder).
+    """
+    sample_counts = foregrounds.dot(matrix).toarray()
+    background_counts = backgrounds.dot(matrix).toarray()
+    has_go = has_go.astype(numpy.int64)
+    sample_totals = (foregrounds > 0).dot(has_go)
+    background_totals = (backgrounds > 0).dot(has_go)
+
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        pover, punder = computeProbabilities(sample_counts,
+                                             sample_totals,
+                                             background_counts,
+                                             background_totals)
+
+    return (sample_counts, sample_totals,
+            background_counts, background_totals,
+            pover, punder)
+
+
+def buildGeneListMatrix(genelists, map_gene2column, ncolumns):
+    """build a sparse matrix with a row for each gene list.
+
+    Genes not in *map_gene2column* are ignored.
+    """
+    indices = [[map_gene2column[x] for x in genes if x in map_gene2column]
+               for genes in genelists]
+    indptr = numpy.cumsum([0] + [len(x) for x in indices])
+    indices = numpy.array([x for row in indices for x in row],
+                          dtype=numpy.int32)
+    matrix = scipy.sparse.csr_matrix(
+        (numpy.ones(len(indices), dtype=numpy.int32), indices, indptr),
+        shape=(len(genelists), ncolumns))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def analyseGOBatch(gene2go, genelists, backgrounds,
+                   num_threads=1, chunk_size=100):
+    """analyse GO enrichment in several gene lists.
+
+    This computes the same results as calling :func:`AnalyseGO` for
+    each gene list in *genelists* and the matching background in
+    *backgrounds*. The gene lists are counted with a sparse matrix
+    product and probabilities are computed for all gene lists at
+    once. Chunks of *chunk_size* gene lists can be processed in
+    *num_threads* processes.
+
+    Returns a list of :class:`GOResults`.
+    """
+
+    genes = set()
+    for x in genelists:
+        genes.update(x)
+    for x in backgrounds:
+        genes.update(x)
+    genes = sorted([x for x in genes if x in gene2go])
+
+    matrix, go_ids = buildGOMatrix(gene2go, genes)
+    has_go = numpy.ones(len(genes), dtype=bool)
+    map_gene2column = dict([(y, x) for x, y in enumerate(genes)])
+
+    foregrounds = buildGeneListMatrix(
+        genelists, map_gene2column, len(genes))
+    backgrounds_matrix = buildGeneListMatrix(
+        backgrounds, map_gene2column, len(genes))
+
+    chunks = [(foregrounds[x:x + chunk_size],
+               backgrounds_matrix[x:x + chunk_size])
+              for x in range(0, len(genelists), chunk_size)]
+
+    if num_threads > 1 and len(chunks) > 1:
+        pool = E.getWorkerPool(num_threads, batch=(matrix, has_go))
+        counts = list(pool.imap(runBatchChunk, chunks))
+        pool.close()
+        pool.join()
+    else:
+        counts = [countGOBatch(matrix, has_go, f, b) for f, b in chunks]
+
+    if not counts:
+        return []
+
+    (sample_counts, sample_totals,
+     background_counts, background_totals,
+     pover, punder) = [numpy.concatenate(x) for x in zip(*counts)]
+
+    results = []
+    for row, (genes, background) in enumerate(zip(genelists, backgrounds)):
+
+        result = GOResults()
+        result.mBackgroundCountsTotal = int(background_counts[row].sum())
+        result.mBackgroundGenes = dict(
+            [(x, 1) for x in background if x in gene2go])
+        result.mNumGenes = len(genes)
+        result.mSampleCountsTotal = int(sample_counts[row].sum())
+        result.mSampleNumCategories = int(
+            numpy.count_nonzero(sample_counts[row]))
+        result.mSampleGenes = dict([(x, 1) for x in genes if x in gene2go])
+
+        columns = numpy.nonzero(background_counts[row])[0]
+        result.mBackgroundNumCategories = len(columns)
+
+        sample_total = int(sample_totals[row])
+        background_total = int(background_totals[row])
+
+        for column in columns:
+            result_go = GOResult(go_ids[column])
+            result_go.mSampleCountsCategory = int(sample_counts[row, column])
+            result_go.mSampleCountsTotal = sample_total
+            result_go.mBackgroundCountsTotal = background_total
+            result_go.mBackgroundCountsCategory = int(
+                background_counts[row, column])
+            result_go.mProbabilityOverRepresentation = float(
+                pover[row, column])
+            result_go.mProbabilityUnderRepresentation = float(
+                punder[row, column])
+            result_go.mPValue = min(
+                result_go.mProbabilityOverRepresentation,
+                result_go.mProbabilityUnderRepresentation)
+
+            if sample_total == 0:
+                result_go.mRatio = "na"
+            else:
+                result_go.mRatio = \
+                    float(result_go.mSampleCountsCategory) * \
+                    background_total / sample_total / \
+                    result_go.mBackgroundCountsCategory
+
+            result.mResults[go_ids[column]] = result_go
+
+        results.append(result)
+
+    return results
+
+
+def runBatchChunk(args):
+    """count a chunk of gene lists in a worker process."""
+    foregrounds, backgrounds = args
+    matrix, has_go = E.WORKER_STATE["batch"]
+    return countGOBatch(matrix, has_go, foregrounds, backgrounds)
+
+
+def runSampleBatch(args):
+    """sample a batch of *num_samples* in a worker process."""
+    num_samples, seed = args
+    matrix, has_go, sample_size = E.WORKER_STATE["args"]
+    return sampleGOProbabilities(matrix, has_go, sample_size,
+                                 num_samples, seed)
+
+
+def getSamples(gene2go, foreground, background, options, test_ontology,
+               go2info):
+    """compute GO enrichment in random samples of *background*.
+
+    The GO assignments of the background are stored in a sparse
+    matrix and samples are processed in batches of
+    *options.sample_batch_size*. Each batch uses a separate random
+    number generator seeded from python's random number generator,
+    so that results do not depend on the number of processes given
+    by *options.num_threads*.
+    """
+
+    sample_size = options.sample
+    E.info("sampling: calculating %i samples: " % (sample_size))
+
+    matrix, go_ids = buildGOMatrix(gene2go, background)
+    # genes without assignments after filtering still count as
+    # annotated genes, see :func:`GetGOFrequencies`
+    has_go = numpy.array([x in gene2go for x in background], dtype=bool)
+
+    batch_size = max(1, options.sample_batch_size)
+    batches = []
+    for x in range(0, sample_size, batch_size):
+        batches.append((min(batch_size, sample_size - x),
+                        random.randint(0, 2 ** 32 - 1)))
+
+    if options.num_threads > 1:
+        pool = E.getWorkerPool(options.num_threads,
+                               args=(matrix, has_go, len(foreground)))
+        results = list(pool.imap(runSampleBatch, batches))
+        pool.close()
+        pool.join()
+    else:
+        results = [sampleGOProbabilities(matrix, has_go, len(foreground),
+                                         num_samples, seed)
+                   for num_samples, seed in batches]
+
+    if results:
+        counts = numpy.vstack([x[0] for x in results])
+        prob_overs = numpy.vstack([x[1] for x in results])
+        prob_unders = numpy.vstack([x[2] for x in results])
+    else:
+        counts = numpy.zeros((0, len(go_ids)), dtype=numpy.int32)
+        prob_overs = numpy.zeros((0, len(go_ids)))
+        prob_unders = numpy.zeros((0, len(go_ids)))
+
+    # List of all minimum probabilities in simulation
+    simulation_min_pvalues = numpy.minimum(prob_overs, prob_unders).ravel()
+    E.info("sampling: sorting %i P-Values" % len(simulation_min_pvalues))
     simulation_min_pvalues.sort()
-    simulation_min_pvalues = numpy.array(simulation_min_pvalues)
 
     samples = {}
 
@@ -1179,20 +1616,18 @@ def getSamples(gene2go, foreground, background, options, test_ontology,
                              "CI95lower", "CI95upper",
                              "pover", "punder", "goid",
                              "category", "description")) + "\n")
-    for k in sorted(list(counts.keys())):
 
-        c = counts[k]
+    for column, k in enumerate(go_ids):
 
-        prob_overs[k].sort()
-        prob_unders[k].sort()
+        c = counts[:, column]
 
         s = GOSample(min(c),
                      max(c),
-                     scipy.mean(c),
+                     numpy.mean(c),
                      numpy.std(c),
-                     numpy.array(prob_overs[k]),
-                     numpy.array(prob_unders[k]),
-                     counts[k])
+                     numpy.sort(prob_overs[:, column]),
+                     numpy.sort(prob_unders[:, column]),
+                     c)
 
         samples[k] = s
 
@@ -1200,13 +1635,13 @@ def getSamples(gene2go, foreground, background, options, test_ontology,
                       (k,
                        min(c),
                        max(c),
-                       scipy.mean(c),
-                       scipy.median(c),
+                       numpy.mean(c),
+                       numpy.median(c),
                        numpy.std(c),
                        scipy.stats.scoreatpercentile(c, 5),
                        scipy.stats.scoreatpercentile(c, 95),
-                       min(prob_overs[k]),
-                       min(prob_unders[k]),
+                       min(prob_overs[:, column]),
+                       min(prob_unders[:, column]),
                        go2info[k]))
 
     if options.output_filename_pattern:
@@ -1303,15 +1738,11 @@ def computeFDRs(go_results,
 
             # calculate values for FDR:
             # nfdr = number of entries with P-Value better than node.
-            a = 0
-            while a < len(simulation_min_pvalues) and \
-                    simulation_min_pvalues[a] < pvalue:
-                a += 1
+            a = numpy.searchsorted(simulation_min_pvalues, pvalue,
+                                   side="left")
             a = float(a) / float(sample_size)
-            b = 0
-            while b < len(observed_min_pvalues) and \
-                    observed_min_pvalues[b] < pvalue:
-                b += 1
+            b = numpy.searchsorted(observed_min_pvalues, pvalue,
+                                   side="left")
 
             if b > 0:
                 fdr = min(1.0, float(a) / float(b))
@@ -33,15 +33,28 @@ Apart from basic iteration, this module provides the following utilities:
 * Manipulate lists of GTF records: :func:`asRanges`, :func:`CombineOverlaps`,
   :func:`SortPerContig`, :func:`toIntronIntervals`, :func:`toSequence`
 
+* Read a complete file into memory column by column:
+  :func:`read_columnar` returns a :class:`ColumnarGTF`. Iterating
+  over it yields :class:`ColumnarEntry` views that can be used with
+  the iterators above.
+
 """
 
 import collections
+import re
+import numpy
 from CGAT import Intervals as Intervals
 from CGAT import Genomics as Genomics
 from CGAT import IndexedGenome as IndexedGenome
 import pysam
 from CGAT import IOTools as IOTools
 
+# gene and transcript identifiers in the attribute field,
+# quoted or unquoted
+RX_GENE_ID = re.compile(r'(?:^|;)\s*gene_id\s+(?:"([^"]*)"|([^;\s]+))')
+RX_TRANSCRIPT_ID = re.compile(
+    r'(?:^|;)\s*transcript_id\s+(?:"([^"]*)"|([^;\s]+))')
+
 
 def iterator(infile):
     """return a simple iterator over all entries in a file."""
@@ -692,9 +705,24 @@ def readAsIntervals(gff_iterator,
     return intervals
 
 
-def readAndIndex(iterator, with_value=True):
+def readAndIndex(iterator, with_value=True, cache=None, filename=None):
     '''read from gtf stream and index.
 
+    Arguments
+    ---------
+    iterator : iterator
+       Iterator yielding GTF records.
+    with_value : bool
+       If True, store the GTF records in the index.
+    cache : string
+       If given, save the index in this directory and re-use it in
+       subsequent calls as long as `filename` has not been modified,
+       see :func:`IndexedGenome.cached`. Records in a cached index
+       are stored as :class:`Entry` objects.
+    filename : string
+       Name of the file that `iterator` reads from. Required if
+       `cache` is given.
+
     Returns
     -------
 
@@ -702,6 +730,28 @@ def readAndIndex(iterator, with_value=True):
         an object of type :class:`IndexedGenome.IndexedGenome`
     '''
 
+    if cache is not None:
+        if filename is None:
+            raise ValueError("a filename is required to cache an index")
+
+        def _buildIndex(with_value):
+            if not with_value:
+                return readAndIndex(iterator, with_value=False)
+            # GTF records returned by pysam can not be pickled
+            index = IndexedGenome.IndexedGenome()
+            for gtf in iterator:
+                index.add(gtf.contig, gtf.start, gtf.end, Entry().copy(gtf))
+            return index
+
+        if with_value:
+            index_class = IndexedGenome.IndexedGenome
+        else:
+            index_class = IndexedGenome.Simple
+
+        return IndexedGenome.cached(filename, _buildIndex, cache,
+                                    index_class=index_class,
+                                    with_value=with_value)
+
     if with_value:
         index = IndexedGenome.IndexedGenome()
         for gtf in iterator:
@@ -739,6 +789,53 @@ class ParsingError(Error):
         self.message = message
 
 
+def parseAttributes(attributes):
+    """parse the attribute field of a GTF record.
+
+    Returns an ordered dictionary of all attributes including
+    gene_id and transcript_id. Quoted values are returned as strings,
+    other values are converted to numbers if possible.
+    """
+
+    # remove comments
+    attributes = attributes.split("#")[0]
+
+    # separate into fields
+    # Fields might contain a ";", for example in ENSEMBL GTF file
+    # for mouse, v78:
+    # ...; transcript_name "TXNRD2;-001"; ....
+    # The current heuristic is to split on a semicolon followed by a
+    # space, which seems to be part of the specification, see
+    # http://mblab.wustl.edu/GTF22.html
+    fields = [x.strip()
+              for x in attributes[:attributes.rfind(";")].split("; ")]
+    result = collections.OrderedDict()
+
+    for f in fields:
+
+        d = [x.strip() for x in f.split(" ")]
+
+        n, v = d[0], " ".join(d[1:])
+        if len(d) > 2:
+            v = d[1:]
+
+        if v[0] == '"' and v[-1] == '"':
+            v = v[1:-1]
+        else:
+            # try to convert to a value
+            try:
+                v = float(v)
+                v = int(v)
+            except ValueError:
+                pass
+            except TypeError:
+                pass
+
+        result[n] = v
+
+    return result
+
+
 def toDot(v):
     '''convert value to '.' if None'''
     if v is None:
@@ -828,45 +925,9 @@ class Entry:
         if present.
         """
 
-        # remove comments
-        attributes = attributes.split("#")[0]
-
-        # separate into fields
-        # Fields might contain a ";", for example in ENSEMBL GTF file
-        # for mouse, v78:
-        # ...; transcript_name "TXNRD2;-001"; ....
-        # The current heuristic is to split on a semicolon followed by a
-        # space, which seems to be part of the specification, see
-        # http://mblab.wustl.edu/GTF22.html
-        fields = [x.strip() for x in attributes[:attributes.rfind(";")].split("; ")]
-        self.attributes = collections.OrderedDict()
-
-        for f in fields:
-
-            d = [x.strip() for x in f.split(" ")]
-
-            n, v = d[0], " ".join(d[1:])
-            if len(d) > 2:
-                v = d[1:]
-
-            if v[0] == '"' and v[-1] == '"':
-                v = v[1:-1]
-            else:
-                # try to convert to a value
-                try:
-                    v = float(v)
-                    v = int(v)
-                except ValueError:
-                    pass
-                except TypeError:
-                    pass
-
-            if n == "gene_id":
-                self.gene_id = v
-            elif n == "transcript_id":
-                self.transcript_id = v
-            else:
-                self.attributes[n] = v
+        self.attributes = parseAttributes(attributes)
+        self.gene_id = self.attributes.pop("gene_id", None)
+        self.transcript_id = self.attributes.pop("transcript_id", None)
 
         if not self.gene_id:
             raise ParsingError("missing attribute 'gene_id' in line %s" % line)
@@ -1068,3 +1129,321 @@ class Entry:
                 self.strand == other.strand and
                 (abs(self.end - other.end) < max_slippage or
                  abs(self.start - other.start < max_slippage)))
+
+
+class ColumnarEntry(object):
+    """a lightweight view of a single record in a :class:`ColumnarGTF`.
+
+    The view provides the read-only attributes of a
+    :class:`pysam.GTFProxy` (``contig``, ``source``, ``feature``,
+    ``start``, ``end``, ``score``, ``strand``, ``frame``, ``gene_id``
+    and ``transcript_id``) so that it can be passed to the iterators
+    in this module such as :func:`transcript_iterator` or
+    :func:`flat_gene_iterator`.
+
+    The attribute field is only parsed when it is first accessed
+    through :meth:`asDict` or item access.
+    """
+
+    __slots__ = ("_gtf", "_index", "_attributes")
+
+    def __init__(self, gtf, index):
+        self._gtf = gtf
+        self._index = index
+        self._attributes = None
+
+    @property
+    def contig(self):
+        return self._gtf.contigs[self._gtf.contig_codes[self._index]]
+
+    @property
+    def source(self):
+        return self._gtf.sources[self._gtf.source_codes[self._index]]
+
+    @property
+    def feature(self):
+        return self._gtf.features[self._gtf.feature_codes[self._index]]
+
+    @property
+    def start(self):
+        return int(self._gtf.starts[self._index])
+
+    @property
+    def end(self):
+        return int(self._gtf.ends[self._index])
+
+    @property
+    def score(self):
+        score = self._gtf.scores[self._gtf.score_codes[self._index]]
+        if score == ".":
+            return None
+        return float(score)
+
+    @property
+    def strand(self):
+        strand = self._gtf.strands[self._gtf.strand_codes[self._index]]
+        if strand == ".":
+            return None
+        return strand
+
+    @property
+    def frame(self):
+        frame = self._gtf.frames[self._gtf.frame_codes[self._index]]
+        if frame == ".":
+            return None
+        return int(frame)
+
+    @property
+    def gene_id(self):
+        code = self._gtf.gene_codes[self._index]
+        if code < 0:
+            raise KeyError("gene_id")
+        return self._gtf.gene_ids[code]
+
+    @property
+    def transcript_id(self):
+        code = self._gtf.transcript_codes[self._index]
+        if code < 0:
+            raise KeyError("transcript_id")
+        return self._gtf.transcript_ids[code]
+
+    @property
+    def attributes(self):
+        '''the unparsed attribute field.'''
+        return self._gtf.getAttributeField(self._index)
+
+    def asDict(self):
+        '''return attributes, including gene_id and transcript_id, as
+        a dictionary.'''
+        if self._attributes is None:
+            self._attributes = parseAttributes(self.attributes)
+        return self._attributes
+
+    def keys(self):
+        return list(self.asDict().keys())
+
+    def __getitem__(self, key):
+        return self.asDict()[key]
+
+    def __contains__(self, key):
+        return key in self.asDict()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __str__(self):
+        gtf, index = self._gtf, self._index
+        return "\t".join((self.contig, self.source, self.feature,
+                          str(self.start + 1), str(self.end),
+                          gtf.scores[gtf.score_codes[index]],
+                          gtf.strands[gtf.strand_codes[index]],
+                          gtf.frames[gtf.frame_codes[index]],
+                          self.attributes))
+
+
+class ColumnarGTF(object):
+    """a :term:`GTF` file stored column by column.
+
+    Coordinates are stored in numpy arrays of 0-based, half-open
+    coordinates. The text columns and the gene and transcript
+    identifiers are interned: each record stores an integer code
+    that indexes into a list of distinct values, for example::
+
+        gtf.contigs[gtf.contig_codes[x]]
+
+    is the contig of the x-th record. Missing gene or transcript
+    identifiers are stored as -1.
+
+    The attribute fields are kept in a single string and are only
+    parsed on demand.
+
+    Iterating over a :class:`ColumnarGTF` yields
+    :class:`ColumnarEntry` views in file order. Use
+    :func:`read_columnar` to build an object from a file.
+    """
+
+    columns = ("contig_codes", "source_codes", "feature_codes",
+               "starts", "ends", "score_codes", "strand_codes",
+               "frame_codes", "gene_codes", "transcript_codes")
+
+    def __init__(self):
+        self.contigs = []
+        self.sources = []
+        self.features = []
+        self.scores = []
+        self.strands = []
+        self.frames = []
+        self.gene_ids = []
+        self.transcript_ids = []
+        for column in self.columns:
+            setattr(self, column, numpy.zeros(0, dtype=numpy.int32))
+        self.attribute_data = ""
+        self.attribute_offsets = numpy.zeros(1, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("record index out of range")
+        return ColumnarEntry(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield ColumnarEntry(self, index)
+
+    def getAttributeField(self, index):
+        '''return the unparsed attribute field of record *index*.'''
+        return self.attribute_data[
+            self.attribute_offsets[index]:self.attribute_offsets[index + 1]]
+
+    def getCode(self, column, value):
+        '''return the code of *value* in the interned *column*, for
+        example ``gtf.getCode("features", "exon")``.
+
+        Returns -1 if *value* does not occur.
+        '''
+        try:
+            return getattr(self, column).index(value)
+        except ValueError:
+            return -1
+
+    def select(self, mask):
+        '''return a new :class:`ColumnarGTF` with the records selected
+        by *mask*, a boolean array or an array of indices.
+
+        The interned values are shared with this object.
+        '''
+        indices = numpy.arange(len(self))[mask]
+        result = ColumnarGTF()
+        for column in ("contigs", "sources", "features", "scores",
+                       "strands", "frames", "gene_ids", "transcript_ids"):
+            setattr(result, column, getattr(self, column))
+        for column in self.columns:
+            setattr(result, column, getattr(self, column)[indices])
+
+        starts = self.attribute_offsets[indices]
+        ends = self.attribute_offsets[indices + 1]
+        result.attribute_data = "".join(
+            [self.attribute_data[x:y] for x, y in zip(starts, ends)])
+        result.attribute_offsets = numpy.zeros(
+            len(indices) + 1, dtype=numpy.int64)
+        numpy.cumsum(ends - starts, out=result.attribute_offsets[1:])
+        return result
+
+
+def _asValues(codes):
+    '''return list of values from a dictionary mapping values to codes.'''
+    return [x[0] for x in sorted(codes.items(), key=lambda x: x[1])]
+
+
+def _extractIds(field):
+    '''return gene_id and transcript_id in attribute *field*.
+
+    Missing identifiers are returned as None.
+    '''
+    match = RX_GENE_ID.search(field)
+    gene_id = match.group(match.lastindex) if match else None
+    match = RX_TRANSCRIPT_ID.search(field)
+    transcript_id = match.group(match.lastindex) if match else None
+    return gene_id, transcript_id
+
+
+def read_columnar(infile):
+    """read a :term:`GTF` formatted file into a :class:`ColumnarGTF`.
+
+    Comment lines, empty lines and track lines are skipped.
+
+    Arguments
+    ---------
+    infile : string or file
+       Filename (optionally compressed) or an open file object.
+
+    Returns
+    -------
+    gtf : :class:`ColumnarGTF`
+    """
+
+    if isinstance(infile, str):
+        with IOTools.openFile(infile) as inf:
+            return read_columnar(inf)
+
+    gtf = ColumnarGTF()
+    columns = [[] for x in gtf.columns]
+    (contig_codes, source_codes, feature_codes, starts, ends,
+     score_codes, strand_codes, frame_codes,
+     gene_codes, transcript_codes) = columns
+    contigs, sources, features = {}, {}, {}
+    scores, strands, frames = {}, {}, {}
+    # None is used for missing identifiers and is removed at the end
+    gene_ids, transcript_ids = {None: -1}, {None: -1}
+    attributes, attribute_lengths = [], []
+
+    for line in infile:
+        if line[0] == "#" or line.startswith("track") or not line.strip():
+            continue
+        data = line.rstrip("\r\n").split("\t", 8)
+        if len(data) < 9:
+            raise ParsingError("parsing error in line `%s`" % line)
+
+        contig_codes.append(contigs.setdefault(data[0], len(contigs)))
+        source_codes.append(sources.setdefault(data[1], len(sources)))
+        feature_codes.append(features.setdefault(data[2], len(features)))
+        starts.append(data[3])
+        ends.append(data[4])
+        score_codes.append(scores.setdefault(data[5], len(scores)))
+        strand_codes.append(strands.setdefault(data[6], len(strands)))
+        frame_codes.append(frames.setdefault(data[7], len(frames)))
+
+        field = data[8]
+        # fast path for the common layout starting with
+        # 'gene_id "x"; transcript_id "y";'
+        if field.startswith('gene_id "'):
+            end = field.find('"', 9)
+            gene_id = field[9:end]
+            if field.startswith('; transcript_id "', end + 1):
+                start = end + 18
+                transcript_id = field[start:field.find('"', start)]
+            else:
+                gene_id, transcript_id = _extractIds(field)
+        else:
+            gene_id, transcript_id = _extractIds(field)
+
+        gene_codes.append(
+            gene_ids.setdefault(gene_id, len(gene_ids) - 1))
+        transcript_codes.append(
+            transcript_ids.setdefault(transcript_id,
+                                      len(transcript_ids) - 1))
+
+        attributes.append(field)
+        attribute_lengths.append(len(field))
+
+    del gene_ids[None]
+    del transcript_ids[None]
+    gtf.contigs = _asValues(contigs)
+    gtf.sources = _asValues(sources)
+    gtf.features = _asValues(features)
+    gtf.scores = _asValues(scores)
+    gtf.strands = _asValues(strands)
+    gtf.frames = _asValues(frames)
+    gtf.gene_ids = _asValues(gene_ids)
+    gtf.transcript_ids = _asValues(transcript_ids)
+
+    for column, values in zip(gtf.columns, columns):
+        if column in ("starts", "ends"):
+            # convert coordinates from text in a single pass
+            values = numpy.array(values, dtype=numpy.str_).astype(
+                numpy.int64)
+        else:
+            values = numpy.array(values, dtype=numpy.int32)
+        setattr(gtf, column, values)
+    gtf.starts -= 1
+
+    gtf.attribute_data = "".join(attributes)
+    gtf.attribute_offsets = numpy.zeros(len(attributes) + 1,
+                                        dtype=numpy.int64)
+    numpy.cumsum(attribute_lengths, out=gtf.attribute_offsets[1:])
+
+    return gtf
@@ -3076,78 +3076,246 @@ def plotPCA(data, nPCs, point_labels, save_path,
     R('''dev.off()''')
 
 
+# genotype codes used for ped files parsed into numpy arrays
+GENO_MISSING = 0
+GENO_HOM_A1 = 1
+GENO_HET = 2
+GENO_HOM_A2 = 3
+
+# plink genotype strings corresponding to genotype codes
+GENO_STRINGS = np.array(["00", "11", "12", "22"])
+
+
+def encodeGenotypes(genos):
+    '''
+    Encode plink genotype strings of a single individual into
+    a numpy array of genotype codes.
+
+    Arguments
+    ---------
+    genos: list
+      genotypes in 1/2 allele coding, e.g. "11", "12", "1 2"
+      or "00" for missing genotypes.
+
+    Returns
+    -------
+    codes: np.ndarray
+      uint8 array with missing genotypes coded as 0, A1
+      homozygotes as 1, heterozygotes as 2 and A2
+      homozygotes as 3.
+    '''
+
+    alleles = "".join(genos).replace(" ", "")
+    if len(alleles) != 2 * len(genos):
+        raise ValueError("genotypes are not bi-allelic in 1/2 coding")
+
+    alleles = np.frombuffer(alleles.encode("ascii"),
+                            dtype=np.uint8).reshape(-1, 2) - ord("0")
+    if (alleles > 2).any():
+        raise ValueError("genotypes are not in 1/2 allele coding")
+
+    codes = alleles[:, 0] + alleles[:, 1] - 1
+    codes[(alleles[:, 0] == 0) | (alleles[:, 1] == 0)] = GENO_MISSING
+    return codes.astype(np.uint8)
+
+
+def iteratePedChunks(ped_file, delim="\t", chunk_size=1000):
+    '''
+    Iterate over a plink .ped file in chunks of individuals.
+
+    Arguments
+    ---------
+    ped_file: string
+      Path to a plink .ped file with genotypes in 1/2 allele
+      coding
+
+    delim: string
+      delimiter that separates columns in ped_file
+
+    chunk_size: int
+      number of individuals per chunk
+
+    Returns
+    -------
+    chunks: iterator
+      tuples of a list of pedigree information (FID, IID,
+      SEX, PHEN) and a uint8 genotype matrix of individuals x
+      variants, see :func:`encodeGenotypes` for the coding.
+    '''
+
+    samples, genos = [], []
+    with IOTools.openFile(ped_file, "r") as pfile:
+        for indiv in pfile:
+            indiv_split = indiv.strip("\n").split(delim)
+            samples.append((indiv_split[0], indiv_split[1],
+                            int(indiv_split[4]), int(indiv_split[5])))
+            genos.append(encodeGenotypes(indiv_split[6:]))
+            if len(genos) == chunk_size:
+                yield samples, np.vstack(genos)
+                samples, genos = [], []
+
+    if genos:
+        yield samples, np.vstack(genos)
+
+
+def countGenotypes(ped_file, delim="\t", samples=None, chunk_size=1000):
+    '''
+    Count genotypes per variant in a plink .ped file.
+
+    The file is parsed in chunks so that memory usage is
+    independent of the number of individuals.
+
+    Arguments
+    ---------
+    ped_file: string
+      Path to a plink .ped file
+
+    delim: string
+      delimiter that separates columns in ped_file
+
+    samples: set
+      if given, only count genotypes of individuals
+      with an IID in `samples`
+
+    chunk_size: int
+      number of individuals to parse at a time
+
+    Returns
+    -------
+    counts: np.ndarray
+      array of 4 x variants with the number of missing,
+      A1 homozygous, heterozygous and A2 homozygous
+      genotypes per variant
+
+    nsamples: int
+      number of individuals counted
+    '''
+
+    counts = None
+    nsamples = 0
+    for info, genos in iteratePedChunks(ped_file, delim=delim,
+                                        chunk_size=chunk_size):
+        if samples is not None:
+            genos = genos[[x[1] in samples for x in info]]
+
+        if counts is None:
+            counts = np.zeros((4, genos.shape[1]), dtype=np.int64)
+
+        for code in (GENO_HOM_A1, GENO_HET, GENO_HOM_A2):
+            counts[code] += (genos == code).sum(axis=0)
+        nsamples += genos.shape[0]
+
+    if counts is None:
+        counts = np.zeros((4, 0), dtype=np.int64)
+    else:
+        counts[GENO_MISSING] = nsamples - counts[1:].sum(axis=0)
+
+    return counts, nsamples
+
+
+def readMapVariants(map_file):
+    '''
+    Return variant ids in a plink .map file in file order.
+    '''
+    variant_ids = []
+    with open(map_file, "r") as mfile:
+        for snp in mfile:
+            variant_ids.append(snp.split("\t")[1])
+    return variant_ids
+
+
 def countByVariantAllele(ped_file, map_file):
     '''
     Count the number of individuals carrying the variant allele
     for each SNP.
-    Count the number of occurences of each allele with the variant
-    allele of each other SNP.
 
     Requires ped file genotyping to be in format A1(minor)=1, A2=2
     '''
 
-    # parse the ped file - get the variant column headers from
-    # the map file - no headers with these files
-    # variant order in the map file matters, use an ordered dict
-    variants = collections.OrderedDict()
-    with open(map_file, "r") as mfile:
-        for snp in mfile.readlines():
-            attrs = snp.split("\t")
-            snpid = attrs[1]
-            variants[snpid] = {"chr": attrs[0],
-                               "pos": attrs[-1].strip("\n")}
-
-    variant_ids = variants.keys()
-    # store genotype matrix as an array
-    # rows and columns are variant IDs
-    homA1 = np.zeros((len(variant_ids), len(variant_ids)),
-                     dtype=np.int64)
+    # variant order in the map file matters
+    variant_ids = readMapVariants(map_file)
 
-    homA2 = np.zeros((len(variant_ids), len(variant_ids)),
-                     dtype=np.int64)
+    counts, tcount = countGenotypes(ped_file)
+    homA1 = counts[GENO_HOM_A1]
+    het = counts[GENO_HET]
+    homA2 = counts[GENO_HOM_A2]
 
-    het = np.zeros((len(variant_ids), len(variant_ids)),
-                   dtype=np.int64)
-
-    tcount = 0
-    with open(ped_file, "r") as pfile:
-        for indiv in pfile.readlines():
-            indiv = indiv.strip("\n")
-            indiv_split = indiv.split("\t")
-            fid = indiv_split[0]
-            iid = indiv_split[1]
-            mid = indiv_split[2]
-            pid = indiv_split[3]
-            gender = indiv_split[4]
-            phen = indiv_split[5]
-            genos = indiv_split[6:]
-            tcount += 1
-            # get genotype counts
-            for i in range(len(genos)):
-                # missing genotypes are coded '00' in plink format
-                if genos[i] == "00":
-                    pass
-                elif genos[i] == "11":
-                    homA1[i, i] += 1
-                elif genos[i] == "12":
-                    het[i, i] += 1
-                else:
-                    homA2[i, i] += 1
     allele_counts = ((2 * homA2) + het)/float(2 * tcount)
-    mafs = 1 - allele_counts.diagonal()
-    maf_df = pd.DataFrame(zip(variant_ids, mafs), columns=["SNP", "MAF"],
-                          index=[x for x, y in enumerate(variant_ids)])
-    maf_df["A2_HOMS"] = (2 * homA1).diagonal()
-    maf_df["A2_HETS"] = het.diagonal()
+    mafs = 1 - allele_counts
+    maf_df = pd.DataFrame(list(zip(variant_ids, mafs)),
+                          columns=["SNP", "MAF"])
+    maf_df["A2_HOMS"] = 2 * homA1
+    maf_df["A2_HETS"] = het
     maf_df.index = maf_df["SNP"]
     maf_df.drop(["SNP"], axis=1, inplace=True)
 
     E.info("allele frequencies calculated over %i SNPs and "
-           "%i individuals" % (len(genos), tcount))
+           "%i individuals" % (len(variant_ids), tcount))
 
     return maf_df
 
 
+def simulatePed(ped_file, nsamples, nvariants, seed=None,
+                missing_rate=0.01):
+    '''
+    Write a synthetic plink .ped file of random genotypes.
+
+    Allele frequencies are drawn uniformly per variant and
+    genotypes are sampled under Hardy-Weinberg equilibrium.
+    Used for benchmarking.
+    '''
+
+    rng = np.random.RandomState(seed)
+    freqs = rng.uniform(0.01, 0.5, nvariants)
+    with IOTools.openFile(ped_file, "w") as outf:
+        for x in range(nsamples):
+            codes = (rng.random_sample(nvariants) < freqs).astype(np.uint8) + \
+                (rng.random_sample(nvariants) < freqs).astype(np.uint8)
+            # code 2 minor alleles as A1 homozygote
+            codes = np.array([GENO_HOM_A2, GENO_HET, GENO_HOM_A1],
+                             dtype=np.uint8)[codes]
+            codes[rng.random_sample(nvariants) < missing_rate] = \
+                GENO_MISSING
+            outf.write("\t".join(
+                ["FAM%i" % x, "IND%i" % x, "0", "0",
+                 str(rng.randint(1, 3)), str(rng.randint(1, 3))] +
+                list(GENO_STRINGS[codes])) + "\n")
+
+
+def benchmarkCountGenotypes(ped_file=None, nsamples=10000,
+                            nvariants=100000, seed=1):
+    '''
+    Benchmark genotype counting on a synthetic .ped file.
+
+    If `ped_file` does not exist, a file with `nsamples`
+    individuals and `nvariants` variants is created.
+
+    Returns
+    -------
+    result: dict
+      run time in seconds and number of genotypes
+      processed per second
+    '''
+
+    import time
+
+    if ped_file is None:
+        ped_file = "benchmark_%ix%i.ped" % (nsamples, nvariants)
+
+    if not os.path.exists(ped_file):
+        E.info("creating synthetic ped file %s" % ped_file)
+        simulatePed(ped_file, nsamples, nvariants, seed=seed)
+
+    t0 = time.time()
+    counts, nsamples = countGenotypes(ped_file)
+    t1 = time.time()
+
+    ngenotypes = nsamples * counts.shape[1]
+    return {"seconds": t1 - t0,
+            "genotypes": ngenotypes,
+            "genotypes_per_second": ngenotypes / max(t1 - t0, 1e-9)}
+
+
 def calcMaxAlleleFreqDiff(ped_file, map_file, group_file,
                           test=None, ref=None):
     '''
@@ -3212,120 +3380,58 @@ def calcMaxAlleleFreqDiff(ped_file, map_file, group_file,
         E.info("Test label not provided, setting test "
                "label to %s." % test)
 
-    # parse the ped file - get the variant column headers from
-    # the map file - no headers with these files
-    # variant order in the map file matters, use an ordered dict
-    variants = collections.OrderedDict()
-    with open(map_file, "r") as mfile:
-        for snp in mfile.readlines():
-            attrs = snp.split("\t")
-            snpid = attrs[1]
-            variants[snpid] = {"chr": attrs[0],
-                               "pos": attrs[-1].strip("\n")}
-
-    variant_ids = variants.keys()
-    # store genotype matrix as an array
-    # rows and columns are variant IDs
-    ref_homA1 = np.zeros((len(variant_ids), len(variant_ids)),
-                         dtype=np.int64)
-
-    ref_homA2 = np.zeros((len(variant_ids), len(variant_ids)),
-                         dtype=np.int64)
-
-    ref_het = np.zeros((len(variant_ids), len(variant_ids)),
-                       dtype=np.int64)
-
-    test_homA1 = np.zeros((len(variant_ids), len(variant_ids)),
-                          dtype=np.int64)
+    # variant order in the map file matters
+    variant_ids = readMapVariants(map_file)
 
-    test_homA2 = np.zeros((len(variant_ids), len(variant_ids)),
-                          dtype=np.int64)
+    ref_ids = set(group_df["IID"][group_df["GROUP"] == ref].values)
+    test_ids = set(group_df["IID"][group_df["GROUP"] == test].values)
 
-    test_het = np.zeros((len(variant_ids), len(variant_ids)),
-                        dtype=np.int64)
+    # per-variant genotype counts for reference and test individuals,
+    # individuals in neither group are ignored
+    ref_counts = np.zeros((4, len(variant_ids)), dtype=np.int64)
+    test_counts = np.zeros((4, len(variant_ids)), dtype=np.int64)
     tcount = 0
     rcount = 0
     ncount = 0
-    ref_ids = group_df["IID"][group_df["GROUP"] == ref].values
-    test_ids = group_df["IID"][group_df["GROUP"] == test].values
-    total = len(group_df)
 
-    with open(ped_file, "r") as pfile:
-        for indiv in pfile.readlines():
-            indiv = indiv.strip("\n")
-            indiv_split = indiv.split("\t")
-            fid = indiv_split[0]
-            iid = indiv_split[1]
-            mid = indiv_split[2]
-            pid = indiv_split[3]
-            gender = indiv_split[4]
-            phen = indiv_split[5]
-            genos = indiv_split[6:]
-
-            # check for ref and test conditions
-            # ignore individuals in neither camp
-            if iid in test_ids:
-                tcount += 1
-                # get genotype counts
-                for i in range(len(genos)):
-                    # missing genotypes are coded '00' in plink format
-                    if genos[i] == "00":
-                        pass
-                    elif genos[i] == "11":
-                        test_homA1[i, i] += 1
-                    elif genos[i] == "12":
-                        test_het[i, i] += 1
-                    else:
-                        test_homA2[i, i] += 1
-
-            elif iid in ref_ids:
-                rcount += 1
-                # get genotype counts
-                for i in range(len(genos)):
-                    # missing genotypes are coded '00' in plink format
-                    if genos[i] == "00":
-                        pass
-                    elif genos[i] == "11":
-                        ref_homA1[i, i] += 1
-                    elif genos[i] == "12":
-                        ref_het[i, i] += 1
-                    else:
-                        ref_homA2[i, i] += 1
-            else:
-                ncount += 1
-                if round((tcount + rcount + ncount)/total, 2) == 0.25:
-                    E.info("%i samples counted."
-                           "Approximately 25% samples counted" % tcount + rcount + ncount)
-                elif round((tcount + rcount + ncount)/total, 2) == 0.50:
-                    E.info("%i samples counted."
-                           "Approximately 50% samples counted" % tcount + rcount + ncount)
-                elif round((tcount + rcount + ncount)/total, 2) == 0.75:
-                    E.info("%i samples counted."
-                           "Approximately 75% samples counted" % tcount + rcount + ncount)
+    for info, genos in iteratePedChunks(ped_file):
+        is_test = np.array([x[1] in test_ids for x in info], dtype=bool)
+        is_ref = np.array([x[1] in ref_ids for x in info], dtype=bool)
+        is_ref &= ~is_test
+        for counts, select in ((test_counts, is_test),
+                               (ref_counts, is_ref)):
+            selected = genos[select]
+            for code in (GENO_HOM_A1, GENO_HET, GENO_HOM_A2):
+                counts[code] += (selected == code).sum(axis=0)
+
+        tcount += is_test.sum()
+        rcount += is_ref.sum()
+        ncount += len(info) - is_test.sum() - is_ref.sum()
+        E.info("%i samples counted" % (tcount + rcount + ncount))
 
     E.info("Counted alleles for %i test cases, %i ref cases,"
            " %i neither reference nor test." % (tcount, rcount,
                                                 ncount))
 
-    ref_allele_counts = ((2 * ref_homA2) + ref_het)/float(2 * rcount)
-    test_allele_counts = ((2 * test_homA2) + test_het)/float(2 * tcount)
+    ref_allele_counts = ((2 * ref_counts[GENO_HOM_A2]) +
+                         ref_counts[GENO_HET])/float(2 * rcount)
+    test_allele_counts = ((2 * test_counts[GENO_HOM_A2]) +
+                          test_counts[GENO_HET])/float(2 * tcount)
 
-    ref_mafs = 1 - ref_allele_counts.diagonal()
-    test_mafs = 1 - ref_allele_counts.diagonal()
+    ref_mafs = 1 - ref_allele_counts
+    test_mafs = 1 - test_allele_counts
 
-    ref_maf_df = pd.DataFrame(zip(variant_ids, ref_mafs),
-                              columns=["SNP", "ref_MAF"],
-                              index=[x for x, y in enumerate(variant_ids)])
-    ref_maf_df["ref_A2_HOMS"] = (2 * ref_homA1).diagonal()
-    ref_maf_df["ref_A2_HETS"] = ref_het.diagonal()
+    ref_maf_df = pd.DataFrame(list(zip(variant_ids, ref_mafs)),
+                              columns=["SNP", "ref_MAF"])
+    ref_maf_df["ref_A2_HOMS"] = 2 * ref_counts[GENO_HOM_A1]
+    ref_maf_df["ref_A2_HETS"] = ref_counts[GENO_HET]
     ref_maf_df.index = ref_maf_df["SNP"]
     ref_maf_df.drop(["SNP"], axis=1, inplace=True)
 
-    test_maf_df = pd.DataFrame(zip(variant_ids, test_mafs),
-                               columns=["SNP", "test_MAF"],
-                               index=[x for x, y in enumerate(variant_ids)])
-    test_maf_df["test_A2_HOMS"] = (2 * test_homA1).diagonal()
-    test_maf_df["test_A2_HETS"] = test_het.diagonal()
+    test_maf_df = pd.DataFrame(list(zip(variant_ids, test_mafs)),
+                               columns=["SNP", "test_MAF"])
+    test_maf_df["test_A2_HOMS"] = 2 * test_counts[GENO_HOM_A1]
+    test_maf_df["test_A2_HETS"] = test_counts[GENO_HET]
     test_maf_df.index = test_maf_df["SNP"]
     test_maf_df.drop(["SNP"], axis=1, inplace=True)
 
@@ -3336,7 +3442,7 @@ def calcMaxAlleleFreqDiff(ped_file, map_file, group_file,
     freq_diffs["MAF_diff"] = freq_diffs["ref_MAF"] - freq_diffs["test_MAF"]
 
     E.info("allele frequencies calculated over %i SNPs and "
-           "%i individuals" % (len(genos), tcount + rcount))
+           "%i individuals" % (len(variant_ids), tcount + rcount))
 
     return freq_diffs
 
@@ -5491,30 +5597,59 @@ def parsePed(ped_file, delim="\t", compound_geno="False"):
     ped_frame: pd.Core.DataFrame
       pandas dataframe representation of
       the ped_file.  Genotypes are presented
-      as a numpy array.
+      as a numpy array. Genotypes in 1/2 allele
+      coding are normalised to "00", "11", "12"
+      and "22", other genotypes, for example
+      nucleotides, are kept as they are.
 
     '''
 
     samples = []
+    genos = []
 
-    # parse the ped file, return a dataframe
-    with open(ped_file, "r") as pfile:
-        for indiv in pfile.readlines():
-            ped_dict = {}
-            indiv = indiv.strip("\n")
-            indiv_split = indiv.split(delim)
-            ped_dict["FID"] = indiv_split[0]
-            ped_dict["IID"] = indiv_split[1]
-            ped_dict["SEX"] = int(indiv_split[4])
-            ped_dict["PHEN"] = int(indiv_split[5])
-            ped_dict["GENOS"] = np.array(["".join(x.split(" ")) for x in indiv_split[6:]])
-            samples.append(ped_dict)
-
-    ped_frame = pd.DataFrame(samples)
+    # parse the ped file in chunks of genotype arrays,
+    # return a dataframe
+    try:
+        for info, chunk in iteratePedChunks(ped_file, delim=delim):
+            samples.extend(info)
+            genos.append(GENO_STRINGS[chunk])
+    except ValueError:
+        # not in 1/2 allele coding, keep genotype strings
+        return parsePedStrings(ped_file, delim=delim)
+
+    ped_frame = pd.DataFrame(samples,
+                             columns=["FID", "IID", "SEX", "PHEN"])
+    if genos:
+        ped_frame["GENOS"] = list(np.vstack(genos))
+    else:
+        ped_frame["GENOS"] = []
 
     return ped_frame
 
 
+def parsePedStrings(ped_file, delim="\t"):
+    '''
+    Parse a plink .ped file into a dataframe, keeping
+    genotypes as strings in any allele coding.
+
+    See :func:`parsePed`.
+    '''
+
+    samples = []
+
+    with IOTools.openFile(ped_file, "r") as pfile:
+        for indiv in pfile:
+            indiv_split = indiv.strip("\n").split(delim)
+            samples.append(
+                (indiv_split[0], indiv_split[1],
+                 int(indiv_split[4]), int(indiv_split[5]),
+                 np.array(["".join(x.split(" "))
+                           for x in indiv_split[6:]])))
+
+    return pd.DataFrame(samples,
+                        columns=["FID", "IID", "SEX", "PHEN", "GENOS"])
+
+
 def countRiskAlleles(ped_frame, snp_index, report, flag):
     '''
     Count the number of risk alleles per individual
@@ -5552,25 +5687,22 @@ def countRiskAlleles(ped_frame, snp_index, report, flag):
     cntrl_freq = np.zeros(shape=(len(snp_index)*2) + 1,
                           dtype=np.float64)
 
+    nbins = len(case_freq)
+
     # group by phenotype column
     phen_groups = ped_frame.groupby(by="PHEN")
     for name, group in phen_groups:
-        genos = group.loc[:, snp_index]
-
-        # convert to 0,1,2 coding for ease of counting
-        # treat 00 as missing/NA
-        genos.replace({"22": 0,
-                       "12": 1,
-                       "11": 2,
-                       "00": np.nan},
-                      inplace=True)
-        risk_sums = np.nansum(genos, axis=1)
-
-        for val in risk_sums:
-            if name == 1:
-                cntrl_freq[val] += 1
-            elif name == 2:
-                case_freq[val] += 1
+        genos = group.loc[:, snp_index].values.astype(str)
+
+        # count risk alleles with 0,1,2 coding, treat 00 as missing
+        risk_sums = (2 * (genos == "11") +
+                     (genos == "12") +
+                     (genos == "21")).sum(axis=1)
+
+        if name == 1:
+            cntrl_freq += np.bincount(risk_sums, minlength=nbins)
+        elif name == 2:
+            case_freq += np.bincount(risk_sums, minlength=nbins)
 
     if flag:
         explained = pd.DataFrame(risk_sums)
@@ -13,6 +13,9 @@ These include methods for
 * manipulating file, such as :func:`openFile`, :func:`zapFile`,
   :func:`cloneFile`, :func:`touchFile`, :func:`shadowFile`.
 
+* multi-threaded compression, see :func:`setCompressionThreads`,
+  :class:`BGZFWriter` and :class:`ReadAheadReader`.
+
 * converting values for input/output, such as :func:`val2str`,
   :func:`str2val`, :func:`prettyPercent`, :func:`human2bytes`,
   :func:`convertDictionary`.
@@ -30,9 +33,12 @@ Reference
 
 '''
 
+import atexit
 import collections
 import glob
 import gzip
+import hashlib
+import io
 import itertools
 import numpy
 import numpy.ma
@@ -41,9 +47,32 @@ import re
 import shutil
 import stat
 import string
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import zlib
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+from six.moves import cPickle
+
+# number of threads used for compressing and decompressing files
+# in openFile, see setCompressionThreads()
+COMPRESSION_THREADS = 1
+
+# uncompressed size of a BGZF block, the same as used by htslib
+BGZF_BLOCK_SIZE = 0xff00
+
+# empty BGZF block marking the end of a file
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00"
+            b"\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00"
+            b"\x00\x00\x00\x00")
+
+# thread pools shared by all BGZFWriter objects, keyed by the
+# number of threads
+_compression_pools = {}
 
 
 def getFirstLine(filename, nlines=1):
@@ -201,12 +230,231 @@ def touchFile(filename, times=None):
         fhandle.close()
 
 
-def openFile(filename, mode="r", create_dir=False, encoding="utf-8"):
+def setCompressionThreads(threads):
+    '''set the number of threads used by :func:`openFile` for
+    compressed files.
+
+    If *threads* is larger than 1, compressed files are written with
+    :class:`BGZFWriter` and read with :class:`ReadAheadReader`.
+    This is the default for calls to :func:`openFile` that do not
+    set the number of threads.
+    '''
+    global COMPRESSION_THREADS
+    if threads < 1:
+        raise ValueError("number of threads must be positive, got %i" %
+                         threads)
+    COMPRESSION_THREADS = threads
+
+
+def getCompressionPool(threads):
+    '''return thread pool with *threads* threads for compression,
+    creating it if necessary.
+
+    Pools are shared by all :class:`BGZFWriter` objects with the
+    same number of threads.
+    '''
+    if threads not in _compression_pools:
+        _compression_pools[threads] = ThreadPool(threads)
+    return _compression_pools[threads]
+
+
+def closeCompressionPools():
+    '''close all thread pools created by :func:`getCompressionPool`.
+
+    This is called at exit. Files that are still being written with
+    :class:`BGZFWriter` must be closed before.
+    '''
+    for pool in _compression_pools.values():
+        pool.close()
+        pool.join()
+    _compression_pools.clear()
+
+
+atexit.register(closeCompressionPools)
+
+
+def compressBGZFBlock(data, compresslevel=6):
+    '''return *data* compressed as a single BGZF block.
+
+    *data* must not be longer than :data:`BGZF_BLOCK_SIZE`.
+    '''
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    # header (18 bytes) and footer (8 bytes) around the deflated data
+    block_size = len(compressed) + 26
+    return b"".join((
+        struct.pack("<4BI2BH2BHH",
+                    31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1),
+        compressed,
+        struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                    len(data) & 0xffffffff)))
+
+
+class BGZFWriter(io.RawIOBase):
+    '''write a :term:`BGZF` compressed file using multiple threads.
+
+    Data is split into blocks of :data:`BGZF_BLOCK_SIZE` bytes that
+    are compressed in parallel by a thread pool and written in order.
+    Writers using the same number of threads share a thread pool.
+    The output is a valid gzip file that can be indexed with tabix.
+
+    This is a binary stream, see :func:`openFile` for text access.
+
+    Arguments
+    ---------
+    filename : string
+       Filename to write to.
+    mode : string
+       ``w`` to create a new file or ``a`` to append.
+    compresslevel : int
+       zlib compression level.
+    threads : int
+       Number of compression threads. The default is set by
+       :func:`setCompressionThreads`.
+    max_pending : int
+       Maximum number of blocks compressed at the same time. Defaults
+       to four blocks per thread.
+    '''
+
+    def __init__(self, filename, mode="w", compresslevel=6,
+                 threads=None, max_pending=None):
+        io.RawIOBase.__init__(self)
+        self.name = filename
+        self.outfile = open(filename, mode.replace("b", "") + "b")
+        self.compresslevel = compresslevel
+        if threads is None:
+            threads = COMPRESSION_THREADS
+        self.pool = getCompressionPool(threads)
+        if max_pending is None:
+            max_pending = 4 * threads
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self.buffer.extend(data)
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.pool.apply_async(
+            compressBGZFBlock, (block, self.compresslevel)))
+        while len(self.pending) > self.max_pending:
+            self.outfile.write(self.pending.popleft().get())
+
+    def flush(self):
+        '''compress all buffered data and write it to disk.'''
+        if self.closed or self.outfile.closed:
+            return
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.outfile.write(self.pending.popleft().get())
+        self.outfile.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            self.outfile.write(BGZF_EOF)
+        finally:
+            self.outfile.close()
+            io.RawIOBase.close(self)
+
+
+class ReadAheadReader(io.RawIOBase):
+    '''read a gzip compressed file, decompressing in a separate
+    thread.
+
+    The decompression thread reads ahead up to *max_chunks* chunks of
+    *chunk_size* bytes, so decompression runs while the caller is
+    processing data. This works with any gzip file, not only
+    :term:`BGZF`.
+
+    This is a binary stream, see :func:`openFile` for text access.
+    '''
+
+    def __init__(self, filename, chunk_size=4 * 1024 * 1024, max_chunks=4):
+        io.RawIOBase.__init__(self)
+        self.name = filename
+        self.queue = queue.Queue(max_chunks)
+        self.stop = threading.Event()
+        self.chunk = b""
+        self.offset = 0
+        self.eof = False
+        self.thread = threading.Thread(
+            target=self._decompress, args=(filename, chunk_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress(self, filename, chunk_size):
+        try:
+            with gzip.open(filename, "rb") as inf:
+                while True:
+                    data = inf.read(chunk_size)
+                    if not self._put(data) or not data:
+                        break
+        except Exception as ex:
+            self._put(ex)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.eof:
+            return 0
+        if self.offset >= len(self.chunk):
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self.eof = True
+                return 0
+            self.chunk, self.offset = chunk, 0
+        n = min(len(b), len(self.chunk) - self.offset)
+        b[:n] = self.chunk[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self.stop.set()
+        self.thread.join()
+        io.RawIOBase.close(self)
+
+
+def openFile(filename, mode="r", create_dir=False, encoding="utf-8",
+             threads=None):
     '''open file called *filename* with mode *mode*.
 
     gzip - compressed files are recognized by the
     suffix ``.gz`` and opened transparently.
 
+    If more than one thread is used, compressed files are written in
+    :term:`BGZF` format by :class:`BGZFWriter` with *threads*
+    compression threads. Compressed files are read with a single
+    separate decompression thread by :class:`ReadAheadReader`, as
+    a gzip stream can not be decompressed in parallel.
+
     Note that there are differences in the file
     like objects returned, for example in the
     ability to seek.
@@ -219,6 +467,12 @@ def openFile(filename, mode="r", create_dir=False, encoding="utf-8"):
     create_dir : bool
        If True, the directory containing filename
        will be created if it does not exist.
+    encoding : string
+       Encoding of text files.
+    threads : int
+       Number of threads for compressed files. The default is set by
+       :func:`setCompressionThreads`. When reading, any number
+       larger than 1 enables the decompression thread.
 
     Returns
     -------
@@ -232,8 +486,21 @@ def openFile(filename, mode="r", create_dir=False, encoding="utf-8"):
         if dirname and not os.path.exists(dirname):
             os.makedirs(dirname)
 
+    if threads is None:
+        threads = COMPRESSION_THREADS
+
     if ext.lower() in (".gz", ".z"):
         if sys.version_info.major >= 3:
+            if threads > 1:
+                if mode.startswith("r"):
+                    stream = io.BufferedReader(ReadAheadReader(filename))
+                else:
+                    stream = io.BufferedWriter(
+                        BGZFWriter(filename, mode, threads=threads))
+                if "b" in mode:
+                    return stream
+                return io.TextIOWrapper(stream, encoding=encoding)
+
             if mode == "r":
                 return gzip.open(filename, 'rt', encoding=encoding)
             elif mode == "w":
@@ -1396,3 +1663,77 @@ def unpickle(file_name):
     with open(file_name, "r") as pkl_file:
         data = pickle.load(pkl_file)
     return data
+
+
+def cached(filenames, build, cache_dir, cache_name,
+           load=None, save=None, **kwargs):
+    '''return the result of calling *build*, using a cache in *cache_dir*.
+
+    The cache is keyed on the absolute path, modification time and
+    size of each file in *filenames* and on the keyword arguments in
+    *kwargs*. If no up-to-date cached result exists, *build* is called
+    with *kwargs* and the result is saved to the cache.
+
+    Arguments
+    ---------
+    filenames : list
+       Files the result is built from. Entries that are None are
+       ignored.
+    build : function
+       Function building the result.
+    cache_dir : string
+       Directory with cached results. Created if it does not exist.
+    cache_name : string
+       Name of the cache file in *cache_dir*. ``%s`` is substituted
+       with the cache key.
+    load : function
+       Function loading a result from a filename. The default is
+       to unpickle the file.
+    save : function
+       Function called with a result and a filename to save the
+       result. The default is to pickle the result.
+
+    Returns
+    -------
+    result
+       The result of calling *build*.
+    '''
+    stats = []
+    for filename in filenames:
+        if filename is None:
+            continue
+        filename = os.path.abspath(filename)
+        s = os.stat(filename)
+        stats.append((filename, s.st_mtime, s.st_size))
+
+    key = hashlib.md5(repr(
+        (stats, sorted(kwargs.items()))).encode("utf-8")).hexdigest()
+    cache_filename = os.path.join(cache_dir, cache_name % key)
+
+    if os.path.exists(cache_filename):
+        if load is not None:
+            return load(cache_filename)
+        with open(cache_filename, "rb") as inf:
+            return cPickle.load(inf)
+
+    result = build(**kwargs)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # write to a temporary file first so that concurrent processes
+    # never see a partially written cache file
+    handle, tmpfile = tempfile.mkstemp(dir=cache_dir)
+    os.close(handle)
+    try:
+        if save is not None:
+            save(result, tmpfile)
+        else:
+            with open(tmpfile, "wb") as outf:
+                cPickle.dump(result, outf, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, cache_filename)
+    finally:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+    return result
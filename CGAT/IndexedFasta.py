@@ -48,6 +48,7 @@ import zlib
 import gzip
 import tempfile
 import io
+import mmap
 from CGAT import Experiment as E
 import CGAT.IOTools as IOTools
 import CGAT.Genomics as Genomics
@@ -357,8 +358,6 @@ class MultipleFastaIterator:
             if filename != "-":
                 infile.close()
 
-        raise StopIteration
-
 
 def createDatabase(db, iterator,
                    force=False,
@@ -388,6 +387,15 @@ def createDatabase(db, iterator,
     if db.endswith(".fasta"):
         db = db[:-len(".fasta")]
 
+    if compression == "mmap":
+        return createMemoryMapDatabase(
+            db, iterator,
+            force=force,
+            synonyms=synonyms,
+            clean_sequence=clean_sequence,
+            allow_duplicates=allow_duplicates,
+            translator=translator)
+
     if compression:
         if compression == "lzo":
             import lzo
@@ -582,7 +590,156 @@ def createDatabase(db, iterator,
             for val in vals:
                 outfile_index.write("%s\t%s\n" % (key, val))
 
+
+# header of the binary index of memory mapped databases
+MMAP_MAGIC = b"CGATMDX1"
+
+
+def createMemoryMapDatabase(db, iterator,
+                            force=False,
+                            synonyms=None,
+                            clean_sequence=False,
+                            allow_duplicates=False,
+                            translator=None):
+    """create a database for memory mapped access.
+
+    Two files are created - db.mmap and db.mdx. The sequence file
+    contains the concatenated sequences with one byte per residue and
+    without headers or line breaks, so that fragments can be sliced
+    directly from a memory map. Case and ambiguity codes are
+    preserved.
+
+    The index is a binary table with the offset and length of each
+    sequence followed by synonyms. See :func:`createDatabase` for
+    the other arguments.
+    """
+
+    db_name = db + ".mmap"
+    index_name = db + ".mdx"
+
+    if os.path.exists(db_name) and not force:
+        raise ValueError("database %s already exists." % db_name)
+
+    if os.path.exists(index_name) and not force:
+        raise ValueError("database index %s already exists." % index_name)
+
+    if sys.version_info.major >= 3:
+        translation = str.maketrans("xX", "nN")
+    else:
+        translation = string.maketrans("xX", "nN")
+
+    identifiers = {}
+    contigs = []
+    offset, lsequence = 0, 0
+
+    with open(db_name, "wb") as outfile_fasta:
+        while 1:
+
+            try:
+                result = next(iterator)
+            except StopIteration:
+                break
+
+            if not result:
+                break
+
+            is_new, identifier, fragment = result
+
+            if is_new:
+                if identifier in identifiers:
+                    if allow_duplicates:
+                        out_identifier = identifier + \
+                            "_%i" % (identifiers[identifier])
+                        identifiers[identifier] += 1
+                        identifiers[out_identifier] = 1
+                    else:
+                        raise ValueError("%s occurs more than once" %
+                                         (identifier,))
+                else:
+                    identifiers[identifier] = 1
+                    out_identifier = identifier
+
+                if contigs:
+                    contigs[-1][2] = lsequence
+
+                offset += lsequence
+                lsequence = 0
+                contigs.append([out_identifier, offset, 0])
+
+            if translator:
+                s = translator(fragment)
+            else:
+                s = re.sub(r"\s", "", fragment.strip())
+                if clean_sequence:
+                    s = s.translate(translation)
+
+            lsequence += len(s)
+            outfile_fasta.write(s.encode("ascii"))
+
+    if contigs:
+        contigs[-1][2] = lsequence
+
+    synonym_pairs = []
+    if synonyms:
+        for key, vals in list(synonyms.items()):
+            for val in vals:
+                synonym_pairs.append((key, val))
+
+    with open(index_name, "wb") as outfile_index:
+        outfile_index.write(MMAP_MAGIC)
+        outfile_index.write(struct.pack("<QQ", len(contigs),
+                                        len(synonym_pairs)))
+        for identifier, offset, lsequence in contigs:
+            name = identifier.encode("ascii")
+            outfile_index.write(struct.pack("<QQH", offset, lsequence,
+                                            len(name)))
+            outfile_index.write(name)
+        for key, val in synonym_pairs:
+            key, val = key.encode("ascii"), val.encode("ascii")
+            outfile_index.write(struct.pack("<HH", len(key), len(val)))
+            outfile_index.write(key + val)
+
+
+def readMemoryMapIndex(filename):
+    """read binary index of a memory mapped database.
+
+    Returns a list of tuples (identifier, offset, length) and
+    a list of synonyms as tuples (contig, synonym).
+    """
+
+    with open(filename, "rb") as inf:
+        data = inf.read()
+
+    if data[:len(MMAP_MAGIC)] != MMAP_MAGIC:
+        raise ValueError("%s is not a memory map index" % filename)
+
+    pos = len(MMAP_MAGIC)
+    ncontigs, nsynonyms = struct.unpack_from("<QQ", data, pos)
+    pos += struct.calcsize("<QQ")
+
+    contigs = []
+    entry_size = struct.calcsize("<QQH")
+    for x in range(ncontigs):
+        offset, lsequence, lname = struct.unpack_from("<QQH", data, pos)
+        pos += entry_size
+        contigs.append((data[pos:pos + lname].decode("ascii"),
+                        offset, lsequence))
+        pos += lname
+
+    synonyms = []
+    entry_size = struct.calcsize("<HH")
+    for x in range(nsynonyms):
+        lkey, lval = struct.unpack_from("<HH", data, pos)
+        pos += entry_size
+        synonyms.append((data[pos:pos + lkey].decode("ascii"),
+                         data[pos + lkey:pos + lkey + lval].decode("ascii")))
+        pos += lkey + lval
+
+    return contigs, synonyms
+
+
 NAME_MAP = {
+    'mmap': ('mmap', 'mdx', False),
     'uncompressed': ('fasta', 'idx', False),
     'lzo': ('lzo',   'cdx', True),
     'dictzip': ('dz',    'idx', False),
@@ -593,7 +750,8 @@ NAME_MAP = {
 }
 
 PREFERENCES = (
-    'uncompressed', 'lzo', 'dictzip', 'zlib', 'gzip', 'bzip2', 'debug')
+    'mmap', 'uncompressed', 'lzo', 'dictzip', 'zlib', 'gzip', 'bzip2',
+    'debug')
 
 
 class CGATIndexedFasta:
@@ -644,7 +802,10 @@ class CGATIndexedFasta:
         if compress is set to true, the index will not be loaded,
         but a compressed index will be created instead.
         """
-        if self.mMethod == "uncompressed":
+        if self.mMethod == "mmap":
+            self._loadMemoryMap()
+            return
+        elif self.mMethod == "uncompressed":
             self.mDatabaseFile = open(self.mDbname, "r")
         elif self.mMethod == "dictzip":
             from . import dictzip
@@ -706,6 +867,32 @@ class CGATIndexedFasta:
         self._addSynonyms()
         self.mIsLoaded = True
 
+    def _loadMemoryMap(self):
+        """map sequence file into memory and read binary index."""
+
+        self.mDatabaseFile = open(self.mDbname, "rb")
+        if os.path.getsize(self.mDbname) > 0:
+            self.mMemoryMap = mmap.mmap(self.mDatabaseFile.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+            self.mView = memoryview(self.mMemoryMap)
+        else:
+            self.mMemoryMap = None
+            self.mView = memoryview(b"")
+
+        contigs, synonyms = readMemoryMapIndex(self.mNameIndex)
+        self.mIndex = {}
+        for identifier, offset, lsequence in contigs:
+            self.mIndex[identifier] = struct.pack(
+                "QQi", offset, offset, lsequence)
+
+        for contig, synonym in synonyms:
+            # ignore synonyms of non-existent contigs
+            if contig in self.mIndex:
+                self.mSynonyms[synonym] = contig
+
+        self._addSynonyms()
+        self.mIsLoaded = True
+
     def _addSynonyms(self):
         '''add synonyms to indices.
         '''
@@ -903,6 +1090,24 @@ class CGATIndexedFasta:
             "first position %i is larger than last position %i " % \
             (first_pos, last_pos)
 
+        if self.mMethod == "mmap":
+            # slice directly from the memory map
+            view = self.mView[pos_seq + first_pos:pos_seq + last_pos]
+            if IS_PY3:
+                sequence = view.tobytes().decode("ascii")
+            else:
+                sequence = view.tobytes()
+
+            if str(strand) in ("-", "0", "-1"):
+                sequence = Genomics.complement(sequence)
+
+            if self.mTranslator:
+                return self.mTranslator.translate(AString(sequence))
+            elif as_array:
+                return AString(sequence)
+            else:
+                return sequence
+
         p = AString()
 
         if self.mNoSeek:
@@ -1204,6 +1409,31 @@ def benchmarkRandomFragment(fasta, size):
     return s
 
 
+def benchmarkDatabases(dbnames, num_iterations, fragment_size):
+    """benchmark random fragment access across several databases.
+
+    The databases can use different storage methods, for example
+    the same genome indexed uncompressed, compressed and memory
+    mapped.
+
+    Returns a list of tuples (database, method, time) with the time in
+    seconds for *num_iterations* calls to
+    :func:`benchmarkRandomFragment`.
+    """
+    import timeit
+
+    results = []
+    for dbname in dbnames:
+        fasta = IndexedFasta(dbname)
+        # load index outside of timing
+        fasta.getContigs()
+        timer = timeit.Timer(
+            lambda: benchmarkRandomFragment(fasta=fasta, size=fragment_size))
+        t = timer.timeit(number=num_iterations)
+        results.append((dbname, fasta.mMethod, t))
+    return results
+
+
 def verify(fasta1, fasta2, num_iterations, fragment_size,
            stdout=sys.stdout, quiet=False):
     """verify two databases.
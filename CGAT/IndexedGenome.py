@@ -33,15 +33,62 @@ The basic usage is::
    print index.contains("chr1", 1000, 2000)
    print index.get("chr1", 10000, 20000)
 
-The index is built in memory.
+Many queries on the same contig can be answered in a single call
+with :meth:`IndexedGenome.get_many` and
+:meth:`IndexedGenome.count_overlaps`, which take arrays of start and
+end coordinates::
+
+   offsets, indices = index.get_many("chr1", starts, ends)
+   counts = index.count_overlaps("chr1", starts, ends)
+
+The index is built in memory. Building large indices is slow, so
+indices can be saved to a single binary file with
+:meth:`IndexedGenome.save` and restored with
+:meth:`IndexedGenome.load`::
+
+   index.save("genes.ncl")
+   index = IndexedGenome.load("genes.ncl")
+
+When loading, the file is memory mapped. Values associated with
+intervals are only unpickled once a contig is first queried.
+:class:`Quicksect` indices save their intervals and values, and the
+trees are rebuilt when loading.
+
+:func:`cached` builds an index from a file or restores it from a
+cache directory if the file has not changed since it was indexed.
 
 Reference
 ---------
 
 '''
+import os
+import struct
+import numpy
+from mmap import mmap as MemoryMap, ACCESS_READ
+from six.moves import cPickle as pickle
 from CGAT import NCL as ncl
+from CGAT import IOTools as IOTools
 from bx.intervals.intersection import Intersecter, Interval
 
+# file identifiers of saved indices
+MAGIC = b"CGATNCL1"
+MAGIC_QUICKSECT = b"CGATQSI1"
+
+
+class PickledValues(object):
+
+    '''values of a saved index that are unpickled on first access.'''
+
+    def __init__(self, buffer):
+        self.mBuffer = buffer
+        self.mValues = None
+
+    def __getitem__(self, key):
+        if self.mValues is None:
+            self.mValues = pickle.loads(bytes(self.mBuffer))
+            self.mBuffer = None
+        return self.mValues[key]
+
 
 class IndexedGenome:
 
@@ -50,8 +97,11 @@ class IndexedGenome:
 
     index_factory = ncl.NCL
 
+    with_values = True
+
     def __init__(self):
         self.mIndex = {}
+        self.mMap = None
 
     def add(self, contig, start, end, value):
 
@@ -78,16 +128,122 @@ class IndexedGenome:
 
         return self.mIndex[contig].find(start, end)
 
+    def get_many(self, contig, starts, ends):
+        '''return intervals overlapping each of the queries in the
+        arrays *starts* and *ends*.
+
+        The result is a tuple of numpy arrays ``(offsets, indices)``.
+        The intervals overlapping query ``i`` are
+        ``indices[offsets[i]:offsets[i+1]]``, where an index is the
+        position of the interval in the order in which intervals were
+        added to *contig*. Use :meth:`getValues` to obtain the values.
+        '''
+        if contig not in self.mIndex:
+            raise KeyError("contig %s not in index" % contig)
+
+        return self.mIndex[contig].findMany(starts, ends)
+
+    def count_overlaps(self, contig, starts, ends):
+        '''return array with the number of intervals overlapping each
+        of the queries in the arrays *starts* and *ends*.'''
+        if contig not in self.mIndex:
+            raise KeyError("contig %s not in index" % contig)
+
+        return self.mIndex[contig].countMany(starts, ends)
+
+    def getValues(self, contig, indices):
+        '''return values of intervals with *indices* on *contig*.'''
+        values = self.mIndex[contig].mValues
+        return [values[x] for x in indices]
+
     def __len__(self):
         '''return number of contigs.'''
         return len(self.mIndex)
 
+    def save(self, filename):
+        '''save index to *filename*.
+
+        The nested containment lists are written in their binary
+        in-memory layout, values are pickled per contig.
+        '''
+        contigs = []
+        with open(filename, "wb") as outf:
+            # header: identifier and offset of table of contents
+            outf.write(MAGIC)
+            outf.write(struct.pack("<Q", 0))
+            for contig, index in sorted(self.mIndex.items()):
+                n, ntop, nlists, intervals, sublists = index.toBuffers()
+                if self.with_values:
+                    values = pickle.dumps(index.mValues[:],
+                                          pickle.HIGHEST_PROTOCOL)
+                else:
+                    values = b""
+                contigs.append((contig, n, ntop, nlists, outf.tell(),
+                                len(intervals), len(sublists), len(values)))
+                outf.write(intervals)
+                outf.write(sublists)
+                outf.write(values)
+
+            toc_offset = outf.tell()
+            pickle.dump((self.with_values, contigs), outf,
+                        pickle.HIGHEST_PROTOCOL)
+            outf.seek(len(MAGIC))
+            outf.write(struct.pack("<Q", toc_offset))
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        '''load an index saved with :meth:`save` from *filename*.
+
+        If *mmap* is True, the file is memory mapped and values
+        are read from disk when a contig is first queried. Otherwise
+        the file is read into memory.
+
+        Raises ValueError if the file is not an index or has been
+        saved from an index of a different type.
+        '''
+        with open(filename, "rb") as inf:
+            if inf.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a saved index" % filename)
+            if mmap:
+                data = MemoryMap(inf.fileno(), 0, access=ACCESS_READ)
+            else:
+                inf.seek(0)
+                data = inf.read()
+
+        buf = memoryview(data)
+        toc_offset = struct.unpack(
+            "<Q", buf[len(MAGIC):len(MAGIC) + 8].tobytes())[0]
+        with_values, contigs = pickle.loads(buf[toc_offset:].tobytes())
+        if with_values != cls.with_values:
+            raise ValueError(
+                "%s has been saved from an index %s values" %
+                (filename, "with" if with_values else "without"))
+
+        result = cls()
+        for (contig, n, ntop, nlists, offset,
+             nintervals, nsublists, nvalues) in contigs:
+            index = cls.index_factory()
+            index.fromBuffers(
+                n, ntop, nlists,
+                buf[offset:offset + nintervals],
+                buf[offset + nintervals:offset + nintervals + nsublists])
+            if with_values:
+                offset += nintervals + nsublists
+                index.mValues = PickledValues(buf[offset:offset + nvalues])
+            result.mIndex[contig] = index
+
+        # keep file mapped while values are still to be read
+        result.mMap = data
+        return result
+
 
 class Simple(IndexedGenome):
 
     '''index intervals without storing a value.'''
     index_factory = ncl.NCLSimple
 
+    with_values = False
+
     def __init__(self, *args, **kwargs):
         IndexedGenome.__init__(self, *args, **kwargs)
 
@@ -109,12 +265,18 @@ class Quicksect(IndexedGenome):
 
     def __init__(self, *args, **kwargs):
         IndexedGenome.__init__(self, *args, **kwargs)
+        # intervals and their positions per contig, built
+        # on demand for batch queries
+        self.mIntervals = {}
+        self.mPositions = {}
 
     def add(self, contig, start, end, value):
 
         if contig not in self.mIndex:
             self.mIndex[contig] = self.index_factory()
         self.mIndex[contig].add_interval(Interval(start, end, value))
+        self.mIntervals.pop(contig, None)
+        self.mPositions.pop(contig, None)
 
     def get(self, contig, start, end):
         '''return intervals overlapping with key.'''
@@ -124,6 +286,114 @@ class Quicksect(IndexedGenome):
         return [(x.start, x.end, x.value)
                 for x in self.mIndex[contig].find(start, end)]
 
+    def get_many(self, contig, starts, ends):
+        '''return intervals overlapping each of the queries in the
+        arrays *starts* and *ends*.
+
+        See :meth:`IndexedGenome.get_many`. Quicksect has no batch
+        query, so the intervals are searched query by query. An
+        index is the position of an interval when intervals are
+        sorted by their start coordinate.
+        '''
+        if contig not in self.mIndex:
+            raise KeyError("contig %s not in index" % contig)
+
+        index = self.mIndex[contig]
+        positions = self._getPositions(contig)
+        starts, ends = self._checkQueries(starts, ends)
+        offsets = numpy.zeros(len(starts) + 1, dtype=numpy.int64)
+        hits = []
+        for x, (start, end) in enumerate(zip(starts, ends)):
+            if 0 <= start < end:
+                hits.extend(positions[id(y)]
+                            for y in index.find(start, end))
+            offsets[x + 1] = len(hits)
+
+        return offsets, numpy.array(hits, dtype=numpy.intc)
+
+    def count_overlaps(self, contig, starts, ends):
+        '''return array with the number of intervals overlapping each
+        of the queries in the arrays *starts* and *ends*.'''
+        if contig not in self.mIndex:
+            raise KeyError("contig %s not in index" % contig)
+
+        index = self.mIndex[contig]
+        starts, ends = self._checkQueries(starts, ends)
+        counts = numpy.zeros(len(starts), dtype=numpy.int64)
+        for x, (start, end) in enumerate(zip(starts, ends)):
+            if 0 <= start < end:
+                counts[x] = len(index.find(start, end))
+
+        return counts
+
+    def _checkQueries(self, starts, ends):
+        '''return *starts* and *ends* as integer arrays.'''
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        if len(starts) != len(ends):
+            raise ValueError("starts and ends have different lengths")
+        return starts, ends
+
+    def _iterateIntervals(self, contig):
+        '''return list of intervals on *contig* sorted by start.'''
+        nodes = []
+        self.mIndex[contig].traverse(nodes.append)
+        return [x.interval for x in nodes]
+
+    def _getIntervals(self, contig):
+        '''return cached list of intervals on *contig* sorted
+        by start.'''
+        if contig not in self.mIntervals:
+            self.mIntervals[contig] = self._iterateIntervals(contig)
+        return self.mIntervals[contig]
+
+    def _getPositions(self, contig):
+        '''return dictionary mapping intervals on *contig* to
+        their position.'''
+        if contig not in self.mPositions:
+            self.mPositions[contig] = dict(
+                (id(x), y) for y, x in enumerate(self._getIntervals(contig)))
+        return self.mPositions[contig]
+
+    def getValues(self, contig, indices):
+        '''return values of intervals with *indices* on *contig*.'''
+        intervals = self._getIntervals(contig)
+        return [intervals[x].value for x in indices]
+
+    def save(self, filename):
+        '''save index to *filename*.
+
+        Quicksect trees can not be written directly. Instead, the
+        intervals and values of each contig are pickled.
+        '''
+        contigs = [(contig, [(x.start, x.end, x.value)
+                             for x in self._iterateIntervals(contig)])
+                   for contig in sorted(self.mIndex)]
+        with open(filename, "wb") as outf:
+            outf.write(MAGIC_QUICKSECT)
+            pickle.dump(contigs, outf, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename, mmap=True):
+        '''load an index saved with :meth:`save` from *filename*.
+
+        The trees are rebuilt from the saved intervals, *mmap* is
+        ignored.
+
+        Raises ValueError if the file is not a saved quicksect index.
+        '''
+        with open(filename, "rb") as inf:
+            if inf.read(len(MAGIC_QUICKSECT)) != MAGIC_QUICKSECT:
+                raise ValueError(
+                    "%s is not a saved quicksect index" % filename)
+            contigs = pickle.load(inf)
+
+        result = cls()
+        for contig, intervals in contigs:
+            for start, end, value in intervals:
+                result.add(contig, start, end, value)
+        return result
+
     def before(self, contig, start, end, num_intervals=1, max_dist=2500):
         '''get closest interval before *start*.'''
         if contig not in self.mIndex:
@@ -143,3 +413,35 @@ class Quicksect(IndexedGenome):
                     Interval(start, end),
                     num_intervals=1,
                     max_dist=max_dist)]
+
+
+def cached(filename, build, cache_dir, index_class=IndexedGenome, **kwargs):
+    '''return index for *filename*, using a cache in *cache_dir*.
+
+    The cache is keyed on the absolute path, modification time and
+    size of *filename* and on the keyword arguments in *kwargs*. If
+    no up-to-date cached index exists, *build* is called with
+    *kwargs* to build the index, which is then saved to the cache.
+
+    Arguments
+    ---------
+    filename : string
+       Filename of the source file.
+    build : function
+       Function returning an index of type *index_class*.
+    cache_dir : string
+       Directory with cached indices. Created if it does not exist.
+    index_class : class
+       Class of the index, :class:`IndexedGenome`, :class:`Simple`
+       or :class:`Quicksect`.
+
+    Returns
+    -------
+    index : :class:`IndexedGenome`
+    '''
+    return IOTools.cached(
+        [filename], build, cache_dir,
+        "%s.%s.%%s.ncl" % (os.path.basename(filename), index_class.__name__),
+        load=index_class.load,
+        save=lambda index, filename: index.save(filename),
+        **kwargs)
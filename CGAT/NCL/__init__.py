@@ -69,12 +69,48 @@ class NCLSimple(object):
         self._commit()
         return self.mDatabase.find_overlap(start, end)
 
+    def findMany(self, starts, ends):
+        """find intervals overlapping each of the queries in the arrays
+        *starts* and *ends*.
+
+        returns a tuple of arrays ``(offsets, ids)``, see
+        :meth:`cnestedlist.IntervalDB.find_overlap_many`.
+        """
+        self._commit()
+        return self.mDatabase.find_overlap_many(starts, ends)
+
+    def countMany(self, starts, ends):
+        """return an array with the number of intervals overlapping
+        each of the queries in the arrays *starts* and *ends*.
+        """
+        self._commit()
+        return self.mDatabase.find_overlap_many(starts, ends,
+                                                counts_only=True)
+
     def _commit(self):
         """commit database if changed."""
         if self.mIsDirty:
             self.mDatabase.fromlist(self.mTuples)
             self.mIsDirty = False
 
+    def toBuffers(self):
+        """return the database as raw buffers.
+
+        See :meth:`cnestedlist.IntervalDB.tobuffers`.
+        """
+        self._commit()
+        return self.mDatabase.tobuffers()
+
+    def fromBuffers(self, n, ntop, nlists, intervals, sublists):
+        """restore database from buffers returned by :meth:`toBuffers`.
+
+        No segments can be added to a restored database.
+        """
+        self.mDatabase.frombuffers(n, ntop, nlists, intervals, sublists)
+        self.mTuples = []
+        self.mIsDirty = False
+        self.mFromDisk = True
+
     def __del__(self):
         """flush database to disk."""
         if self.mFilestem and not self.mFromDisk:
@@ -109,8 +145,9 @@ class NCL(NCLSimple):
         if start >= end:
             raise ValueError(
                 "adding empty/invalid interval (%i,%i)" % (start, end))
+        v = NCLSimple.add(self, start, end)
         self.mValues.append(value)
-        return NCLSimple.add(self, start, end)
+        return v
 
     def __getitem__(self, key):
         """get a value from the database
@@ -126,7 +163,7 @@ class NCL(NCLSimple):
 
         returns an :class:`ncl.IteratorWithValues`
         """
-        if self.mFromDisk:
+        if self.mFromDisk and self.mFilestem:
             return IteratorWithValues(self, NCLSimple.find(self, start, end))
         else:
             return IteratorWithValues(self.mValues, NCLSimple.find(self, start, end))
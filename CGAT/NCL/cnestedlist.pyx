@@ -1,5 +1,7 @@
 #cython: embedsignature=True
 cimport cython
+from libc.stdint cimport int64_t
+import numpy
 
 ###############################
 # Could not make .pxd file to be found in gpipe/setup.py, so including it here:
@@ -277,6 +279,83 @@ cdef class IntervalDB:
     free_interval_iterator(it_alloc)
     return l
         
+  def find_overlap_many(self, starts, ends, counts_only=False):
+    """find intervals overlapping each of the queries *starts*, *ends*.
+
+    The queries are given as two integer arrays of the same length.
+    The result is returned in compressed sparse row format as a
+    tuple of numpy arrays ``(offsets, ids)``: the ids of intervals
+    overlapping the i-th query are ``ids[offsets[i]:offsets[i+1]]``.
+    Queries that are empty or invalid have no hits.
+
+    If *counts_only* is True, return an array with the number of
+    overlapping intervals per query instead.
+    """
+    cdef int i, k, nhit, nqueries
+    cdef int64_t nresults = 0, nallocated = 1024
+    cdef int *hits = NULL
+    cdef int *new_hits
+    cdef int[:] cstarts, cends, ids
+    cdef int64_t[:] offsets
+    cdef IntervalIterator *it
+    cdef IntervalIterator *it_alloc
+    cdef IntervalMap im_buf[1024]
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+
+    cstarts = numpy.ascontiguousarray(starts, dtype=numpy.intc)
+    cends = numpy.ascontiguousarray(ends, dtype=numpy.intc)
+    nqueries = cstarts.shape[0]
+    if cends.shape[0] != nqueries:
+      raise ValueError("starts and ends have different lengths")
+
+    if counts_only:
+      result_offsets = numpy.zeros(nqueries, dtype=numpy.int64)
+    else:
+      result_offsets = numpy.zeros(nqueries + 1, dtype=numpy.int64)
+      hits = <int*>malloc(nallocated * sizeof(int))
+      if hits == NULL:
+        raise MemoryError('unable to allocate hit buffer')
+    offsets = result_offsets
+
+    it_alloc = interval_iterator_alloc()
+    try:
+      for i from 0 <= i < nqueries:
+        if cstarts[i] < 0 or cstarts[i] >= cends[i]:
+          if not counts_only:
+            offsets[i + 1] = nresults
+          continue
+        it = reset_interval_iterator(it_alloc)
+        while it:
+          find_intervals(it, cstarts[i], cends[i], self.im, self.ntop,
+                         self.subheader, self.nlists, im_buf, 1024,
+                         &nhit, &it) # GET NEXT BUFFER CHUNK
+          if counts_only:
+            offsets[i] += nhit
+            continue
+          if nresults + nhit > nallocated:
+            nallocated = 2 * (nresults + nhit)
+            new_hits = <int*>realloc(hits, nallocated * sizeof(int))
+            if new_hits == NULL:
+              raise MemoryError('unable to allocate hit buffer')
+            hits = new_hits
+          for k from 0 <= k < nhit:
+            hits[nresults] = im_buf[k].target_id
+            nresults += 1
+        if not counts_only:
+          offsets[i + 1] = nresults
+
+      if counts_only:
+        return result_offsets
+
+      result_ids = numpy.empty(nresults, dtype=numpy.intc)
+      if nresults > 0:
+        ids = result_ids
+        memcpy(&ids[0], hits, nresults * sizeof(int))
+      return result_offsets, result_ids
+    finally:
+      free_interval_iterator(it_alloc)
+      free(hits)
+
   def check_nonempty(self):
     """return True if the database is empty."""
     if self.im:
@@ -297,13 +376,58 @@ cdef class IntervalDB:
     if err_msg:
       raise IOError(err_msg)
 
+  def tobuffers(self):
+    """return the database as a tuple ``(n, ntop, nlists, intervals,
+    sublists)``.
+
+    ``intervals`` and ``sublists`` are the raw contents of the
+    interval map and sublist header arrays. The database can be
+    restored with :meth:`frombuffers`.
+    """
+    cdef int nsublists
+    self.check_nonempty() # RAISE EXCEPTION IF NO DATA
+    # build_nested_list allocates a dummy header if there are no sublists
+    nsublists = max(self.nlists, 1)
+    intervals = (<char*>self.im)[:self.n * sizeof(IntervalMap)]
+    sublists = (<char*>self.subheader)[:nsublists * sizeof(SublistHeader)]
+    return self.n, self.ntop, self.nlists, intervals, sublists
+
+  def frombuffers(self, int n, int ntop, int nlists,
+                  const unsigned char[:] intervals,
+                  const unsigned char[:] sublists):
+    """restore database from buffers returned by :meth:`tobuffers`.
+
+    The buffers can be any object supporting the buffer protocol,
+    such as slices of a memory mapped file. The data is copied.
+    """
+    cdef int nsublists = max(nlists, 1)
+    if n <= 0:
+      raise ValueError("number of intervals must be larger than 0")
+    if intervals.shape[0] != n * sizeof(IntervalMap):
+      raise ValueError("interval buffer has wrong size")
+    if sublists.shape[0] != nsublists * sizeof(SublistHeader):
+      raise ValueError("sublist buffer has wrong size")
+    self.close() # DUMP OUR EXISTING MEMORY
+    self.im = interval_map_alloc(n)
+    if self.im == NULL:
+      raise MemoryError('unable to allocate IntervalMap[%d]' % n)
+    self.subheader = <SublistHeader*>malloc(nsublists * sizeof(SublistHeader))
+    if self.subheader == NULL:
+      raise MemoryError('unable to allocate SublistHeader[%d]' % nsublists)
+    memcpy(self.im, <void*>&intervals[0], n * sizeof(IntervalMap))
+    memcpy(self.subheader, <void*>&sublists[0],
+           nsublists * sizeof(SublistHeader))
+    self.n = n
+    self.ntop = ntop
+    self.nlists = nlists
+
   def __dealloc__(self):
     'remember: dealloc cannot call other methods!'
     if self.subheader:
       free(self.subheader)
     if self.im:
       free(self.im)
-    
+
   def close(self):
     if self.subheader:
       free(self.subheader)
@@ -28,6 +28,15 @@ procedure::
 This design is useful to compute multiple properties while iterating
 only once over an input file and output a single, multi-column table.
 
+Counting is done on arrays of byte codes. Wrapping a sequence in an
+:class:`EncodedSequence` before loading it into several counters
+encodes the sequence only once and shares residue, dinucleotide and
+codon counts between the counters::
+
+   sequence = EncodedSequence(sequence)
+   for c in counters:
+       c.loadSequence(sequence)
+
 .. note::
     While useful and in working order, the design of the classes is
     cumbersome.
@@ -42,6 +51,7 @@ import math
 import hashlib
 import base64
 import itertools
+import numpy
 import six
 
 from CGAT import Genomics as Genomics
@@ -49,6 +59,119 @@ from CGAT import Genomics as Genomics
 import Bio.Alphabet.IUPAC
 
 
+# map lower case to upper case byte codes
+UPPER_CASE = numpy.arange(256, dtype=numpy.uint8)
+UPPER_CASE[ord("a"):ord("z") + 1] -= ord("a") - ord("A")
+
+
+class EncodedSequence(str):
+    """a sequence with cached residue counts.
+
+    The sequence is converted once into an array of byte codes.
+    Character, dinucleotide and codon counts are computed with
+    :func:`numpy.bincount` on demand and cached, so that several
+    SequenceProperties objects loading the same :class:`EncodedSequence`
+    scan the sequence only once.
+
+    As a subclass of str, an :class:`EncodedSequence` can be used
+    wherever a sequence is expected.
+    """
+
+    def __new__(cls, sequence):
+        self = str.__new__(cls, sequence)
+        self._cache = {}
+        return self
+
+    def getCodes(self, upper=False):
+        """return the sequence as an array of byte codes.
+
+        If *upper* is set, lower case characters are mapped to upper
+        case.
+        """
+        key = ("codes", upper)
+        if key not in self._cache:
+            if upper:
+                codes = UPPER_CASE[self.getCodes()]
+            else:
+                codes = numpy.frombuffer(six.b(self), dtype=numpy.uint8)
+            self._cache[key] = codes
+        return self._cache[key]
+
+    def getCounts(self, upper=False):
+        """return array with the counts of each byte code."""
+        key = ("counts", upper)
+        if key not in self._cache:
+            self._cache[key] = numpy.bincount(self.getCodes(upper),
+                                              minlength=256)
+        return self._cache[key]
+
+    def countCharacters(self, alphabet, upper=False):
+        """count characters in *alphabet*.
+
+        Returns a tuple of a list of counts for each character in
+        *alphabet* and the number of other characters.
+        """
+        counts = self.getCounts(upper)[[ord(x) for x in alphabet]]
+        return ([int(x) for x in counts],
+                len(self.getCodes()) - int(numpy.sum(counts)))
+
+    def countDinucleotides(self, alphabet, upper=False):
+        """count overlapping pairs of characters in *alphabet*.
+
+        Returns a tuple of a dictionary of counts for each pair of
+        characters in *alphabet* and the number of pairs containing
+        other characters.
+        """
+        key = ("dinucleotides", alphabet, upper)
+        if key not in self._cache:
+            n = len(alphabet)
+            lookup = numpy.empty(256, dtype=numpy.int64)
+            lookup.fill(n)
+            lookup[[ord(x) for x in alphabet]] = numpy.arange(n)
+            codes = lookup[self.getCodes(upper)]
+            counts = numpy.bincount(
+                codes[:-1] * (n + 1) + codes[1:],
+                minlength=(n + 1) * (n + 1)).reshape(n + 1, n + 1)
+            result = {}
+            for x, a in enumerate(alphabet):
+                for y, b in enumerate(alphabet):
+                    result[a + b] = int(counts[x, y])
+            self._cache[key] = (
+                result,
+                max(0, len(codes) - 1) - int(numpy.sum(counts[:n, :n])))
+        return self._cache[key]
+
+    def countCodons(self, upper=False):
+        """count codons in the sequence.
+
+        Returns a dictionary of counts for each codon observed in the
+        sequence. Raises ValueError if the length of the sequence is
+        not a multiple of 3.
+        """
+        key = ("codons", upper)
+        if key not in self._cache:
+            codes = self.getCodes(upper)
+            if len(codes) % 3:
+                raise ValueError(
+                    "sequence length is not a multiple of 3 (length=%i)" %
+                    len(codes))
+            codes = codes.reshape(-1, 3)
+            codes = codes.astype(numpy.uint32)
+            packed = (codes[:, 0] << 16) | (codes[:, 1] << 8) | codes[:, 2]
+            values, counts = numpy.unique(packed, return_counts=True)
+            self._cache[key] = dict(
+                (chr(v >> 16) + chr((v >> 8) & 255) + chr(v & 255), int(c))
+                for v, c in zip(values, counts))
+        return self._cache[key]
+
+
+def encodeSequence(sequence):
+    """return *sequence* as an :class:`EncodedSequence`."""
+    if isinstance(sequence, EncodedSequence):
+        return sequence
+    return EncodedSequence(sequence)
+
+
 class SequenceProperties(object):
     """Base class.
 
@@ -239,19 +362,12 @@ class SequencePropertiesNA(SequenceProperties):
         """load sequence properties from a sequence."""
         SequenceProperties.loadSequence(self, sequence, seqtype)
         # counts of nucleotides
-        self.mCountsNA = {}
-        for x in self.mAlphabet:
-            self.mCountsNA[x] = 0
-
-        for na in sequence.upper():
-            if na in ('G', 'C'):
-                self.mCountsGC += 1
-            elif na in ('A', 'T'):
-                self.mCountsAT += 1
-            try:
-                self.mCountsNA[na] += 1
-            except KeyError:
-                self.mCountsOthers += 1
+        counts, others = encodeSequence(sequence).countCharacters(
+            self.mAlphabet, upper=True)
+        self.mCountsNA = dict(zip(self.mAlphabet, counts))
+        self.mCountsGC += self.mCountsNA['G'] + self.mCountsNA['C']
+        self.mCountsAT += self.mCountsNA['A'] + self.mCountsNA['T']
+        self.mCountsOthers += others
 
     def getFields(self):
         fields = SequenceProperties.getFields(self)
@@ -327,14 +443,11 @@ class SequencePropertiesDN(SequenceProperties):
         """load sequence properties from a sequence."""
         SequenceProperties.loadSequence(self, sequence, seqtype)
 
-        # IMS: generator rather than list
-        # to save memory for might be a neater way of doing this.
-        for dinuc in (sequence[x - 2:x]
-                      for x in range(2, len(sequence) + 1, 1)):
-            try:
-                self.mCountsDinuc[dinuc] += 1
-            except KeyError:
-                self.mCountsOthers += 1
+        counts, others = encodeSequence(sequence).countDinucleotides(
+            self.mAlphabet)
+        for dinuc, count in counts.items():
+            self.mCountsDinuc[dinuc] += count
+        self.mCountsOthers += others
 
     def getFields(self):
 
@@ -382,6 +495,7 @@ class SequencePropertiesCpg(SequencePropertiesNA, SequencePropertiesDN):
         self.mCpG_ObsExp += other.mCpG_ObsExp
 
     def loadSequence(self, sequence, seqtype="na"):
+        sequence = encodeSequence(sequence)
         SequencePropertiesNA.loadSequence(self, sequence, seqtype)
         SequencePropertiesDN.loadSequence(self, sequence, seqtype)
 
@@ -451,29 +565,18 @@ class SequencePropertiesGaps(SequenceProperties):
         """load sequence properties from a sequence."""
         SequenceProperties.loadSequence(self, sequence, seqtype)
 
-        gap_chars = self.gap_chars
-        ngaps = 0
-        was_gap = not (sequence[0] in gap_chars)
+        is_gap = numpy.zeros(256, dtype=bool)
+        is_gap[[ord(x) for x in self.gap_chars]] = True
+        is_gap = is_gap[encodeSequence(sequence).getCodes()]
 
-        ngap_regions = 0
-        nseq_regions = 0
-
-        x = 0
-        for x, c in enumerate(sequence):
-
-            is_gap = c in gap_chars
-            if is_gap:
-                ngaps += 1
-                if not was_gap:
-                    ngap_regions += 1
-            else:
-                if was_gap:
-                    nseq_regions += 1
-            was_gap = is_gap
+        # a region starts at the first residue and whenever the
+        # residue type changes
+        starts = numpy.ones(len(is_gap), dtype=bool)
+        starts[1:] = is_gap[1:] != is_gap[:-1]
 
-        self.ngaps = ngaps
-        self.ngap_regions = ngap_regions
-        self.nseq_regions = nseq_regions
+        self.ngaps = int(numpy.sum(is_gap))
+        self.ngap_regions = int(numpy.sum(starts & is_gap))
+        self.nseq_regions = int(numpy.sum(starts & ~is_gap))
 
     def addProperties(self, other):
         SequenceProperties.addProperties(self, other)
@@ -584,9 +687,6 @@ class SequencePropertiesDegeneracy (SequencePropertiesLength):
                 '''sequence length is not a multiple of 3 (length=%i)''' %
                 (len(sequence)))
 
-        # uppercase all letters
-        sequence = sequence.upper()
-
         self.mNStopCodons = 0
 
         # setup counting arrays
@@ -608,21 +708,22 @@ class SequencePropertiesDegeneracy (SequencePropertiesLength):
                 xx.append(yy)
             self.mCountsDegeneracy.append(xx)
 
-        # use generator rather than list to save memory
-        for codon in (sequence[x:x + 3] for x in range(0, len(sequence), 3)):
+        # count each distinct (upper case) codon once
+        codons = encodeSequence(sequence).countCodons(upper=True)
+        for codon, count in codons.items():
 
             for x in (0, 1, 2):
-                self.mCounts[x][codon[x]] += 1
+                self.mCounts[x][codon[x]] += count
 
             if Genomics.IsStopCodon(codon):
-                self.mNStopCodons += 1
+                self.mNStopCodons += count
                 continue
 
             try:
                 aa, deg1, deg2, deg3 = Genomics.GetDegeneracy(codon)
                 degrees = (deg1, deg2, deg3)
                 for x in range(len(degrees)):
-                    self.mCountsDegeneracy[x][degrees[x]][codon[x]] += 1
+                    self.mCountsDegeneracy[x][degrees[x]][codon[x]] += count
 
             except KeyError:
                 pass
@@ -784,9 +885,9 @@ class SequencePropertiesAA(SequenceProperties):
         for x in Bio.Alphabet.IUPAC.extended_protein.letters:
             self.mCountsAA[x] = 0
 
-        for codon in (sequence[x:x + 3] for x in range(0, len(sequence), 3)):
+        for codon, count in encodeSequence(sequence).countCodons().items():
             aa = Genomics.MapCodon2AA(codon)
-            self.mCountsAA[aa] += 1
+            self.mCountsAA[aa] += count
 
     def getFields(self):
 
@@ -839,18 +940,11 @@ class SequencePropertiesAminoAcids(SequenceProperties):
 
         SequenceProperties.loadSequence(self, sequence, seqtype)
 
-        # set to zero
-        for x in Bio.Alphabet.IUPAC.extended_protein.letters:
-            self.mCountsAA[x] = 0
-        self.mOtherCounts = 0
-
-        for aa in sequence:
-            if aa == "-":
-                continue
-            try:
-                self.mCountsAA[aa] += 1
-            except KeyError:
-                self.mOtherCounts += 1
+        alphabet = Bio.Alphabet.IUPAC.extended_protein.letters
+        counts, others = encodeSequence(sequence).countCharacters(
+            alphabet + "-")
+        self.mCountsAA = dict(zip(alphabet, counts))
+        self.mOtherCounts = others
 
     def getFields(self):
 
@@ -921,8 +1015,11 @@ class SequencePropertiesCodons(SequencePropertiesLength):
 
         SequencePropertiesLength.loadSequence(self, sequence, seqtype)
 
-        # uppercase all letters and count codons
-        self.mCodonCounts = Genomics.CountCodons(sequence.upper())
+        # uppercase all letters and count codons, skipping stop-codons
+        codons = encodeSequence(sequence).countCodons(upper=True)
+        self.mCodonCounts = {}
+        for codon in Genomics.GeneticCodeAA.keys():
+            self.mCodonCounts[codon] = codons.get(codon, 0)
 
     def getFields(self):
 
@@ -1214,17 +1311,9 @@ class SequencePropertiesCounts(SequenceProperties):
 
         SequenceProperties.loadSequence(self, sequence, seqtype)
 
-        # counts of amino acids
-        self.mCounts = {}
-        for x in self.mAlphabet:
-            self.mCounts[x] = 0
-        self.mCountsOthers = 0
-
-        for na in sequence.upper():
-            try:
-                self.mCounts[na] += 1
-            except KeyError:
-                self.mCountsOthers += 1
+        counts, self.mCountsOthers = encodeSequence(
+            sequence).countCharacters(self.mAlphabet, upper=True)
+        self.mCounts = dict(zip(self.mAlphabet, counts))
 
     def getFields(self):
         fields = SequenceProperties.getFields(self)
@@ -502,6 +502,34 @@ def adjustPValuesR(pvalues, method):
     return R.p_adjust(pvalues, method)
 
 
+def sortPValues(pvalues):
+    '''sort p-values and count ties.
+
+    Returns a tuple (order, values, nle) of the sort order, the sorted
+    p-values and, for each sorted p-value, the number of p-values less
+    than or equal to it.
+    '''
+    order = numpy.argsort(pvalues)
+    values = pvalues[order]
+    last = numpy.empty(len(values), dtype=bool)
+    last[-1:] = True
+    numpy.not_equal(values[1:], values[:-1], out=last[:-1])
+    ends = numpy.flatnonzero(last) + 1
+    nle = numpy.repeat(ends, numpy.diff(numpy.concatenate(([0], ends))))
+    return order, values, nle
+
+
+def estimatePi0Lambda(values, vlambda):
+    '''return estimates of pi0 for each value of lambda in *vlambda*.
+
+    The estimate is the proportion of p-values larger or equal than
+    lambda divided by 1 - lambda. *values* are sorted p-values.
+    '''
+    vlambda = numpy.asarray(vlambda, dtype=numpy.float64)
+    nabove = len(values) - numpy.searchsorted(values, vlambda, side="left")
+    return nabove / float(len(values)) / (1.0 - vlambda)
+
+
 def smoothPValues(pvalues,
                   vlambda=numpy.arange(0, 0.95, 0.05),
                   smooth_df=3,
@@ -520,11 +548,7 @@ def smoothPValues(pvalues,
 
     m = len(pvalues)
 
-    pi0 = numpy.zeros(len(vlambda), numpy.float)
-
-    for i in range(len(vlambda)):
-        pi0[i] = numpy.mean([x >= vlambda[i]
-                             for x in pvalues]) / (1.0 - vlambda[i])
+    pi0 = estimatePi0Lambda(numpy.sort(pvalues), vlambda)
 
     R.assign("pi0", pi0)
     R.assign("vlambda", vlambda)
@@ -564,6 +588,7 @@ def getPi0(pvalues,
         raise ValueError("vlambda must be within [0, 1).")
 
     m = len(pvalues)
+    values = numpy.sort(pvalues)
 
     # these next few functions are the various ways to estimate pi0
     if len(vlambda) == 1:
@@ -571,17 +596,13 @@ def getPi0(pvalues,
         if vlambda < 0 or vlambda >= 1:
             raise ValueError("vlambda must be within [0, 1).")
 
-        pi0 = numpy.mean([x >= vlambda for x in pvalues]) / (1.0 - vlambda)
+        pi0 = estimatePi0Lambda(values, [vlambda])[0]
         pi0 = min(pi0, 1.0)
         R.assign("pi0", pi0)
 
     else:
 
-        pi0 = numpy.zeros(len(vlambda), numpy.float)
-
-        for i in range(len(vlambda)):
-            pi0[i] = numpy.mean([x >= vlambda[i]
-                                 for x in pvalues]) / (1.0 - vlambda[i])
+        pi0 = estimatePi0Lambda(values, vlambda)
 
         R.assign("pi0", pi0)
         R.assign("vlambda", vlambda)
@@ -851,9 +872,16 @@ def doFDRPython(pvalues,
 
     Compute FDR after method by Storey et al. (2002).
 
+    The computation requires a single sort of the p-values.
+    Single precision input is not converted, the q-values are
+    returned with the same precision.
     """
 
-    if min(pvalues) < 0 or max(pvalues) > 1:
+    pvalues = numpy.asarray(pvalues)
+    if pvalues.dtype.kind != "f":
+        pvalues = pvalues.astype(numpy.float64)
+
+    if pvalues.min() < 0 or pvalues.max() > 1:
         raise ValueError("p-values out of range")
 
     # set to default of qvalue method
@@ -861,7 +889,7 @@ def doFDRPython(pvalues,
         vlambda = numpy.arange(0, 0.95, 0.05)
 
     m = len(pvalues)
-    pvalues = numpy.array(pvalues, dtype=numpy.float)
+    order, values, nle = sortPValues(pvalues)
 
     if pi0 is None:
         if type(vlambda) == float:
@@ -880,20 +908,16 @@ def doFDRPython(pvalues,
             if vlambda < 0 or vlambda >= 1:
                 raise ValueError("vlambda must be within [0, 1).")
 
-            pi0 = numpy.mean([x >= vlambda for x in pvalues]) / (1.0 - vlambda)
+            pi0 = estimatePi0Lambda(values, [vlambda])[0]
             pi0 = min(pi0, 1.0)
         else:
 
-            pi0 = numpy.zeros(len(vlambda), numpy.float)
-
-            for i in range(len(vlambda)):
-                pi0[i] = numpy.mean([x >= vlambda[i]
-                                     for x in pvalues]) / (1.0 - vlambda[i])
+            pi0 = estimatePi0Lambda(values, vlambda)
 
             if pi0_method == "smoother":
 
                 if smooth_log_pi0:
-                    pi0 = math.log(pi0)
+                    pi0 = numpy.log(pi0)
 
                 tck = scipy.interpolate.splrep(vlambda,
                                                pi0,
@@ -916,20 +940,28 @@ def doFDRPython(pvalues,
             elif pi0_method == "bootstrap":
 
                 minpi0 = min(pi0)
-
-                mse = numpy.zeros(len(vlambda), numpy.float)
-                pi0_boot = numpy.zeros(len(vlambda), numpy.float)
-
-                for i in range(100):
-                    # sample pvalues
-                    idx_boot = numpy.random.random_integers(0, m - 1, m)
-                    pvalues_boot = pvalues[idx_boot]
-
-                    for x in range(len(vlambda)):
-                        # compute number of pvalues larger than lambda[x]
-                        pi0_boot[x] = numpy.mean(
-                            pvalues_boot > vlambda[x]) / (1.0 - vlambda[x])
-                    mse += (pi0_boot - minpi0) ** 2
+                nsamples = 100
+
+                # the number of p-values in a bootstrap sample falling
+                # into the intervals delimited by the lambdas follows
+                # a multinomial distribution, so there is no need
+                # to resample the p-values themselves.
+                vlambda_array = numpy.asarray(vlambda, dtype=numpy.float64)
+                lambda_order = numpy.argsort(vlambda_array)
+                ngreater = m - numpy.searchsorted(
+                    values, vlambda_array[lambda_order], side="right")
+                bins = -numpy.diff(numpy.concatenate(([m], ngreater, [0])))
+                samples = numpy.random.multinomial(
+                    m, bins / float(m), size=nsamples)
+                # number of p-values larger than each lambda
+                ngreater_boot = numpy.cumsum(
+                    samples[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+                pi0_boot = numpy.zeros((nsamples, len(vlambda)),
+                                       numpy.float64)
+                pi0_boot[:, lambda_order] = ngreater_boot / float(m) / \
+                    (1.0 - vlambda_array[lambda_order])
+                mse = numpy.sum((pi0_boot - minpi0) ** 2, axis=0)
                 pi0 = min(pi0[mse == min(mse)])
             else:
                 raise ValueError(
@@ -945,39 +977,29 @@ def doFDRPython(pvalues,
     if fdr_level is not None and (fdr_level <= 0 or fdr_level > 1):
         raise ValueError("'fdr_level' must be within (0, 1].")
 
-    # compute qvalues
-    idx = numpy.argsort(pvalues)
-    # monotonically decreasing bins, so that bins[i-1] > x >=  bins[i]
-    bins = numpy.unique(pvalues)[::-1]
-
-    # v[i] = number of observations less than or equal to pvalue[i]
-    # could this be done more elegantly?
-    val2bin = len(bins) - numpy.digitize(pvalues, bins)
-    v = numpy.zeros(m, dtype=numpy.int)
-    lastbin = None
-    for x in range(m - 1, -1, -1):
-        bin = val2bin[idx[x]]
-        if bin != lastbin:
-            c = x
-        v[idx[x]] = c + 1
-        lastbin = bin
-
-    qvalues = pvalues * pi0 * m / v
+    # compute qvalues for the sorted p-values. nle is the number
+    # of observations less than or equal to each p-value.
+    sorted_qvalues = values * pi0 * m / nle
     if robust:
-        qvalues /= (1.0 - (1.0 - pvalues) ** m)
+        # 1 - (1 - p)^m in double precision, as 1 - p rounds
+        # to 1 for small single precision p-values
+        sorted_qvalues /= -numpy.expm1(
+            m * numpy.log1p(-values.astype(numpy.float64)))
 
     # bound qvalues by 1 and make them monotonic
-    qvalues[idx[m - 1]] = min(qvalues[idx[m - 1]], 1.0)
-    for i in range(m - 2, -1, -1):
-        qvalues[idx[i]] = min(min(qvalues[idx[i]], qvalues[idx[i + 1]]), 1.0)
+    sorted_qvalues = numpy.minimum(
+        numpy.minimum.accumulate(sorted_qvalues[::-1])[::-1], 1.0)
+
+    qvalues = numpy.empty(m, dtype=pvalues.dtype)
+    qvalues[order] = sorted_qvalues
 
     result = FDRResult()
     result.mQValues = qvalues
 
     if fdr_level is not None:
-        result.mPassed = [x <= fdr_level for x in result.mQValues]
+        result.mPassed = qvalues <= fdr_level
     else:
-        result.mPassed = [False for x in result.mQValues]
+        result.mPassed = numpy.zeros(m, dtype=bool)
 
     result.mPValues = pvalues
     result.mPi0 = pi0
@@ -1416,7 +1438,9 @@ def adjustPValues(pvalues, method='fdr', n=None):
         method = "BH"
 
     # optional, remove NA values
-    p = numpy.array(pvalues, dtype=numpy.float)
+    p = numpy.asarray(pvalues)
+    if p.dtype.kind != "f":
+        p = p.astype(numpy.float64)
     lp = len(p)
 
     assert n <= lp
@@ -1427,12 +1451,6 @@ def adjustPValues(pvalues, method='fdr', n=None):
         method = "hochberg"
     if method == "bonferroni":
         p0 = n * p
-    elif method == "holm":
-        i = numpy.arange(lp)
-        o = numpy.argsort(p)
-        ro = numpy.argsort(o)
-        m = numpy.maximum.accumulate((n - i) * p[o])
-        p0 = m[ro]
     elif method == "hommel":
         raise NotImplementedError("hommel method not implemented")
     # if (n > lp) p <- c(p, rep.int(1, n - lp))
@@ -1451,29 +1469,35 @@ def adjustPValues(pvalues, method='fdr', n=None):
     #         pa <- pmax(pa, q)
     #     }
     #     pmax(pa, p)[if (lp < n) ro[1:lp] else ro]
-    elif method == "hochberg":
-        i = numpy.arange(0, lp)[::-1]
-        o = numpy.argsort(1 - p)
-        ro = numpy.argsort(o)
-        m = numpy.minimum.accumulate((n - i) * p[o])
-        p0 = m[ro]
-    elif method == "BH":
-        i = numpy.arange(1, lp + 1)[::-1]
-        o = numpy.argsort(1 - p)
-        ro = numpy.argsort(o)
-        m = numpy.minimum.accumulate(float(n) / i * p[o])
-        p0 = m[ro]
-    elif method == "BY":
-        i = numpy.arange(1, lp + 1)[::-1]
-        o = numpy.argsort(1 - p)
-        ro = numpy.argsort(o)
-        q = numpy.sum(1.0 / numpy.arange(1, n + 1))
-        m = numpy.minimum.accumulate(q * float(n) / i * p[o])
-        p0 = m[ro]
     elif method == "none":
         p0 = p
+    elif method in ("holm", "hochberg", "BH", "BY"):
+        # sort once and scatter the adjusted p-values back.
+        # NaN values are sorted last in both directions.
+        if method == "holm":
+            o = numpy.argsort(p)
+            i = numpy.arange(lp)
+            m = numpy.maximum.accumulate((n - i) * p[o])
+        else:
+            # decreasing p-values
+            o = numpy.argsort(-p)
+            if method == "hochberg":
+                i = numpy.arange(0, lp)[::-1]
+                m = (n - i) * p[o]
+            elif method == "BH":
+                i = numpy.arange(1, lp + 1)[::-1]
+                m = float(n) / i * p[o]
+            elif method == "BY":
+                i = numpy.arange(1, lp + 1)[::-1]
+                q = numpy.sum(1.0 / numpy.arange(1, n + 1))
+                m = q * float(n) / i * p[o]
+            m = numpy.minimum.accumulate(m)
+        p0 = numpy.empty(lp, dtype=p.dtype)
+        p0[o] = m
+    else:
+        raise ValueError("unknown method '%s'" % method)
 
-    return numpy.minimum(p0, numpy.ones(len(p0)))
+    return numpy.minimum(p0, 1.0)
 
 
 def savitzky_golay(y, window_size, order, deriv=0, rate=1):
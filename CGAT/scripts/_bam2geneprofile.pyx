@@ -14,7 +14,130 @@ import numpy
 CountResult = collections.namedtuple(
     "Counts", "upstream upstream_utr cds downstream_utr downstream")
 
+
+cdef class CoverageBuffer:
+    '''base-level coverage in a window sliding along a contig.
+
+    Counts are kept in a ring array indexed by genomic position
+    modulo its capacity. Advancing the window clears counts before
+    the new start so that their slots can be re-used. The capacity
+    is doubled if counts are added beyond it.
+    '''
+
+    cdef object counts
+    cdef double[:] view
+    cdef long capacity
+    # first position in window
+    cdef public long start
+    # end of positions with counts
+    cdef public long end
+
+    def __init__(self, long start=0, long capacity=65536):
+        self.start = start
+        self.end = start
+        self.allocate(capacity)
+
+    cdef allocate(self, long capacity):
+        self.counts = numpy.zeros(capacity)
+        self.view = self.counts
+        self.capacity = capacity
+
+    cdef reserve(self, long end):
+        '''make room for counts up to *end*.'''
+        cdef long capacity = self.capacity
+        cdef long pos
+        cdef double[:] counts
+
+        if end - self.start <= capacity:
+            return
+        while end - self.start > capacity:
+            capacity *= 2
+        counts = self.get(self.start, self.end)
+        self.allocate(capacity)
+        for pos from self.start <= pos < self.end:
+            self.view[pos % capacity] = counts[pos - self.start]
+
+    def advance(self, long start):
+        '''move window to *start*, discarding counts before it.'''
+        cdef long pos
+        if start <= self.start:
+            return
+        for pos from self.start <= pos < min(start, self.end):
+            self.view[pos % self.capacity] = 0
+        self.start = start
+        self.end = max(start, self.end)
+
+    cpdef add(self, long start, long end):
+        '''add one to counts in *start*-*end*.'''
+        cdef long pos
+        start = max(start, self.start)
+        if end <= start:
+            return
+        self.reserve(end)
+        for pos from start <= pos < end:
+            self.view[pos % self.capacity] += 1
+        self.end = max(end, self.end)
+
+    def addPositions(self, positions):
+        '''add one to counts at each of *positions*.'''
+        cdef long pos
+        for pos in positions:
+            if pos < self.start:
+                continue
+            self.reserve(pos + 1)
+            self.view[pos % self.capacity] += 1
+            self.end = max(pos + 1, self.end)
+
+    def get(self, long start, long end):
+        '''return a copy of the counts in *start*-*end*.'''
+        cdef long pos
+        assert start >= self.start, \
+            "region %i-%i before window start %i" % (start, end, self.start)
+        result = numpy.zeros(max(0, end - start))
+        cdef double[:] r = result
+        for pos from start <= pos < min(end, self.end):
+            r[pos - start] = self.view[pos % self.capacity]
+        return result
+
+
+class ReadStream:
+    '''reads in a contig of a :term:`bam` formatted file that are
+    consumed in chunks of increasing position.
+    '''
+
+    def __init__(self, samfile, contig, start=0):
+        self.pending = None
+        if samfile.gettid(contig) < 0:
+            self.iterator = iter([])
+        else:
+            self.iterator = samfile.fetch(contig, max(0, start))
+
+    def until(self, end):
+        '''iterate over remaining reads starting before *end*.'''
+        while True:
+            if self.pending is None:
+                try:
+                    self.pending = next(self.iterator)
+                except StopIteration:
+                    return
+            if self.pending.pos >= end:
+                return
+            read, self.pending = self.pending, None
+            yield read
+
 class RangeCounter:
+
+    # counts within a range only depend on data overlapping that
+    # range, so counts for several ranges can be sliced from the
+    # coverage of a region containing them all.
+    use_cache = True
+
+    # cached region as tuple of (contig, start, end)
+    cached_region = None
+
+    # coverage can be computed in a single pass along a contig,
+    # see :meth:`startSweep`.
+    use_sweep = False
     
     def __init__(self, countfiles, 
                  controlfiles=None, 
@@ -52,6 +175,118 @@ class RangeCounter:
         raise NotImplementedError(
             'implementations of RangeCounter need to implement getTotal')
 
+    def setCache(self, contig, start, end):
+        '''compute base-level coverage in region *contig*:*start*-*end*.
+
+        Subsequent calls to :meth:`getCounts` with ranges within
+        this region slice the cached coverage instead of counting
+        from the files again. The cache is discarded with
+        :meth:`clearCache` or the next call to :meth:`setCache`.
+        '''
+        self.clearCache()
+        if not self.use_cache:
+            return
+
+        start = max(0, start)
+        if end <= start:
+            return
+
+        self.cached_counts = numpy.zeros(end - start)
+        self.count(self.cached_counts, self.countfiles,
+                   contig, [(start, end)])
+        if self.controlfiles:
+            self.cached_counts_bg = numpy.zeros(end - start)
+            self.count(self.cached_counts_bg, self.controlfiles,
+                       contig, [(start, end)])
+        self.cached_region = (contig, start, end)
+
+    def clearCache(self):
+        '''discard cached coverage.'''
+        self.cached_region = None
+        self.cached_counts = None
+        self.cached_counts_bg = None
+
+    def startSweep(self, contig, start=0):
+        '''start a single pass along *contig* beginning at *start*.
+
+        Coverage of successive regions is then set with
+        :meth:`setSweep` from a single iterator per file.
+        '''
+        self.clearCache()
+        self.sweep_contig = contig
+        self.sweep_fg = (CoverageBuffer(),
+                         [ReadStream(x, contig,
+                                     start - self.getSweepMargin(index))
+                          for index, x in enumerate(self.countfiles)])
+        if self.controlfiles:
+            self.sweep_bg = (CoverageBuffer(),
+                             [ReadStream(x, contig,
+                                         start - self.getSweepMargin(index))
+                              for index, x in enumerate(self.controlfiles)])
+
+    def getSweepMargin(self, index):
+        '''return distance upstream of a region from which reads
+        in file *index* can contribute to its coverage.'''
+        return 0
+
+    def stopSweep(self):
+        '''end the current pass and discard coverage.'''
+        self.clearCache()
+        self.sweep_contig = self.sweep_fg = self.sweep_bg = None
+
+    def setSweep(self, start, end):
+        '''set the cache to region *start*-*end* on the contig of the
+        current sweep.
+
+        Regions need to be supplied in order of increasing start.
+        '''
+        self.clearCache()
+        start = max(0, start)
+        if end <= start:
+            return
+        self.cached_counts = self.advanceSweep(self.sweep_fg, start, end)
+        if self.controlfiles:
+            self.cached_counts_bg = self.advanceSweep(
+                self.sweep_bg, start, end)
+        self.cached_region = (self.sweep_contig, start, end)
+
+    def advanceSweep(self, sweep, start, end):
+        '''advance *sweep* to *start* and return coverage in
+        *start*-*end*.'''
+        buffer, streams = sweep
+        buffer.advance(start)
+        for index, stream in enumerate(streams):
+            self.sweepFile(buffer, stream, index, end)
+        return buffer.get(start, end)
+
+    def sweepFile(self, buffer, stream, index, end):
+        '''add all data in *stream* that contributes to coverage
+        before *end* to *buffer*.'''
+        raise NotImplementedError(
+            'implementations of RangeCounter supporting sweeps '
+            'need to implement sweepFile')
+
+    def isCached(self, contig, ranges):
+        '''return True if all *ranges* are within the cached region.'''
+        if self.cached_region is None:
+            return False
+        cached_contig, cached_start, cached_end = self.cached_region
+        if contig != cached_contig:
+            return False
+        for start, end in ranges:
+            if start < cached_start or end > cached_end or end < start:
+                return False
+        return True
+
+    def sliceCache(self, counts, cached_counts, ranges):
+        '''fill *counts* with *ranges* from *cached_counts*.'''
+        cdef int offset = 0
+        cdef int cached_start = self.cached_region[1]
+        for start, end in ranges:
+            counts[offset:offset + end - start] = \
+                cached_counts[start - cached_start:end - cached_start]
+            offset += end - start
+
     def getCounts(self, contig, ranges, length=0):
         '''count from a set of ranges.
 
@@ -60,9 +295,15 @@ class RangeCounter:
         '''
 
         self.setup(ranges)
-        self.count(self.counts, self.countfiles, contig, ranges)
-        if self.controlfiles:
-            self.count(self.counts_bg, self.controlfiles, contig, ranges)
+        if self.isCached(contig, ranges):
+            self.sliceCache(self.counts, self.cached_counts, ranges)
+            if self.controlfiles:
+                self.sliceCache(self.counts_bg, self.cached_counts_bg,
+                                ranges)
+        else:
+            self.count(self.counts, self.countfiles, contig, ranges)
+            if self.controlfiles:
+                self.count(self.counts_bg, self.controlfiles, contig, ranges)
 
         # subsample for length
         if length > 0:
@@ -100,6 +341,8 @@ class RangeCounterBAM(RangeCounter):
     '''count densities using bam files.
     '''
 
+    use_sweep = True
+
     def getTotal(self, bamfile):
         '''return total number of tags in bedfile.'''
         return bamfile.mapped
@@ -154,6 +397,14 @@ class RangeCounterBAM(RangeCounter):
 
                 current_offset += length
 
+    def sweepFile(self, CoverageBuffer buffer, stream, int index, long end):
+        cdef AlignedSegment read
+        for read in stream.until(end):
+            # skip unmapped reads that are assigend a position.
+            if read.aend is None:
+                continue
+            buffer.add(read.pos, read.aend)
+
     def getTotal(self, samfile):
         '''return total number of mapped tags in samfile.'''
         return samfile.mapped
@@ -164,6 +415,9 @@ class RangeCounterBAMShift(RangeCounterBAM):
 
     Before counting, reads are shifted and extended by a fixed amount.
     '''
+
+    use_sweep = False
+
     def __init__(self, countfiles, shifts, extends, 
                  controlfiles = None,
                  *args, **kwargs ):
@@ -264,6 +518,12 @@ class RangeCounterBAMMerge(RangeCounterBAM):
 
     Reads are not shifted.
     '''
+
+    # reads are fetched per range, so pairs counted within a range
+    # depend on the range boundaries.
+    use_cache = False
+    use_sweep = False
+
     def __init__(self, countfiles,
                  merge_pairs, 
                  min_insert_size, max_insert_size, 
@@ -399,6 +659,11 @@ class RangeCounterBAMBaseAccuracy(RangeCounterBAM):
 
                 current_offset += length
 
+    def sweepFile(self, CoverageBuffer buffer, stream, int index, long end):
+        cdef AlignedSegment read
+        for read in stream.until(end):
+            buffer.addPositions(read.positions)
+
 class RangeCounterBed(RangeCounter):
 
     def __init__(self, *args, **kwargs):
@@ -445,6 +710,9 @@ class RangeCounterBed(RangeCounter):
 
 class RangeCounterBigWig(RangeCounter):
 
+    # wiggle intervals are not truncated at range boundaries.
+    use_cache = False
+
     def __init__(self, *args, **kwargs ):
         RangeCounter.__init__(self, *args, **kwargs )
         
@@ -499,6 +767,11 @@ class IntervalsCounter:
 
     format = "%i"
 
+    # distances counted outside a transcript
+    extension_upstream = 0
+    extension_downstream = 0
+    scale_flanks = 0
+
     def __init__(self, counter, 
                  normalization = None, 
                  outfile_profiles = None,
@@ -555,6 +828,13 @@ class IntervalsCounter:
         '''returns the number of bins in this counter.'''
         return sum(self.nbins )
 
+    def getFlank(self, length):
+        '''return the maximum distance outside of a transcript of
+        *length* that is counted.'''
+        if self.scale_flanks > 0:
+            return length * self.scale_flanks
+        return max(self.extension_upstream, self.extension_downstream)
+
     def closeOutputProfiles( self ):
         if self.outfile_profiles:
             self.outfile_profiles.close()
@@ -684,13 +964,42 @@ class IntervalsCounter:
         
         counted = self.count(gtf)
 
-        if counted and self.outfile_profiles:
-            name = gtf[0].transcript_id
-            self.outfile_profiles.write("%s\t%s\n" % (name,
-                                        "\t".join( [ "\t".join( map(str, x) ) for x in self.last_counts ] ) ) )
+        if counted:
+            self.writeProfile(gtf[0].transcript_id)
         
         return counted
 
+    def writeProfile(self, name):
+        '''output counts of last transcript *name* counted.'''
+        if self.outfile_profiles:
+            self.outfile_profiles.write("%s\t%s\n" % (name,
+                                        "\t".join( [ "\t".join( map(str, x) ) for x in self.last_counts ] ) ) )
+
+    def record(self, gtf):
+        '''count *gtf* and return a record of the changes to this
+        counter.
+
+        The record can be applied to another counter with
+        :meth:`replay`.
+        '''
+        nlengths = [len(x) for x in self.lengths]
+        self.last_counts = None
+        counted = self.count(gtf)
+        return (counted,
+                [x[n:] for x, n in zip(self.lengths, nlengths)],
+                self.last_counts)
+
+    def replay(self, name, record):
+        '''apply *record* of transcript *name* returned by
+        :meth:`record`.'''
+        counted, lengths, counts = record
+        for x, l in zip(self.lengths, lengths):
+            x.extend(l)
+        if counts is not None:
+            self.aggregate(*counts)
+        if counted:
+            self.writeProfile(name)
+
     def __str__(self):
         return "%s=%s" % (self.name, ",".join( [str(sum(x)) for x in self.aggregate_counts]) )
 
@@ -1730,10 +2039,91 @@ class TSSCounter( IntervalsCounter ):
 
         return 1
 
+    def getFlank(self, length):
+        return max(self.extension_out, self.extension_in)
+
+def getRegion(counters, gtf):
+    '''return region covered by *counters* for a transcript *gtf*
+    sorted by start as tuple of (contig, start, end).'''
+    start = gtf[0].start
+    end = max([x.end for x in gtf])
+    flank = max([counter.getFlank(end - start) for counter in counters])
+    return gtf[0].contig, max(0, start - flank), end + flank
+
+
+def iterateRegions(counters, gtf_iterator, sort=False):
+    '''iterate over transcripts in *gtf_iterator* returning tuples
+    of (contig, start, end, gtf), see :func:`getRegion`.
+
+    If *sort* is set, transcripts are returned sorted by region.
+    '''
+    regions = []
+    for gtf in gtf_iterator:
+        gtf.sort( key = lambda x: x.start )
+        region = getRegion(counters, gtf) + (gtf,)
+        if sort:
+            regions.append(region)
+        else:
+            yield region
+
+    if sort:
+        regions.sort(key=lambda x: x[:3])
+        for region in regions:
+            yield region
+
+
+def iterateTranscripts(counters,
+                       gtf_iterator,
+                       use_cache=True,
+                       sweep=False):
+    '''iterate over transcripts in gtf_iterator after setting up
+    coverage for the range counters used by counters.
+
+    If *use_cache* is set, the coverage of each transcript and its
+    flanks is computed once and shared between all counters.
+
+    If *sweep* is set, transcripts are sorted by position and coverage
+    is computed in a single pass along each contig by range counters
+    that support it. Transcripts are then returned in sorted order.
+    '''
+
+    # range counters shared between counters
+    range_counters = []
+    if use_cache or sweep:
+        for counter in counters:
+            if counter.counter not in range_counters:
+                range_counters.append(counter.counter)
+
+    last_contig = None
+    for contig, start, end, gtf in iterateRegions(counters,
+                                                  gtf_iterator,
+                                                  sort=sweep):
+        for range_counter in range_counters:
+            if sweep and range_counter.use_sweep:
+                if contig != last_contig:
+                    range_counter.startSweep(contig, start)
+                range_counter.setSweep(start, end)
+            elif use_cache:
+                range_counter.setCache(contig, start, end)
+        last_contig = contig
+
+        yield gtf
+
+    for range_counter in range_counters:
+        if sweep and range_counter.use_sweep:
+            range_counter.stopSweep()
+        else:
+            range_counter.clearCache()
+
+
 def countFromGTF(counters,
-                 gtf_iterator):
+                 gtf_iterator,
+                 use_cache=True,
+                 sweep=False):
     '''compute counts using counters for
     transcripts in gtf_iterator.
+
+    See :func:`iterateTranscripts` for *use_cache* and *sweep*.
     '''
 
     c = E.Counter()
@@ -1741,12 +2131,14 @@ def countFromGTF(counters,
 
     E.info("starting counting" )
     names = []
-    for iteration, gtf in enumerate(gtf_iterator):
+    for iteration, gtf in enumerate(
+            iterateTranscripts(counters, gtf_iterator,
+                               use_cache=use_cache, sweep=sweep)):
         name = gtf[0].transcript_id
         E.debug( "processing %s" % (name))
         names.append(names)
-        gtf.sort( key = lambda x: x.start )
         c.input += 1
+
         for x, counter in enumerate(counters):
             counter.update( gtf )
             counts[x] += 1
@@ -1758,6 +2150,29 @@ def countFromGTF(counters,
     return names
 
 
+def recordFromGTF(counters,
+                  gtf_iterator,
+                  use_cache=True,
+                  sweep=False):
+    '''count transcripts in gtf_iterator and return a list of
+    tuples of (transcript_id, records) with a record for each counter,
+    see :meth:`IntervalsCounter.record`.
+    '''
+    result = []
+    for gtf in iterateTranscripts(counters, gtf_iterator,
+                                  use_cache=use_cache, sweep=sweep):
+        result.append((gtf[0].transcript_id,
+                       [counter.record(gtf) for counter in counters]))
+    return result
+
+
+def replayRecords(counters, records):
+    '''apply records returned by :func:`recordFromGTF` to counters.'''
+    for name, transcript_records in records:
+        for counter, record in zip(counters, transcript_records):
+            counter.replay(name, record)
+
+
 def countFromCounts( counters,
                      all_counts ):
     '''collect counts from dataframe all_counts
@@ -3,10 +3,10 @@ from pysam.libchtslib cimport *
 from pysam.libcalignmentfile cimport *
 from pysam.libcfaidx cimport *
 from pysam.libcutils cimport force_str, force_bytes
-from libc.string cimport strchr
-from libc.stdint cimport int8_t
-from libc.stdio cimport puts, printf
-import collections, array, struct, sys
+from libc.string cimport strchr, strlen
+from libc.stdint cimport int8_t, uint8_t, uint64_t
+import collections, array, struct, sys, os, tempfile, time
+import numpy
 import CGAT.Experiment as E
 
 import hashlib
@@ -38,12 +38,281 @@ cdef struct CountsType:
     int8_t is_qcfail
     int8_t is_duplicate
 
+# maximum fill of the read name hash table before it is resized
+cdef double MAX_LOAD = 0.7
+
+
+cdef inline uint64_t hashReadName(const char * name, size_t length):
+    '''return 64-bit hash of read name.
+
+    The hash is FNV-1a followed by the finalizer of MurmurHash3. 0 is
+    reserved for empty slots.
+    '''
+    cdef uint64_t h = 14695981039346656037ULL
+    cdef size_t x
+    for x in range(length):
+        h ^= <uint8_t>name[x]
+        h *= 1099511628211ULL
+    h ^= h >> 33
+    h *= 0xff51afd7ed558ccdULL
+    h ^= h >> 33
+    h *= 0xc4ceb1b35a21e6d3ULL
+    h ^= h >> 33
+    if h == 0:
+        h = 1
+    return h
+
+
+cdef class ReadNameIndex:
+    '''index of read names with counts per read.
+
+    Read names are stored as 64-bit hashes in an open addressing hash
+    table with linear probing. The counts for a read are stored
+    alongside in the slot of its hash. A read takes about
+    (8 + sizeof(CountsType)) / MAX_LOAD bytes.
+
+    If *tmpdir* is given, the table is kept in memory mapped files in
+    *tmpdir* instead of in memory.
+    '''
+
+    cdef uint64_t * keys
+    cdef CountsType * counts
+    cdef uint64_t capacity
+    cdef uint64_t mask
+    cdef uint64_t size
+    cdef object keys_array
+    cdef object counts_array
+    cdef object tmpdir
+
+    def __init__(self, capacity=1 << 20, tmpdir=None):
+        self.tmpdir = tmpdir
+        self.size = 0
+        c = 1
+        while c < capacity:
+            c <<= 1
+        self.allocate(c)
+
+    cdef allocate(self, uint64_t capacity):
+        '''allocate an empty table with *capacity* slots.'''
+        self.keys_array = self.createArray((capacity,), numpy.uint64)
+        self.counts_array = self.createArray(
+            (capacity, sizeof(CountsType)), numpy.int8)
+        self.keys = <uint64_t *><size_t>self.keys_array.ctypes.data
+        self.counts = <CountsType *><size_t>self.counts_array.ctypes.data
+        self.capacity = capacity
+        self.mask = capacity - 1
+
+    def createArray(self, shape, dtype):
+        '''return a zero-initialized array, possibly backed by disk.'''
+        if self.tmpdir is None:
+            return numpy.zeros(shape, dtype=dtype)
+        handle, filename = tempfile.mkstemp(dir=self.tmpdir,
+                                            prefix="readnames_")
+        os.close(handle)
+        try:
+            return numpy.memmap(filename, dtype=dtype,
+                                mode="w+", shape=shape)
+        finally:
+            # space is released once the array has been deleted
+            os.unlink(filename)
+
+    cdef resize(self):
+        '''double the size of the table.'''
+        cdef uint64_t * old_keys = self.keys
+        cdef CountsType * old_counts = self.counts
+        cdef uint64_t old_capacity = self.capacity
+        cdef uint64_t x, slot
+        # keep references until copied
+        old_arrays = (self.keys_array, self.counts_array)
+        self.allocate(old_capacity * 2)
+        for x in range(old_capacity):
+            if old_keys[x] == 0:
+                continue
+            slot = old_keys[x] & self.mask
+            while self.keys[slot] != 0:
+                slot = (slot + 1) & self.mask
+            self.keys[slot] = old_keys[x]
+            self.counts[slot] = old_counts[x]
+        del old_arrays
+
+    cdef CountsType * insert(self, const char * name, size_t length):
+        '''add read *name* and return pointer to its counts.'''
+        if self.size + 1 > self.capacity * MAX_LOAD:
+            self.resize()
+        cdef uint64_t h = hashReadName(name, length)
+        cdef uint64_t slot = h & self.mask
+        while self.keys[slot] != 0:
+            if self.keys[slot] == h:
+                return &self.counts[slot]
+            slot = (slot + 1) & self.mask
+        self.keys[slot] = h
+        self.size += 1
+        return &self.counts[slot]
+
+    cdef CountsType * lookup(self, const char * name, size_t length):
+        '''return pointer to counts of read *name* or NULL if
+        the read is not present.'''
+        cdef uint64_t h = hashReadName(name, length)
+        cdef uint64_t slot = h & self.mask
+        while self.keys[slot] != 0:
+            if self.keys[slot] == h:
+                return &self.counts[slot]
+            slot = (slot + 1) & self.mask
+        return NULL
+
+    def add(self, name):
+        '''add read *name* to the index.'''
+        name = force_bytes(name)
+        self.insert(name, len(name))
+
+    def __contains__(self, name):
+        name = force_bytes(name)
+        return self.lookup(name, len(name)) != NULL
+
+    def __len__(self):
+        return self.size
+
+    property nbytes:
+        '''number of bytes used by the table.'''
+        def __get__(self):
+            return self.capacity * (sizeof(uint64_t) + sizeof(CountsType))
+
+
+def iterateReadNames(filename_fastq):
+    '''iterate over the names of the reads in *filename_fastq*.'''
+    cdef FastxRecord fq
+    cdef int chop = 0
+    cdef bint first = True
+
+    for fq in FastxFile(filename_fastq):
+        if first:
+            # chop off /1 or /2 as mappers usually remove these
+            # suffices. Test only the first.
+            name = fq.name
+            if name.endswith("/1") or name.endswith("/2"):
+                chop = -2
+            first = False
+
+        if chop != 0:
+            yield force_bytes(fq.name[:chop])
+        else:
+            yield force_bytes(fq.name)
+
+
+def buildReadNameIndex(filename_fastq, tmpdir=None):
+    '''build a :class:`ReadNameIndex` from the reads in
+    *filename_fastq*.
+
+    returns a tuple with the index and the number of reads in the
+    file.
+    '''
+    cdef int64_t fastq_nreads = 0
+    cdef ReadNameIndex reads = ReadNameIndex(tmpdir=tmpdir)
+    cdef bytes s
+
+    for s in iterateReadNames(filename_fastq):
+        reads.insert(s, len(s))
+        fastq_nreads += 1
+
+    return reads, fastq_nreads
+
+
+def writeDetails(outfile, ReadNameIndex reads, filename_fastq):
+    '''write counts per read in *reads* to *outfile*.
+
+    The read names are not stored in the index, so they are read
+    again from *filename_fastq*. Reads are output in the order of the
+    fastq file and identified by the base64 encoded md5 digest of
+    their name. Duplicate read names are output once.
+    '''
+    cdef bytes name
+    cdef CountsType * fastq_count
+    cdef uint64_t slot
+    cdef uint8_t[:] written = numpy.zeros(reads.capacity, dtype=numpy.uint8)
+
+    outfile.write(
+        "read_md5\tis_unmapped\tmate_is_unmapped\tis_paired\t"
+        "mapped_is_read1\tmapped_is_read2\tis_proper_pair\t"
+        "is_qcfail\tis_duplicate\n")
+
+    for name in iterateReadNames(filename_fastq):
+        fastq_count = reads.lookup(name, len(name))
+        slot = fastq_count - reads.counts
+        if written[slot]:
+            continue
+        written[slot] = 1
+        outfile.write("%s\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i\n" % (
+            force_str(base64.b64encode(hashlib.md5(name).digest())),
+            fastq_count.is_unmapped,
+            fastq_count.mate_is_unmapped,
+            fastq_count.is_paired,
+            fastq_count.mapped_is_read1,
+            fastq_count.mapped_is_read2,
+            fastq_count.is_proper_pair,
+            fastq_count.is_qcfail,
+            fastq_count.is_duplicate))
+
+
+def benchmarkReadNameIndex(filename_fastq, tmpdir=None):
+    '''compare :class:`ReadNameIndex` against a python dictionary
+    of md5 digests for the reads in *filename_fastq*.
+
+    Each index is built from the read names in the fastq file and all
+    reads are looked up once. The memory used by the dictionary is estimated with
+    :func:`sys.getsizeof`.
+
+    returns a list of tuples (method, reads, build time, lookup
+    time, bytes).
+    '''
+    names = [force_bytes(fq.name) for fq in FastxFile(filename_fastq)]
+
+    t = time.time()
+    reads = {}
+    for x, name in enumerate(names):
+        reads[hashlib.md5(name).digest()] = x
+    build_time = time.time() - t
+    t = time.time()
+    for name in names:
+        reads[hashlib.md5(name).digest()]
+    lookup_time = time.time() - t
+    nbytes = sys.getsizeof(reads) + sum(
+        [sys.getsizeof(key) + sys.getsizeof(value)
+         for key, value in reads.items()])
+    results = [("dict", len(reads), build_time, lookup_time, nbytes)]
+    del reads
+
+    cdef ReadNameIndex index = ReadNameIndex(tmpdir=tmpdir)
+    cdef bytes name_bytes
+    t = time.time()
+    for name_bytes in names:
+        index.insert(name_bytes, len(name_bytes))
+    build_time = time.time() - t
+    t = time.time()
+    for name_bytes in names:
+        if index.lookup(name_bytes, len(name_bytes)) == NULL:
+            raise KeyError(name_bytes)
+    lookup_time = time.time() - t
+    results.append(
+        ("ReadNameIndex", len(index), build_time, lookup_time, index.nbytes))
+
+    return results
+
+
 def count(AlignmentFile samfile,
           remove_rna,
           rna,
           filename_fastq=None,
-          outfile_details=None):
-    '''
+          outfile_details=None,
+          tmpdir=None,
+          contig=None,
+          start=None,
+          end=None):
+    '''count alignments in *samfile*.
+
+    If *contig* is given, only alignments in the region *contig*,
+    *start*, *end* are counted. Alignments starting before *start* are
+    ignored, so that consecutive regions count each alignment
+    once. Unplaced reads are counted with *contig* set to ``*``.
     '''
     cdef bint _remove_rna = remove_rna
 
@@ -73,6 +342,7 @@ def count(AlignmentFile samfile,
     # helper variables
     cdef int last_tid = -1
     cdef int last_pos = 0
+    cdef int64_t region_start = -1
 
     duplicates = collections.defaultdict(int)
     counts = collections.defaultdict(int)
@@ -90,58 +360,35 @@ def count(AlignmentFile samfile,
     cdef int f
 
     # detailed counting
-    cdef FastxRecord fq
-    cdef int64_t index, fastq_nreads
-    cdef CountsType * fastq_counts
+    cdef ReadNameIndex reads
+    cdef int64_t fastq_nreads
+    cdef uint64_t index
     cdef CountsType * fastq_count
     cdef char * read_name
     cdef char * position
     cdef int count_fastq = filename_fastq != None
     cdef int fastq_notfound = 0
-    cdef int chop = 0
-    
-    cdef bint is_py3 = sys.version_info.major >= 3
 
     if count_fastq:
         E.info("reading fastq file")
-        # Using a python dictionary here is due
-        # for a large amount of memory usage.
-        # Alternatives to dictionary
-        # 1. POSIX hash tables (hsearch,...) or trees: very slow
-        # 2. custom hash implementation: worth the effort?
-        # 3. Sorted list and binary search: too slow for many lookups
-        reads = {}
-        fastqfile = FastxFile(filename_fastq)
-        fastq_nreads = 0
-        for fq in fastqfile:
-            if fastq_nreads == 0:
-                # chop off /1 or /2 as mappers usually remove these
-                # suffices. Test only the first.
-                name = fq.name
-                if name.endswith("/1") or name.endswith("/2"):
-                    chop = -2
-                
-            if chop != 0:
-                s = fq.name[:chop]
-            else:
-                s = fq.name
+        reads, fastq_nreads = buildReadNameIndex(filename_fastq,
+                                                 tmpdir=tmpdir)
 
-            name = hashlib.md5(force_bytes(s)).digest()
-
-            reads[name] = fastq_nreads
-
-            fastq_nreads += 1
-        
         E.info("read names of %i reads or read pairs" % fastq_nreads)
+        E.info("allocated %i bytes for read name index" % reads.nbytes)
 
-        E.info("allocating %i bytes" % (fastq_nreads * sizeof(CountsType)))
+    if contig is None:
+        alignments = samfile
+    else:
+        alignments = samfile.fetch(contig, start, end)
+        if start is not None:
+            region_start = start
 
-        fastq_counts = <CountsType *>calloc(fastq_nreads, sizeof(CountsType))
-        if fastq_counts == NULL:
-            raise ValueError("could not allocate memory for %i bytes" %
-                             (fastq_nreads * sizeof(CountsType)))
- 
-    for read in samfile:
+    for read in alignments:
+
+        # skip reads counted in the previous region
+        if read._delegate.core.pos < region_start:
+            continue
 
         if count_fastq:
             read_name = pysam_bam_get_qname(read._delegate)
@@ -155,10 +402,8 @@ def count(AlignmentFile samfile,
             if position != NULL: 
                 position[0] = '\0'
 
-            md5 = hashlib.md5(read_name).digest()
-            try:
-                fastq_count = &fastq_counts[reads[md5]]
-            except KeyError:
+            fastq_count = reads.lookup(read_name, strlen(read_name))
+            if fastq_count == NULL:
                 fastq_notfound += 1
                 continue
 
@@ -271,6 +516,7 @@ def count(AlignmentFile samfile,
     for x from 0 <= x < lflags:
         t[FLAGS[f]] = flags_counts[x]
         f = f << 1
+    free(flags_counts)
 
     # count based on fastq data
     cdef int total_paired = 0
@@ -306,8 +552,10 @@ def count(AlignmentFile samfile,
     if count_fastq:
 
         E.info("fastq counting: aggregating counts")
-        for qname, index in reads.items():
-            fastq_count = &fastq_counts[index]
+        for index in range(reads.capacity):
+            if reads.keys[index] == 0:
+                continue
+            fastq_count = &reads.counts[index]
 
             # paired read data
             if fastq_count.is_paired: 
@@ -443,47 +691,7 @@ def count(AlignmentFile samfile,
         counter.total_read2_is_missing = total_read2_is_missing
 
         if outfile_details:
-            if outfile_details != sys.stdout:
-                # later: get access FILE * object
-                outfile_details.write(
-                    "read_md5\tis_unmapped\tmate_is_unmapped\tis_paired\tmapped_is_read1\tmapped_is_read2\tis_proper_pair\tis_qcfail\tis_duplicate\n")
-                for qname, index in reads.items():
-                    fastq_count = &fastq_counts[index]
-                    
-                    # remove "\n" from base64 encoded md5
-                    outfile_details.write("%s\t%s\n" % (
-                        force_str(base64.encodestring(qname)[:-1]),
-                        "\t".join( \
-                                   map(str,
-                                       (fastq_count.is_unmapped,
-                                        fastq_count.mate_is_unmapped,
-                                        fastq_count.is_paired,
-                                        fastq_count.mapped_is_read1,
-                                        fastq_count.mapped_is_read2,
-                                        fastq_count.is_proper_pair,
-                                        fastq_count.is_qcfail,
-                                        fastq_count.is_duplicate
-                                    ) )) ))
-
-            else:
-                # output to stdout much quicker
-                # use puts to avoid the following error:
-                # format not a string literal and no format arguments
-                puts("read\tis_unmapped\tmate_is_unmapped\tis_paired\tmapped_is_read1\tmapped_is_read2\tis_proper_pair\tis_qcfail\tis_duplicate\n")
-                for qname, index in reads.items():
-                    fastq_count = &fastq_counts[index]
-                    read_name = qname
-                    printf("%s\t%i\t%i\t%i\t%i\t%i\t%i\t%i\t%i\n",
-                           read_name,
-                           fastq_count.is_unmapped,
-                           fastq_count.mate_is_unmapped,
-                           fastq_count.is_paired,
-                           fastq_count.mapped_is_read1,
-                           fastq_count.mapped_is_read2,
-                           fastq_count.is_proper_pair,
-                           fastq_count.is_qcfail,
-                           fastq_count.is_duplicate)
-
+            writeDetails(outfile_details, reads, filename_fastq)
 
     return (counter, t, 
             nh_filtered, nh_all, 
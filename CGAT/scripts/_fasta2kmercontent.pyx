@@ -0,0 +1,52 @@
+"""Cython code for fasta2kmercontent.py."""
+
+import numpy
+
+# 2-bit codes of nucleotides, invalid characters are set to 4
+cdef unsigned char ENCODING[256]
+for x in range(256):
+    ENCODING[x] = 4
+for code, nucleotide in enumerate("ACGT"):
+    ENCODING[ord(nucleotide)] = code
+
+
+def encodeKmers(sequence, int kmer_size, bint canonical=False):
+    """return 2-bit packed codes of all kmers in *sequence*.
+
+    The sequence is scanned once, updating the codes of the kmer
+    and of its reverse complement at each position. Kmers
+    containing characters other than upper-case ACGT are skipped.
+
+    If *canonical* is True, the smaller of the code of a kmer and
+    of its reverse complement is returned.
+    """
+    cdef bytes data = sequence.encode("ascii")
+    cdef const unsigned char * s = data
+    cdef Py_ssize_t length = len(data)
+    cdef Py_ssize_t i, n = 0
+    cdef int nvalid = 0
+    cdef unsigned char c
+    cdef unsigned long long forward = 0, reverse = 0
+    cdef unsigned long long mask = (1ULL << (2 * kmer_size)) - 1
+    cdef int shift = 2 * (kmer_size - 1)
+
+    result = numpy.empty(max(length - kmer_size + 1, 0),
+                         dtype=numpy.uint64)
+    cdef unsigned long long[:] codes = result
+
+    for i in range(length):
+        c = ENCODING[s[i]]
+        if c > 3:
+            nvalid = 0
+            continue
+        forward = ((forward << 2) | c) & mask
+        reverse = (reverse >> 2) | (<unsigned long long>(3 - c) << shift)
+        nvalid += 1
+        if nvalid >= kmer_size:
+            if canonical and reverse < forward:
+                codes[n] = reverse
+            else:
+                codes[n] = forward
+            n += 1
+
+    return result[:n]
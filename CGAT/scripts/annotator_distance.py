@@ -23,6 +23,13 @@ observed counts.
 
 The script implements various sampling and counting methods.
 
+Samples are generated with numpy in batches of ``--sample-batch-size``
+permutations. Each batch uses its own random number generator seeded
+from ``--random-seed``, so results are reproducible. With
+``--num-threads`` larger than 1, batches are counted in parallel by a
+pool of worker processes. The results do not depend on the number of
+processes.
+
 Usage
 -----
 
@@ -40,6 +47,7 @@ Command line options
 import os
 import sys
 import collections
+import functools
 import itertools
 import CGAT.GTF as GTF
 import CGAT.Bed as Bed
@@ -252,11 +260,44 @@ def readSegments(infile, indexed_workspace,
     return segments
 
 
+def permuteRows(values, num_samples, rng):
+    """return *num_samples* random permutations of *values*.
+
+    The permutations are returned as rows of a 2D array.
+    """
+    order = numpy.argsort(rng.random_sample((num_samples, len(values))),
+                          axis=1)
+    return numpy.asarray(values)[order]
+
+
+def placeRandomly(lengths, free_length, num_samples, rng):
+    """place fragments of *lengths* (one row per sample) with random
+    gaps between them.
+
+    The free space of *free_length* is split into ``n+1`` randomly
+    sized gaps by uniformly sampling ``n+1`` points. The gaps are
+    then inserted between the fragments.
+
+    returns an array of start positions relative to the workspace
+    start, one row per sample.
+    """
+    num_fragments = lengths.shape[1]
+    points = numpy.sort(
+        rng.randint(0, free_length + 1,
+                    size=(num_samples, num_fragments + 1)),
+        axis=1)[:, :num_fragments]
+    # start of fragment x is the sum of the lengths of the fragments
+    # before it plus the position of its point.
+    return points + numpy.cumsum(lengths, axis=1) - lengths
+
+
 class Sampler(object):
 
     """base clase for objcects that create a sample of
     randomly arranged segments in a workspace.
 
+    Derived classes implement :meth:`sampleMany` to create many samples
+    at once with numpy.
     """
 
     def __init__(self, observed, work_start, work_end):
@@ -273,7 +314,18 @@ class Sampler(object):
              self.mTotalLength, self.mObserved, self.mLengths)
 
     def sample(self):
-        raise NotImplementedError("define sample() in base classes")
+        """return simulated fragments."""
+        starts, ends = self.sampleMany(1, numpy.random)
+        return list(zip(starts[0].tolist(), ends[0].tolist()))
+
+    def sampleMany(self, num_samples, rng):
+        """return *num_samples* simulations using the random number
+        generator *rng*, an instance of :class:`numpy.random.RandomState`.
+
+        returns a tuple of arrays (starts, ends) with one row of sorted
+        fragments per sample.
+        """
+        raise NotImplementedError("define sampleMany() in base classes")
 
 
 class SamplerPermutation(Sampler):
@@ -287,39 +339,62 @@ class SamplerPermutation(Sampler):
 
     """
 
-    def sample(self):
-        """return simulated fragments."""
-        simulated = []
-        # 1. permutate order of segments
-        random.shuffle(self.mLengths)
-        # 2. determine size of space between samples
-        points = []
-        for x in range(len(self.mLengths) + 1):
-            points.append(random.randint(0, self.mFreeLength))
-        points.sort()
-        # 3. move segments to appropriate place
-        start = self.mWorkStart
-        simulated = []
-        last = 0
-        for x in range(len(self.mLengths)):
-            start += points[x] - last
-            simulated.append((start, start + self.mLengths[x]))
-            start += self.mLengths[x]
-            last = points[x]
-
-        assert start + (points[-1] - last) <= self.mWorkEnd, "start=%i, points[-1]=%i, work_end=%i" % \
-            (start, points[-1] - last, self.mWorkEnd)
-
-        return simulated
+    def sampleMany(self, num_samples, rng):
+        lengths = permuteRows(self.mLengths, num_samples, rng)
+        starts = self.mWorkStart + placeRandomly(
+            lengths, self.mFreeLength, num_samples, rng)
+        return starts, starts + lengths
 
 
 class SamplerBlocks(Sampler):
-    """move blocks of fragments to take into account clustering."""
+    """move blocks of fragments to take into account clustering.
 
-    def sample(self):
-        """return simulated fragments."""
-        simulated = []
-        raise NotImplementedError
+    Segments that overlap or are separated by at most *max_gap* bases
+    form a block. Blocks are moved as units like segments in
+    :class:`SamplerPermutation`, preserving the arrangement of the
+    segments within a block.
+    """
+
+    def __init__(self, observed, work_start, work_end, max_gap=0):
+        Sampler.__init__(self, observed, work_start, work_end)
+
+        # assign segments to blocks
+        observed = sorted(observed)
+        block_starts, block_ends, segment_blocks = [], [], []
+        for start, end in observed:
+            if not block_ends or start > block_ends[-1] + max_gap:
+                block_starts.append(start)
+                block_ends.append(end)
+            else:
+                block_ends[-1] = max(block_ends[-1], end)
+            segment_blocks.append(len(block_starts) - 1)
+
+        block_starts = numpy.array(block_starts)
+        self.mSegmentBlocks = numpy.array(segment_blocks)
+        # segment start relative to the start of its block
+        self.mOffsets = numpy.array([x[0] for x in observed]) - \
+            block_starts[self.mSegmentBlocks]
+        self.mSegmentLengths = numpy.array([x[1] - x[0] for x in observed])
+        self.mBlockLengths = numpy.array(block_ends) - block_starts
+        self.mBlockFreeLength = max(
+            0, work_end - work_start - self.mBlockLengths.sum())
+
+    def sampleMany(self, num_samples, rng):
+        num_blocks = len(self.mBlockLengths)
+        order = numpy.argsort(rng.random_sample((num_samples, num_blocks)),
+                              axis=1)
+        placed = self.mWorkStart + placeRandomly(
+            self.mBlockLengths[order], self.mBlockFreeLength,
+            num_samples, rng)
+        # map start of x-th placed block back to its block
+        block_starts = numpy.empty_like(placed)
+        rows = numpy.arange(num_samples)[:, numpy.newaxis]
+        block_starts[rows, order] = placed
+
+        starts = block_starts[:, self.mSegmentBlocks] + self.mOffsets
+        ends = starts + self.mSegmentLengths
+        order = numpy.argsort(starts, axis=1, kind="mergesort")
+        return starts[rows, order], ends[rows, order]
 
 
 class SamplerGaps(Sampler):
@@ -331,21 +406,18 @@ class SamplerGaps(Sampler):
         Sampler.__init__(self, *args, **kwargs)
         self.mGapLengths = [x[1] - x[0]
                             for x in Intervals.complement(self.mObserved, self.mWorkStart, self.mWorkEnd)]
+        # adjacent segments or segments at the workspace boundaries
+        # have empty gaps
+        self.mGapLengths.extend(
+            [0] * (len(self.mLengths) + 1 - len(self.mGapLengths)))
 
-    def sample(self):
-        """return simulated fragments."""
-        simulated = []
-        gaps = self.mGapLengths
-        random.shuffle(gaps)
-
-        start = self.mWorkStart
-
-        for x in range(len(self.mLengths)):
-            start += gaps[x]
-            simulated.append((start, start + self.mLengths[x]))
-            start += self.mLengths[x]
-
-        return simulated
+    def sampleMany(self, num_samples, rng):
+        gaps = permuteRows(self.mGapLengths, num_samples, rng)
+        lengths = numpy.array(self.mLengths)
+        starts = self.mWorkStart + \
+            numpy.cumsum(gaps[:, :len(lengths)], axis=1) + \
+            numpy.cumsum(lengths) - lengths
+        return starts, starts + lengths
 
 
 class CountingResults(object):
@@ -658,6 +730,49 @@ def indexIntervals(intervals, with_values=False):
     return indexed
 
 
+def sampleCounts(workspaces, sampler, counter_factories, num_samples, seed):
+    """count *num_samples* simulations over all *workspaces*.
+
+    *workspaces* is a list of tuples (observed, work_start, work_end,
+    left_labels, right_labels). *sampler* is a callable returning a
+    :class:`Sampler` for a workspace. *counter_factories* is a list of
+    callables creating empty counters.
+
+    The random number generator is seeded with *seed*, so that results
+    only depend on the seed.
+
+    returns a list of simulated counters per counter factory.
+    """
+    rng = numpy.random.RandomState(seed)
+    results = [[factory() for x in range(num_samples)]
+               for factory in counter_factories]
+
+    for (observed, work_start, work_end,
+         left_labels, right_labels) in workspaces:
+        starts, ends = sampler(observed, work_start, work_end).sampleMany(
+            num_samples, rng)
+        for x in range(num_samples):
+            simulated = list(zip(starts[x].tolist(), ends[x].tolist()))
+            for counts in results:
+                counts[x].addCounts(
+                    simulated, work_start, work_end, left_labels, right_labels)
+
+    return results
+
+
+def countBatch(batch):
+    """count a batch of samples in a worker process.
+
+    *batch* is a tuple of (num_samples, seed).
+    """
+    num_samples, seed = batch
+    state = E.WORKER_STATE
+    return sampleCounts(state["workspaces"],
+                        state["sampler"],
+                        state["counter_factories"],
+                        num_samples, seed)
+
+
 def plotCounts(counter, options, transform=lambda x: x):
     """create plots from counter."""
 
@@ -740,7 +855,7 @@ def main(argv=sys.argv):
                       help="labels to use for the workspace workspace [default=%default].")
 
     parser.add_option("--sampler", dest="sampler", type="choice",
-                      choices=("permutation", "gaps"),
+                      choices=("permutation", "gaps", "blocks"),
                       help="sampler to use. The sampler determines the null model of how segments are distributed in the workspace  [default=%default]")
 
     parser.add_option("--counter", dest="counters", type="choice", action="append",
@@ -787,6 +902,22 @@ def main(argv=sys.argv):
     parser.add_option("--keep-ambiguous", dest="keep_ambiguous", action="store_true",
                       help="keep segments extending to more than one workspace [default=%default]")
 
+    parser.add_option("--block-distance", dest="block_distance", type="int",
+                      help="segments separated by at most this distance are "
+                      "moved together with --sampler=blocks "
+                      "[default=%default]")
+
+    parser.add_option("--num-threads", "--num-processes", dest="num_threads",
+                      type="int",
+                      help="number of worker processes computing samples "
+                      "[default=%default]")
+
+    parser.add_option("--sample-batch-size", dest="sample_batch_size",
+                      type="int",
+                      help="number of samples computed together. Each batch "
+                      "uses a separate random number generator "
+                      "[default=%default]")
+
     parser.set_defaults(
         filename_annotations=None,
         filename_workspace="workspace.gff",
@@ -813,6 +944,9 @@ def main(argv=sys.argv):
         hardcopy="%s.png",
         segments_format="gtf",
         remove_overhangs=False,
+        block_distance=0,
+        num_threads=1,
+        sample_batch_size=100,
     )
 
     (options, args) = E.Start(parser, argv=argv, add_output_options=True)
@@ -823,6 +957,9 @@ def main(argv=sys.argv):
         sampler = SamplerPermutation
     elif options.sampler == "gaps":
         sampler = SamplerGaps
+    elif options.sampler == "blocks":
+        sampler = functools.partial(SamplerBlocks,
+                                    max_gap=options.block_distance)
 
     if options.xrange:
         options.xrange = list(map(float, options.xrange.split(",")))
@@ -891,6 +1028,7 @@ def main(argv=sys.argv):
     ###########################################
     # setup counting containers
     counters = []
+    counter_factories = []
     for cc in options.counters:
 
         if cc == "transcription":
@@ -924,20 +1062,16 @@ def main(argv=sys.argv):
                 options.num_bins,
                 ))
 
+        factory = functools.partial(
+            counter, labels, options.num_bins, options.resolution,
+            dtype=dtype)
         c = CountingResults(labels)
-        c.mObservedCounts = counter(
-            labels, options.num_bins, options.resolution, dtype=dtype)
-
-        simulated_counts = []
-        for x in range(options.num_samples):
-            simulated_counts.append(
-                counter(labels, options.num_bins, options.resolution, dtype=dtype))
-        c.mSimulatedCounts = simulated_counts
+        c.mObservedCounts = factory()
+        c.mSimulatedCounts = []
         c.mName = c.mObservedCounts.mName
 
         counters.append(c)
-
-        E.info("allocated memory successfully")
+        counter_factories.append(factory)
 
     segments_per_workspace = []
     segment_sizes = []
@@ -945,7 +1079,8 @@ def main(argv=sys.argv):
     workspaces_per_label = collections.defaultdict(int)
 
     ############################################
-    # get observed and simpulated counts
+    # get observed counts and collect workspaces for sampling
+    sampled_workspaces = []
     nworkspaces, nempty_workspaces, nempty_contigs, nmiddle = 0, 0, 0, 0
     iteration2 = 0
     for contig, vv in workspace.items():
@@ -996,15 +1131,40 @@ def main(argv=sys.argv):
                 counter.mObservedCounts.addCounts(
                     observed, work_start, work_end, left_labels, right_labels)
 
-            # create sampler
-            s = sampler(observed, work_start, work_end)
+            sampled_workspaces.append(
+                (observed, work_start, work_end, left_labels, right_labels))
 
-            # add simulated counts
-            for iteration in range(options.num_samples):
-                simulated = s.sample()
-                for counter in counters:
-                    counter.mSimulatedCounts[iteration].addCounts(
-                        simulated, work_start, work_end, left_labels, right_labels)
+    ############################################
+    # get simulated counts in batches of samples
+    batch_sizes = [min(options.sample_batch_size, options.num_samples - x)
+                   for x in range(0, options.num_samples,
+                                  options.sample_batch_size)]
+    # seeds depend on the python random number generator, which
+    # is initialized with --random-seed
+    batches = [(x, random.randint(0, 2 ** 32 - 1)) for x in batch_sizes]
+
+    E.info("sampling %i samples in %i batches using %i processes" %
+           (options.num_samples, len(batches), options.num_threads))
+
+    if options.num_threads > 1:
+        pool = E.getWorkerPool(options.num_threads,
+                               workspaces=sampled_workspaces,
+                               sampler=sampler,
+                               counter_factories=counter_factories)
+        results = pool.imap(countBatch, batches)
+    else:
+        pool = None
+        results = (sampleCounts(sampled_workspaces, sampler,
+                                counter_factories, num_samples, seed)
+                   for num_samples, seed in batches)
+
+    for batch in results:
+        for counter, simulated_counts in zip(counters, batch):
+            counter.mSimulatedCounts.extend(simulated_counts)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     E.info("counting finished")
     E.info("nworkspaces=%i, nmiddle=%i, nempty_workspaces=%i, nempty_contigs=%i" %
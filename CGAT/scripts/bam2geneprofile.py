@@ -277,6 +277,27 @@ Control
 If control files (chip-seq input tracks) are supplied, counts in the
 control file can be used to compute a fold-change.
 
+Sorted sweep
+++++++++++++
+
+By default, reads are fetched from the :term:`bam` files for each
+transcript separately. If transcripts overlap, as is the case for
+multiple transcripts of a gene, the same regions of the :term:`bam`
+file will be read several times. With the ``--sweep`` option,
+transcripts are sorted by position and each contig is read in a
+single pass while coverage is kept in a window sliding along the
+contig. Transcripts are then processed in sorted order, which affects
+the order of rows in the output of ``--output-all-profiles``.
+
+Multiple processes
+++++++++++++++++++
+
+With ``--num-threads``, transcripts are split into chunks of
+consecutive transcripts on the same contig and counted by several
+worker processes. The counts of each transcript are aggregated in the
+main process in the order of the input, so that the output is the
+same as when counting in a single process.
+
 Bed and wiggle files
 ++++++++++++++++++++
 
@@ -297,6 +318,7 @@ Command line options
 
 import os
 import sys
+import optparse
 import CGAT.Experiment as E
 import CGAT.IOTools as IOTools
 import pysam
@@ -307,6 +329,261 @@ import pandas
 import CGAT.scripts._bam2geneprofile as _bam2geneprofile
 
 
+def buildRangeCounter(options):
+    '''return a range counter for the files given in *options*.'''
+
+    # Select rangecounter based on file type
+    if len(options.infiles) > 0:
+        if options.infiles[0].endswith(".bam"):
+            bamfiles = [pysam.AlignmentFile(x, "rb") for x in options.infiles]
+
+            if options.controlfiles:
+                controlfiles = [pysam.AlignmentFile(x, "rb")
+                                for x in options.controlfiles]
+            else:
+                controlfiles = None
+
+            format = "bam"
+            if options.merge_pairs:
+                range_counter = _bam2geneprofile.RangeCounterBAM(
+                    bamfiles,
+                    shifts=options.shifts,
+                    extends=options.extends,
+                    merge_pairs=options.merge_pairs,
+                    min_insert_size=options.min_insert_size,
+                    max_insert_size=options.max_insert_size,
+                    controfiles=controlfiles,
+                    control_factor=options.control_factor)
+
+            elif options.shifts or options.extends:
+                range_counter = _bam2geneprofile.RangeCounterBAM(
+                    bamfiles,
+                    shifts=options.shifts,
+                    extends=options.extends,
+                    controlfiles=controlfiles,
+                    control_factor=options.control_factor)
+
+            elif options.base_accuracy:
+                range_counter = _bam2geneprofile.RangeCounterBAMBaseAccuracy(
+                    bamfiles,
+                    controlfiles=controlfiles,
+                    control_factor=options.control_factor)
+            else:
+                range_counter = _bam2geneprofile.RangeCounterBAM(
+                    bamfiles,
+                    controlfiles=controlfiles,
+                    control_factor=options.control_factor)
+
+        elif options.infiles[0].endswith(".bed.gz"):
+            bedfiles = [pysam.Tabixfile(x) for x in options.infiles]
+
+            if options.controlfiles:
+                controlfiles = [pysam.Tabixfile(x)
+                                for x in options.controlfiles]
+            else:
+                controlfiles = None
+
+            range_counter = _bam2geneprofile.RangeCounterBed(
+                bedfiles,
+                controlfiles=controlfiles,
+                control_factor=options.control_factor)
+
+        elif options.infiles[0].endswith(".bw"):
+            wigfiles = [BigWigFile(file=open(x)) for x in options.infiles]
+            range_counter = _bam2geneprofile.RangeCounterBigWig(wigfiles)
+
+        else:
+            raise NotImplementedError(
+                "can't determine file type for %s" % str(options.infiles))
+
+    return range_counter
+
+
+def buildCounters(options, range_counter):
+    '''return a list of counters for each method in *options*.'''
+
+    counters = []
+    for method in options.methods:
+        if method == "utrprofile":
+            counters.append(_bam2geneprofile.UTRCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_upstream_utr,
+                options.resolution_cds,
+                options.resolution_downstream_utr,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+            ))
+
+        elif method == "geneprofile":
+            counters.append(_bam2geneprofile.GeneCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+                options.scale_flanks))
+
+        elif method == "geneprofilewithintrons":
+            counters.append(_bam2geneprofile.GeneCounterWithIntrons(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_introns,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream,
+                options.scale_flanks))
+
+        elif method == "geneprofileabsolutedistancefromthreeprimeend":
+            # options.extension_exons_absolute_distance_tostartsite,
+            # options.extension_introns_absolute_distance_tostartsite,
+            # Tim 31th Aug 2013: a possible feature for future,  if five prime
+            # bias is of your interest.
+            # (you need to create another class). It is not very difficult to
+            # derive from this class, but is not implemented yet
+            # This future feature is slightly different the TSS profile
+            # already implemented, because in this future feature introns are
+            # skipped,
+            counters.append(
+                _bam2geneprofile.GeneCounterAbsoluteDistanceFromThreePrimeEnd(
+                    range_counter, options.resolution_upstream,
+                    options.resolution_downstream,
+                    options.resolution_exons_absolute_distance_topolya,
+                    options.resolution_introns_absolute_distance_topolya,
+                    options.extension_upstream,
+                    options.extension_downstream,
+                    options.extension_exons_absolute_distance_topolya,
+                    options.extension_introns_absolute_distance_topolya,
+                    options.scale_flanks))
+
+        elif method == "tssprofile":
+            counters.append(_bam2geneprofile.TSSCounter(
+                range_counter,
+                options.extension_outward,
+                options.extension_inward))
+
+        elif method == "intervalprofile":
+            counters.append(_bam2geneprofile.RegionCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        elif method == "midpointprofile":
+            counters.append(_bam2geneprofile.MidpointCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        # add new method to split 1st and last exons out
+        # requires a representative transcript for reach gene
+        # gtf should be sorted gene-position
+        elif method == "separateexonprofile":
+            counters.append(_bam2geneprofile.SeparateExonCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_first,
+                options.resolution_last,
+                options.resolution_cds,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+        elif method == "separateexonprofilewithintrons":
+            counters.append(_bam2geneprofile.SeparateExonWithIntronCounter(
+                range_counter,
+                options.resolution_upstream,
+                options.resolution_first,
+                options.resolution_last,
+                options.resolution_cds,
+                options.resolution_introns,
+                options.resolution_downstream,
+                options.extension_upstream,
+                options.extension_downstream))
+
+    return counters
+
+
+def buildWorkerCounters(state):
+    '''build counters in a worker process from option values in
+    *state*.'''
+    options = optparse.Values(state["options"])
+    range_counter = buildRangeCounter(options)
+    counters = buildCounters(options, range_counter)
+    for c in counters:
+        c.setNormalization(options.transcript_normalization)
+    state["counters"] = counters
+
+
+def countChunk(chunk):
+    '''count transcripts in *chunk* in a worker process.'''
+    state = E.WORKER_STATE
+    return _bam2geneprofile.recordFromGTF(state["counters"],
+                                          chunk,
+                                          sweep=state["options"]["sweep"])
+
+
+def iterateChunks(gtf_iterator, chunk_size):
+    '''group consecutive transcripts in *gtf_iterator* on the same
+    contig into chunks of at most *chunk_size* transcripts.
+
+    GTF entries are converted to :class:`GTF.Entry` objects so that
+    they can be sent to worker processes.
+    '''
+    chunk = []
+    for gtf in gtf_iterator:
+        gtf = [GTF.Entry().fromGTF(x) for x in gtf]
+        if chunk and (len(chunk) >= chunk_size or
+                      gtf[0].contig != chunk[0][0].contig):
+            yield chunk
+            chunk = []
+        chunk.append(gtf)
+    if chunk:
+        yield chunk
+
+
+def countParallel(counters, gtf_iterator, options, range_counter,
+                  chunk_size=1000):
+    '''count transcripts in *gtf_iterator* with *options.num_threads*
+    worker processes.
+
+    Each worker counts a chunk of transcripts with its own set of
+    counters and returns the counts for each transcript. These are
+    then aggregated into *counters* in input order, so that the
+    output is identical to counting in a single process.
+    '''
+
+    # file handles can not be sent to worker processes
+    kwargs = dict([(key, value) for key, value in list(vars(options).items())
+                   if key not in ("stdin", "stdout", "stdlog", "stderr",
+                                  "gtffile")])
+    # avoid re-computing the normalization factor in each worker
+    kwargs["control_factor"] = range_counter.control_factor
+
+    if options.sweep:
+        gtf_iterator = (x[-1] for x in _bam2geneprofile.iterateRegions(
+            counters, gtf_iterator, sort=True))
+
+    E.info("counting with %i processes" % options.num_threads)
+    pool = E.getWorkerPool(options.num_threads,
+                           initializer=buildWorkerCounters,
+                           options=kwargs)
+    try:
+        for records in pool.imap(countChunk,
+                                 iterateChunks(gtf_iterator, chunk_size)):
+            _bam2geneprofile.replayRecords(counters, records)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def main(argv=None):
     """script main.
 
@@ -522,6 +799,18 @@ def main(argv=None):
                       "from previously computed counts "
                       "[%default]")
 
+    parser.add_option(
+        "--sweep", dest="sweep", action="store_true",
+        help="sort transcripts by position and compute coverage "
+        "in a single pass along each contig. Only applies to "
+        ":term:`bam` formatted files "
+        "[%default]")
+
+    parser.add_option(
+        "--num-threads", "--threads", dest="num_threads", type="int",
+        help="number of processes to use for counting "
+        "[%default]")
+
     parser.add_option(
         "--background-region-bins",
         dest="background_region_bins",
@@ -579,6 +868,8 @@ def main(argv=None):
         output_all_profiles=False,
         background_region_bins=10,
         input_filename_counts=None,
+        sweep=False,
+        num_threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -617,175 +908,8 @@ def main(argv=None):
     elif options.reporter == "transcript":
         gtf_iterator = GTF.transcript_iterator(GTF.iterator(options.gtffile))
 
-    # Select rangecounter based on file type
-    if len(options.infiles) > 0:
-        if options.infiles[0].endswith(".bam"):
-            bamfiles = [pysam.AlignmentFile(x, "rb") for x in options.infiles]
-
-            if options.controlfiles:
-                controlfiles = [pysam.AlignmentFile(x, "rb")
-                                for x in options.controlfiles]
-            else:
-                controlfiles = None
-
-            format = "bam"
-            if options.merge_pairs:
-                range_counter = _bam2geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    shifts=options.shifts,
-                    extends=options.extends,
-                    merge_pairs=options.merge_pairs,
-                    min_insert_size=options.min_insert_size,
-                    max_insert_size=options.max_insert_size,
-                    controfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-            elif options.shifts or options.extends:
-                range_counter = _bam2geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    shifts=options.shifts,
-                    extends=options.extends,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-            elif options.base_accuracy:
-                range_counter = _bam2geneprofile.RangeCounterBAMBaseAccuracy(
-                    bamfiles,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-            else:
-                range_counter = _bam2geneprofile.RangeCounterBAM(
-                    bamfiles,
-                    controlfiles=controlfiles,
-                    control_factor=options.control_factor)
-
-        elif options.infiles[0].endswith(".bed.gz"):
-            bedfiles = [pysam.Tabixfile(x) for x in options.infiles]
-
-            if options.controlfiles:
-                controlfiles = [pysam.Tabixfile(x)
-                                for x in options.controlfiles]
-            else:
-                controlfiles = None
-
-            range_counter = _bam2geneprofile.RangeCounterBed(
-                bedfiles,
-                controlfiles=controlfiles,
-                control_factor=options.control_factor)
-
-        elif options.infiles[0].endswith(".bw"):
-            wigfiles = [BigWigFile(file=open(x)) for x in options.infiles]
-            range_counter = _bam2geneprofile.RangeCounterBigWig(wigfiles)
-
-        else:
-            raise NotImplementedError(
-                "can't determine file type for %s" % str(options.infiles))
-
-    counters = []
-    for method in options.methods:
-        if method == "utrprofile":
-            counters.append(_bam2geneprofile.UTRCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_upstream_utr,
-                options.resolution_cds,
-                options.resolution_downstream_utr,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-            ))
-
-        elif method == "geneprofile":
-            counters.append(_bam2geneprofile.GeneCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-                options.scale_flanks))
-
-        elif method == "geneprofilewithintrons":
-            counters.append(_bam2geneprofile.GeneCounterWithIntrons(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_introns,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream,
-                options.scale_flanks))
-
-        elif method == "geneprofileabsolutedistancefromthreeprimeend":
-            # options.extension_exons_absolute_distance_tostartsite,
-            # options.extension_introns_absolute_distance_tostartsite,
-            # Tim 31th Aug 2013: a possible feature for future,  if five prime
-            # bias is of your interest.
-            # (you need to create another class). It is not very difficult to
-            # derive from this class, but is not implemented yet
-            # This future feature is slightly different the TSS profile
-            # already implemented, because in this future feature introns are
-            # skipped,
-            counters.append(
-                _bam2geneprofile.GeneCounterAbsoluteDistanceFromThreePrimeEnd(
-                    range_counter, options.resolution_upstream,
-                    options.resolution_downstream,
-                    options.resolution_exons_absolute_distance_topolya,
-                    options.resolution_introns_absolute_distance_topolya,
-                    options.extension_upstream,
-                    options.extension_downstream,
-                    options.extension_exons_absolute_distance_topolya,
-                    options.extension_introns_absolute_distance_topolya,
-                    options.scale_flanks))
-
-        elif method == "tssprofile":
-            counters.append(_bam2geneprofile.TSSCounter(
-                range_counter,
-                options.extension_outward,
-                options.extension_inward))
-
-        elif method == "intervalprofile":
-            counters.append(_bam2geneprofile.RegionCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-        elif method == "midpointprofile":
-            counters.append(_bam2geneprofile.MidpointCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-        # add new method to split 1st and last exons out
-        # requires a representative transcript for reach gene
-        # gtf should be sorted gene-position
-        elif method == "separateexonprofile":
-            counters.append(_bam2geneprofile.SeparateExonCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_first,
-                options.resolution_last,
-                options.resolution_cds,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
-
-        elif method == "separateexonprofilewithintrons":
-            counters.append(_bam2geneprofile.SeparateExonWithIntronCounter(
-                range_counter,
-                options.resolution_upstream,
-                options.resolution_first,
-                options.resolution_last,
-                options.resolution_cds,
-                options.resolution_introns,
-                options.resolution_downstream,
-                options.extension_upstream,
-                options.extension_downstream))
+    range_counter = buildRangeCounter(options)
+    counters = buildCounters(options, range_counter)
 
     # set normalization
     for c in counters:
@@ -811,8 +935,12 @@ def main(argv=None):
 
     else:
         E.info("starting counting with %i counters" % len(counters))
-        feature_names = _bam2geneprofile.countFromGTF(counters,
-                                                      gtf_iterator)
+        if options.num_threads > 1:
+            countParallel(counters, gtf_iterator, options, range_counter)
+        else:
+            _bam2geneprofile.countFromGTF(counters,
+                                          gtf_iterator,
+                                          sweep=options.sweep)
 
     # output matrices
     if not options.profile_normalizations:
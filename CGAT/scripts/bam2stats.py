@@ -100,9 +100,10 @@ Supplying a fastq file
 ++++++++++++++++++++++
 
 If a fastq file is supplied (``--fastq-file``), the script will
-compute some additional summary statistics. However, as it builds a dictionary
-of all sequences, it will also require a good  amount of memory. The additional
-metrics output are:
+compute some additional summary statistics. The script builds a hash
+table of all read names, which requires 30 to 55 bytes per read. With
+``--temp-dir``, the table is kept in memory mapped files in the given
+directory instead of in memory. The additional metrics output are:
 
 +-----------------------------+----------------------------------------+
 |*Category*                   |*Content*                               |
@@ -258,6 +259,12 @@ Bam2stats can read from standard input::
 
    cat in.bam | python bam2stats.py -
 
+Indexed BAM files can be counted in parallel with ``--num-threads``.
+The genome is split into regions of at most ``--shard-size`` bases,
+which are counted in separate processes. Unplaced reads are counted
+in a separate region. The output is identical to counting in a single
+process. The option is ignored if ``--fastq-file`` is given.
+
 
 Documentation
 -------------
@@ -288,12 +295,93 @@ Command line options
 
 import os
 import sys
+import collections
 import CGAT.Experiment as E
 import CGAT.IOTools as IOTools
 import CGAT.GTF as GTF
 import pysam
 import CGAT.scripts._bam2stats as _bam2stats
 
+
+def openWorkerFile(state):
+    """open the bam file in a worker process."""
+    state["samfile"] = pysam.AlignmentFile(state["filename"], "rb")
+
+
+def countShard(shard):
+    """count alignments in region *shard* (contig, start, end)."""
+    contig, start, end = shard
+    state = E.WORKER_STATE
+    result = _bam2stats.count(state["samfile"],
+                              state["remove_rna"],
+                              state["rna"],
+                              contig=contig, start=start, end=end)
+    # return counter as dictionary for pickling
+    return (dict(result[0].items()),) + result[1:]
+
+
+def getShards(samfile, shard_size):
+    """return list of regions (contig, start, end) covering all
+    alignments in *samfile*.
+
+    Contigs are split into regions of at most *shard_size* bases.
+    Contigs without alignments are skipped. The last region contains
+    the unplaced reads.
+    """
+    stats = dict((x.contig, x.total) for x in samfile.get_index_statistics())
+    shards = []
+    for contig, length in zip(samfile.references, samfile.lengths):
+        if stats.get(contig, 0) == 0:
+            continue
+        for start in range(0, length, shard_size):
+            shards.append((contig, start, min(length, start + shard_size)))
+    shards.append(("*", None, None))
+    return shards
+
+
+def countParallel(filename, remove_rna, rna, num_threads, shard_size):
+    """count alignments in *filename* in *num_threads* processes.
+
+    returns the same tuple as :func:`_bam2stats.count`.
+    """
+    samfile = pysam.AlignmentFile(filename, "rb")
+    if not samfile.has_index():
+        raise ValueError(
+            "counting with multiple processes requires an indexed bam file")
+    shards = getShards(samfile, shard_size)
+    samfile.close()
+
+    E.info("counting %i regions with %i processes" %
+           (len(shards), num_threads))
+
+    counter = E.Counter()
+    flags_counts = collections.defaultdict(int)
+    histograms = [collections.defaultdict(int) for x in range(6)]
+    max_hi = 0
+
+    pool = E.getWorkerPool(num_threads,
+                           initializer=openWorkerFile,
+                           filename=filename,
+                           remove_rna=remove_rna,
+                           rna=rna)
+
+    for result in pool.imap(countShard, shards):
+        counts, flags, histogram_list, hi = \
+            result[0], result[1], result[2:8], result[8]
+        counter += counts
+        for key, value in flags.items():
+            flags_counts[key] += value
+        for histogram, values in zip(histograms, histogram_list):
+            for key, value in values.items():
+                histogram[key] += value
+        max_hi = max(max_hi, hi)
+
+    pool.close()
+    pool.join()
+
+    return (counter, dict(flags_counts)) + tuple(histograms) + (max_hi,)
+
+
 FLAGS = {
     1: 'paired',
     2: 'proper_pair',
@@ -394,6 +482,21 @@ def main(argv=None):
         "used to collect sequence identifiers. Thus, for paired end data a "
         "single file is sufficient [%default]")
 
+    parser.add_option(
+        "--num-threads", "--threads", dest="num_threads", type="int",
+        help="number of processes to use for counting an indexed bam "
+        "file [%default]")
+
+    parser.add_option(
+        "--shard-size", dest="shard_size", type="int",
+        help="maximum size of regions counted in a process with "
+        "--num-threads [%default]")
+
+    parser.add_option(
+        "--temp-dir", dest="tmpdir", type="string",
+        help="keep the index of read names for --fastq-file in memory "
+        "mapped files in this directory instead of in memory [%default]")
+
     parser.set_defaults(
         filename_rna=None,
         remove_rna=False,
@@ -401,6 +504,9 @@ def main(argv=None):
         force_output=False,
         filename_fastq=None,
         output_details=False,
+        tmpdir=None,
+        num_threads=1,
+        shard_size=10000000,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -427,13 +533,28 @@ def main(argv=None):
     if options.filename_fastq and not os.path.exists(options.filename_fastq):
         raise IOError("file %s does not exist" % options.filename_fastq)
 
+    if options.num_threads > 1 and options.filename_fastq:
+        E.warn("--num-threads is ignored when counting with --fastq-file")
+    elif options.num_threads > 1 and len(args) == 0:
+        E.warn("--num-threads requires an indexed bam file as argument")
+
+    if options.num_threads > 1 and len(args) > 0 and \
+       not options.filename_fastq:
+        result = countParallel(args[0],
+                               options.remove_rna,
+                               rna,
+                               options.num_threads,
+                               options.shard_size)
+    else:
+        result = _bam2stats.count(pysam_in,
+                                  options.remove_rna,
+                                  rna,
+                                  filename_fastq=options.filename_fastq,
+                                  outfile_details=outfile_details,
+                                  tmpdir=options.tmpdir)
+
     (counter, flags_counts, nh_filtered, nh_all,
-     nm_filtered, nm_all, mapq, mapq_all, max_hi) = \
-        _bam2stats.count(pysam_in,
-                         options.remove_rna,
-                         rna,
-                         filename_fastq=options.filename_fastq,
-                         outfile_details=outfile_details)
+     nm_filtered, nm_all, mapq, mapq_all, max_hi) = result[:9]
 
     if max_hi > 0 and max_hi != max(nh_all.keys()):
         E.warn("max_hi(%i) is inconsistent with max_nh (%i) "
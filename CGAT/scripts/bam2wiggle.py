@@ -27,6 +27,19 @@ amount.
 For RNASEQ data it might be best to run genomeCoverageBed directly on
 the bam file.
 
+With ``--method=array``, coverage is computed in-process without
+temporary files or external tools. Aligned blocks of reads (or
+shifted/extended reads or merged pairs) are collected per contig
+and turned into run-length encoded coverage with numpy. The result
+is written directly as :term:`bedGraph`, wiggle or :term:`bigwig`
+(through pyBigWig). Reads are filtered as in the pileup method:
+unmapped, secondary, qc-failed, duplicate and orphan reads are
+skipped and bases covered by both mates of a pair are counted
+twice. Deletions count towards coverage, but introns do not. The
+method supports ``--scale-method`` for all input types and
+processes contigs in parallel with ``--num-threads``. If only
+``--shift-size`` is given, reads keep their aligned length.
+
 Usage
 -----
 
@@ -49,9 +62,11 @@ import sys
 import tempfile
 import shutil
 import subprocess
+import numpy
 import CGAT.Experiment as E
 import pysam
 import CGAT.IOTools as IOTools
+import CGAT.BamTools as BamTools
 import CGAT.scripts._bam2bed as _bam2bed
 
 
@@ -144,6 +159,327 @@ class SpanWriter(object):
                 self.val / (self.lastend % self.span)))
 
 
+def openWorkerFile(state):
+    """open the bam file in a worker process."""
+    state["samfile"] = pysam.AlignmentFile(state["filename"], "rb")
+
+
+class IntervalBuffer(object):
+    """collect intervals in numpy arrays.
+
+    Intervals are added to a list of at most *chunk_size* positions
+    that is converted into arrays once full, so that memory does
+    not grow by a python object for each interval.
+    """
+
+    def __init__(self, chunk_size=100000):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.starts, self.ends = [], []
+
+    def flush(self):
+        if self.starts:
+            self.chunks.append((numpy.array(self.starts, dtype=numpy.int64),
+                                numpy.array(self.ends, dtype=numpy.int64)))
+            self.starts, self.ends = [], []
+
+    def add(self, start, end):
+        self.starts.append(start)
+        self.ends.append(end)
+        if len(self.starts) >= self.chunk_size:
+            self.flush()
+
+    def getArrays(self):
+        """return a tuple of arrays (starts, ends)."""
+        self.flush()
+        if not self.chunks:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return empty, empty
+        starts, ends = zip(*self.chunks)
+        self.chunks = []
+        return numpy.concatenate(starts), numpy.concatenate(ends)
+
+
+def getReadIntervals(samfile, contig,
+                     shift=0,
+                     extend=0,
+                     merge_pairs=False,
+                     min_insert_size=0,
+                     max_insert_size=0):
+    """return intervals covered by reads on *contig*.
+
+    Intervals are the aligned blocks of reads including deletions
+    and split at introns. If *shift* or *extend* are given, a single
+    interval per read is shifted and extended. If *merge_pairs* is
+    set, a single interval spans each read pair. Reads are filtered
+    as by pysam's pileup.
+
+    returns a tuple of arrays (starts, ends) and the number of reads
+    used.
+    """
+    intervals = IntervalBuffer()
+    add = intervals.add
+    nreads = 0
+
+    for read in samfile.fetch(contig):
+        flag = read.flag
+        # skip filtered reads and orphans as pileup does
+        if flag & BamTools.PILEUP_FILTER_FLAGS or \
+           (flag & 1 and not flag & 2):
+            continue
+
+        if merge_pairs:
+            # same rules as _bam2bed.merge_pairs: use the downstream
+            # read of a properly paired read pair
+            if read.pos < read.mpos:
+                continue
+            elif read.pos == read.mpos and flag & 64:
+                continue
+            if not flag & 2 or read.tid != read.mrnm:
+                continue
+            isize = abs(read.isize)
+            if (max_insert_size and isize > max_insert_size) or \
+               (min_insert_size and isize < min_insert_size):
+                continue
+            xstart, xend = read.next_reference_start, read.reference_end
+            add(min(xstart, xend), max(xstart, xend))
+            # count pair as two reads for scaling
+            nreads += 2
+        elif shift or extend:
+            length = extend or read.alen
+            if read.is_reverse:
+                start = read.pos + read.alen - shift - length
+            else:
+                start = read.pos + shift
+            add(start, start + length)
+            nreads += 1
+        else:
+            # pileup counts deletions (D) but not introns (N)
+            start = end = read.pos
+            for op, length in read.cigartuples:
+                if op == 3:
+                    add(start, end)
+                    start = end = end + length
+                elif op in (0, 2, 7, 8):
+                    end += length
+            add(start, end)
+            nreads += 1
+
+    starts, ends = intervals.getArrays()
+    return starts, ends, nreads
+
+
+def buildCoverageRuns(starts, ends):
+    """return run-length encoded coverage of intervals.
+
+    Coverage is computed from a difference array that contains the
+    positions where the coverage changes.
+
+    returns a tuple of arrays (starts, ends, values) with the runs
+    of non-zero coverage.
+    """
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, empty
+
+    positions = numpy.concatenate((starts, ends))
+    deltas = numpy.concatenate((numpy.ones(len(starts), dtype=numpy.int64),
+                                -numpy.ones(len(ends), dtype=numpy.int64)))
+    order = numpy.argsort(positions, kind="mergesort")
+    positions, deltas = positions[order], deltas[order]
+
+    # collapse changes at the same position
+    first = numpy.concatenate(
+        ([0], numpy.flatnonzero(numpy.diff(positions)) + 1))
+    breaks = positions[first]
+    levels = numpy.cumsum(numpy.add.reduceat(deltas, first))[:-1]
+
+    # merge adjacent runs with the same coverage
+    changed = numpy.concatenate(([True], levels[1:] != levels[:-1]))
+    run_starts = breaks[:-1][changed]
+    run_ends = numpy.append(run_starts[1:], breaks[-1])
+    values = levels[changed]
+
+    keep = values != 0
+    return run_starts[keep], run_ends[keep], values[keep]
+
+
+def buildWindowMeans(starts, ends, values, span, size):
+    """return mean coverage in windows of *span* bases.
+
+    Only windows overlapping runs in *starts*, *ends* and *values*
+    are returned. Windows are truncated at *size*.
+
+    returns a tuple of arrays (starts, ends, values).
+    """
+    if len(starts) == 0:
+        return starts, ends, values.astype(numpy.float64)
+
+    first = starts // span
+    nwindows = (ends - 1) // span - first + 1
+    offsets = numpy.cumsum(nwindows) - nwindows
+    run = numpy.repeat(numpy.arange(len(starts)), nwindows)
+    window = first[run] + numpy.arange(nwindows.sum()) - offsets[run]
+
+    window_starts = window * span
+    overlap = numpy.minimum(ends[run], window_starts + span) - \
+        numpy.maximum(starts[run], window_starts)
+    # windows increase monotonically as runs are sorted
+    first = numpy.concatenate(
+        ([0], numpy.flatnonzero(numpy.diff(window)) + 1))
+    sums = numpy.add.reduceat(overlap * values[run], first)
+    window_starts = window_starts[first]
+    return (window_starts,
+            numpy.minimum(window_starts + span, size),
+            sums / float(span))
+
+
+def computeContigCoverage(samfile, contig, **kwargs):
+    """compute run-length encoded coverage for *contig*.
+
+    Further keyword arguments are passed to :func:`getReadIntervals`.
+
+    returns a tuple (contig, starts, ends, values, nreads).
+    """
+    size = samfile.get_reference_length(contig)
+    starts, ends, nreads = getReadIntervals(samfile, contig, **kwargs)
+
+    # intervals extending beyond the contig are truncated
+    starts = numpy.clip(starts, 0, size)
+    ends = numpy.clip(ends, 0, size)
+
+    starts, ends, values = buildCoverageRuns(starts, ends)
+    return contig, starts, ends, values, nreads
+
+
+def computeWorkerCoverage(contig):
+    """compute coverage for *contig* in a worker process."""
+    state = E.WORKER_STATE
+    return computeContigCoverage(state["samfile"], contig, **state["kwargs"])
+
+
+def iterateCoverage(filename, contigs, num_threads=1, **kwargs):
+    """iterate over coverage of *contigs* in bam file *filename*.
+
+    Contigs are processed in *num_threads* processes. Results are
+    returned in the order of *contigs*. Further keyword arguments are
+    passed to :func:`getReadIntervals`.
+    """
+    if num_threads > 1:
+        E.info("computing coverage for %i contigs with %i processes" %
+               (len(contigs), num_threads))
+        pool = E.getWorkerPool(num_threads,
+                               initializer=openWorkerFile,
+                               filename=filename,
+                               kwargs=kwargs)
+        for result in pool.imap(computeWorkerCoverage, contigs):
+            yield result
+        pool.close()
+        pool.join()
+    else:
+        samfile = pysam.AlignmentFile(filename, "rb")
+        for contig in contigs:
+            yield computeContigCoverage(samfile, contig, **kwargs)
+
+
+def writeCoverage(samfile, options):
+    """compute coverage of reads in ``options.samfile`` and write it
+    in ``options.output_format``.
+
+    bigwig files are written to ``options.output_filename_pattern``,
+    all other formats to stdout.
+    """
+    contigs = list(samfile.references)
+    contig_sizes = dict(zip(samfile.references, samfile.lengths))
+
+    results = iterateCoverage(options.samfile,
+                              contigs,
+                              num_threads=options.num_threads,
+                              shift=options.shift,
+                              extend=options.extend,
+                              merge_pairs=options.merge_pairs,
+                              min_insert_size=options.min_insert_size,
+                              max_insert_size=options.max_insert_size)
+
+    scale_factor = None
+    if options.scale_method == "reads":
+        # scaling requires the total number of reads before output
+        results = list(results)
+        nreads = sum(x[4] for x in results)
+        if nreads == 0:
+            raise ValueError("no reads output for scaling")
+        scale_factor = float(options.scale_base) / nreads
+        E.info("scaling: method=%s scale_quantity=%i scale_factor=%f" %
+               (options.scale_method, nreads, scale_factor))
+
+    span = options.span
+    output_format = options.output_format
+    if output_format == "bigwig":
+        import pyBigWig
+        outfile = pyBigWig.open(options.output_filename_pattern, "w")
+        outfile.addHeader(list(zip(samfile.references, samfile.lengths)))
+    else:
+        outfile = options.stdout
+        if output_format == "bedgraph":
+            outfile.write("track type=bedGraph\n")
+
+    counter = E.Counter()
+    for contig, starts, ends, values, nreads in results:
+        counter.contigs += 1
+        counter.reads += nreads
+        if scale_factor is not None:
+            values = values * scale_factor
+
+        if span > 1 and output_format != "bedgraph":
+            starts, ends, values = buildWindowMeans(
+                starts, ends, values, span, contig_sizes[contig])
+
+        counter.runs += len(starts)
+        if len(starts) == 0:
+            continue
+
+        if output_format == "bigwig":
+            outfile.addEntries([contig] * len(starts),
+                               starts.tolist(),
+                               ends=ends.tolist(),
+                               values=values.astype(numpy.float64).tolist())
+        elif output_format == "bedgraph":
+            if values.dtype.kind == "f":
+                pattern = "%s\t%i\t%i\t%f\n"
+            else:
+                pattern = "%s\t%i\t%i\t%i\n"
+            outfile.write("".join(
+                [pattern % (contig, x, y, v)
+                 for x, y, v in zip(starts.tolist(), ends.tolist(),
+                                    values.tolist())]))
+        else:
+            outfile.write("variableStep chrom=%s span=%i\n" %
+                          (contig, span))
+            if span == 1:
+                # wiggle is one-based, output all bases in runs
+                lengths = ends - starts
+                positions = numpy.arange(lengths.sum()) + 1 + \
+                    numpy.repeat(starts - (numpy.cumsum(lengths) - lengths),
+                                 lengths)
+                values = numpy.repeat(values, lengths)
+            else:
+                positions = starts + 1
+            if values.dtype.kind == "f":
+                pattern = "%i\t%f\n"
+            else:
+                pattern = "%i\t%i\n"
+            outfile.write("".join(
+                [pattern % x
+                 for x in zip(positions.tolist(), values.tolist())]))
+
+    if output_format == "bigwig":
+        outfile.close()
+
+    E.info(str(counter))
+
+
 def main(argv=None):
     """script main.
     """
@@ -163,6 +499,13 @@ def main(argv=None):
                           "bigwig", "bed"),
                       help="output format [default=%default]")
 
+    parser.add_option("--method", dest="method", type="choice",
+                      choices=("pileup", "array"),
+                      help="method to compute coverage. 'pileup' uses "
+                      "pysam's pileup and external tools, 'array' "
+                      "computes coverage in-process from read "
+                      "blocks [default=%default]")
+
     parser.add_option("-s", "--shift-size", dest="shift", type="int",
                       help="shift reads by a certain amount (ChIP-Seq) "
                       "[%default]")
@@ -206,6 +549,11 @@ def main(argv=None):
                       "at least # bases apart. "
                       "0 turns of this filter. [default=%default]")
 
+    parser.add_option("--num-threads", "--threads", dest="num_threads",
+                      type="int",
+                      help="number of processes to compute coverage "
+                      "with --method=array [default=%default]")
+
     parser.set_defaults(
         samfile=None,
         output_format="wiggle",
@@ -217,6 +565,8 @@ def main(argv=None):
         max_insert_size=0,
         scale_method='none',
         scale_base=1000000,
+        method="pileup",
+        num_threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -232,6 +582,19 @@ def main(argv=None):
     # Read BAM file using Pysam
     samfile = pysam.AlignmentFile(options.samfile, "rb")
 
+    if options.method == "array":
+        if options.output_format not in ("bedgraph", "wiggle", "bigwig"):
+            raise ValueError(
+                "output format `%s` not available for array method" %
+                options.output_format)
+        if options.output_format == "bigwig" and \
+           not options.output_filename_pattern:
+            raise ValueError(
+                "please specify an output file for bigwig computation.")
+        writeCoverage(samfile, options)
+        E.Stop()
+        return
+
     # Create temporary files / folders
     tmpdir = tempfile.mkdtemp()
     E.debug("temporary files are in %s" % tmpdir)
@@ -35,6 +35,16 @@ fasta except those with no coverage in the input BAMs.
 
 At present the --interval or -i option has not been implemented.
 
+By default, coverage is computed with pysam's pileup and collected
+in a dictionary. With ``--method=matrix``, coverage is computed in
+windows of ``--window-size`` bases. Each window is stored as an array
+with one column per file, and only positions with coverage are
+output. Reads are counted as in pileup: unmapped, secondary,
+qc-failed, duplicate and orphan reads are skipped, and a read covers
+all bases between its first and last aligned base. Unlike pileup,
+the coverage is not capped at a maximum depth. Windows are processed
+in parallel with ``--num-threads``.
+
 Command line options
 --------------------
 
@@ -46,8 +56,110 @@ Command line options
 
 import sys
 import re
+import numpy
 import pysam
 import CGAT.Experiment as E
+import CGAT.BamTools as BamTools
+
+
+def openWorkerFiles(state):
+    """open the bam files in a worker process."""
+    state["samfiles"] = [pysam.AlignmentFile(x, "rb")
+                         for x in state["filenames"]]
+
+
+def getWindows(contigs, lengths, window_size):
+    """return list of windows (contig, start, end) of at most
+    *window_size* bases covering *contigs*."""
+    windows = []
+    for contig, length in zip(contigs, lengths):
+        for start in range(0, length, window_size):
+            windows.append((contig, start, min(length, start + window_size)))
+    return windows
+
+
+def buildCoverageMatrix(samfiles, contig, start, end):
+    """return coverage of *samfiles* in window *contig*:*start*-*end*.
+
+    returns a tuple (positions, matrix). *positions* contains the
+    positions with coverage in any file, *matrix* the coverage at
+    these positions with one column per file.
+    """
+    size = end - start
+    matrix = None
+
+    for column, samfile in enumerate(samfiles):
+        starts, ends = [], []
+        for read in samfile.fetch(contig, start, end):
+            flag = read.flag
+            # skip filtered reads and orphans as pileup does
+            if flag & BamTools.PILEUP_FILTER_FLAGS or \
+               (flag & 1 and not flag & 2):
+                continue
+            starts.append(read.reference_start)
+            ends.append(read.reference_end)
+
+        if not starts:
+            continue
+        if matrix is None:
+            matrix = numpy.zeros((size, len(samfiles)), dtype=numpy.uint32)
+            covered = numpy.zeros(size, dtype=bool)
+        starts = numpy.clip(numpy.array(starts) - start, 0, size)
+        ends = numpy.clip(numpy.array(ends) - start, 0, size)
+        delta = numpy.bincount(starts, minlength=size + 1) - \
+            numpy.bincount(ends, minlength=size + 1)
+        coverage = numpy.cumsum(delta[:size])
+        matrix[:, column] = coverage
+        covered |= coverage > 0
+
+    if matrix is None:
+        return (numpy.zeros(0, dtype=numpy.int64),
+                numpy.zeros((0, len(samfiles)), dtype=numpy.uint32))
+
+    positions = numpy.flatnonzero(covered)
+    return positions + start, matrix[positions]
+
+
+def formatWindow(samfiles, window):
+    """return coverage of *samfiles* in *window* (contig, start, end)
+    as tab-separated rows."""
+    contig, start, end = window
+    positions, matrix = buildCoverageMatrix(samfiles, contig, start, end)
+    if len(positions) == 0:
+        return ""
+    rows = numpy.column_stack((positions, matrix))
+    pattern = contig.replace("%", "%%") + "\t%i" * rows.shape[1] + "\n"
+    return "".join([pattern % tuple(x) for x in rows.tolist()])
+
+
+def formatWorkerWindow(window):
+    """return coverage in *window* in a worker process."""
+    return formatWindow(E.WORKER_STATE["samfiles"], window)
+
+
+def writeCoverageMatrix(outfile, filenames, contigs, lengths,
+                        window_size, num_threads=1):
+    """write coverage of all files in *filenames* on *contigs* to
+    *outfile*.
+
+    returns the number of windows processed.
+    """
+    windows = getWindows(contigs, lengths, window_size)
+    if num_threads > 1:
+        E.info("computing coverage in %i windows with %i processes" %
+               (len(windows), num_threads))
+        pool = E.getWorkerPool(num_threads,
+                               initializer=openWorkerFiles,
+                               filenames=filenames)
+        for text in pool.imap(formatWorkerWindow, windows):
+            outfile.write(text)
+        pool.close()
+        pool.join()
+    else:
+        samfiles = [pysam.AlignmentFile(x, "rb") for x in filenames]
+        for window in windows:
+            outfile.write(formatWindow(samfiles, window))
+    return len(windows)
 
 
 def main(argv=None):
@@ -74,9 +186,26 @@ def main(argv=None):
                       help="regular expression to extract identifier from "
                       "filename [%default].")
 
+    parser.add_option("-m", "--method", dest="method", type="choice",
+                      choices=("pileup", "matrix"),
+                      help="method to compute coverage [%default].")
+
+    parser.add_option("-w", "--window-size", dest="window_size",
+                      type="int",
+                      help="size of windows for --method=matrix "
+                      "[%default].")
+
+    parser.add_option("--num-threads", "--threads", dest="num_threads",
+                      type="int",
+                      help="number of processes for --method=matrix "
+                      "[%default].")
+
     parser.set_defaults(
         filename_intervals=None,
         regex_identifier="(.*)",
+        method="pileup",
+        window_size=1000000,
+        num_threads=1,
     )
 
     # add common options (-h/--help, ...) and parse command line
@@ -101,6 +230,25 @@ def main(argv=None):
     ninput, nskipped, noutput = 0, 0, 0
     contigs = samfiles[0].references
 
+    if options.method == "matrix":
+        # contigs missing in any file are skipped
+        present = [x for x in zip(samfiles[0].references,
+                                  samfiles[0].lengths)
+                   if all(f.get_tid(x[0]) >= 0 for f in samfiles)]
+        nskipped = len(contigs) - len(present)
+        noutput = len(present)
+        nwindows = writeCoverageMatrix(
+            options.stdout,
+            args,
+            [x[0] for x in present],
+            [x[1] for x in present],
+            options.window_size,
+            num_threads=options.num_threads)
+        E.info("ninput=%i, noutput=%i, nskipped=%i, nwindows=%i" %
+               (ninput, noutput, nskipped, nwindows))
+        E.Stop()
+        return
+
     for contig in contigs:
 
         missing_contig = False
@@ -174,6 +174,12 @@ The generation of spike-ins is extensively parameterised:
 
     Defines how many iterations of random shuffling should be performed.
 
+--spike-num-threads=[int]
+
+    Number of processes to shuffle clusters. Each iteration uses its
+    own random number generator seeded from ``--random-seed``, so the
+    output does not depend on the number of processes.
+
 --spike-shuffle-column-suffix=[string]
 --spike-keep-column-suffix=[string]
 
@@ -311,6 +317,11 @@ def main(argv=None):
                       help="bin width for subcluster size\
                       [default=%default].")
 
+    parser.add_option("--spike-num-threads",
+                      dest="num_threads", type="int",
+                      help="number of processes to use for shuffling\
+                      clusters [default=%default].")
+
     parser.add_option("--spike-output-method",
                       dest="output_method", type="choice",
                       choices=("append", "seperate"),
@@ -362,6 +373,7 @@ def main(argv=None):
         min_sbin=1,
         max_sbin=1,
         width_sbin=1,
+        num_threads=1,
         shuffle_suffix=None,
         keep_suffix=None,
         normalization_method="deseq-size-factors"
@@ -516,11 +528,12 @@ def main(argv=None):
                 raise Exception("no clusters were found, check parameters")
 
             E.info("shuffling subcluster regions...")
-            output_indices, counts = Counts.shuffleCluster(
+            output_indices, bin_counts = Counts.shuffleCluster(
                 initial_bins, change_bins, g_to_spike_tracks, groups,
                 options.difference, options.max_spike,
                 options.iterations, clusters_dict,
-                options.max_sbin, options.min_sbin, options.width_sbin)
+                options.max_sbin, options.min_sbin, options.width_sbin,
+                num_threads=options.num_threads)
 
         elif options.spike_type == "row":
 
@@ -63,12 +63,12 @@ column for the dataframe.
 """
 
 import copy
-import random
 import sys
 import re
 import pandas as pd
 import numpy as np
 import CGAT.Experiment as E
+import CGAT.Counts as Counts
 
 
 def groupMappers(design_table, spike_regex, shuffle_suffix, keep_suffix):
@@ -159,73 +159,6 @@ def findClusters(df, distance, size, tracks_map, groups):
     return (cluster_dfs)
 
 
-def shuffleCluster(i_bins, c_bins, tracks_map, groups,
-                   difference, s_max, i, clusters_dict,
-                   s_bins_max, s_bins_min, s_bins_width):
-
-    s_bins = list(range(s_bins_min, s_bins_max+1, s_bins_width,))
-
-    counts = np.zeros((len(i_bins)+1, len(c_bins)+1, len(s_bins)+1))
-
-    indices = {(key1, key2, key3): []
-               for key1 in np.digitize(i_bins, i_bins)
-               for key2 in np.digitize(c_bins, c_bins)
-               for key3 in np.digitize(s_bins, s_bins)}
-
-    for iteration in range(0,  i):
-        E.info("performing shuffling iteration number %i.." % (iteration + 1))
-        for size in s_bins:
-            group1_mean = []
-            group2_mean = []
-            g1_rand_s = []
-            g2_rand_s = []
-            g1_rand = np.random.permutation(list(clusters_dict.keys()))
-            g2_rand = np.random.permutation(list(clusters_dict.keys()))
-            for perm in range(0, len(g1_rand)):
-                cluster1 = clusters_dict[g1_rand[perm]].ix[
-                    :, tracks_map[groups[0]]]
-                cluster2 = clusters_dict[g2_rand[perm]].ix[
-                    :, tracks_map[groups[1]]]
-
-                c1_rand_s = random.randint(
-                    min(cluster1.index), max(cluster1.index)-size)
-                c1_e = int(c1_rand_s + size)
-                c2_rand_s = random.randint(
-                    min(cluster2.index), max(cluster2.index)-size)
-                c2_e = int(c2_rand_s + size)
-
-                c1_mean = np.mean(np.mean(cluster1.ix[c1_rand_s: c1_e]))
-                c2_mean = np.mean(np.mean(cluster2.ix[c2_rand_s: c2_e]))
-                group1_mean.append(c1_mean)
-                group2_mean.append(c2_mean)
-                g1_rand_s.append(c1_rand_s)
-                g2_rand_s.append(c2_rand_s)
-
-            change_idx, initial_idx,  = means2idxarrays(
-                group1_mean, group2_mean, i_bins,
-                c_bins,  difference)
-            size_idx = np.digitize([size]*len(initial_idx), s_bins)
-            for idx, coord in enumerate(zip(
-                    initial_idx, change_idx, size_idx)):
-                if counts[coord] < s_max:
-                    counts[coord] += 1
-                    cluster1_ix = clusters_dict[g1_rand[idx]].index.values
-                    cluster1_start = cluster1_ix[0]
-                    cluster1_end = cluster1_ix[-1]
-                    cluster2_ix = clusters_dict[g2_rand[idx]].index.values
-                    cluster2_start = cluster2_ix[0]
-                    cluster2_end = cluster2_ix[-1]
-                    c1_rand_s = g1_rand_s[idx]
-                    c1_rand_e = int(c1_rand_s + size)
-                    c2_rand_s = g2_rand_s[idx]
-                    c2_rand_e = int(c2_rand_s + size)
-                    indices[coord].append((
-                        cluster1_start, cluster1_end, cluster2_start,
-                        cluster2_end, c1_rand_s, c1_rand_e, c2_rand_s,
-                        c2_rand_e))
-    return indices, counts
-
-
 def shuffleRows(df, i_bins, c_bins, tracks_map,  groups,
                 difference, s_max=100, i=1):
 
@@ -499,6 +432,10 @@ def main(argv=None):
                       help="a regex to identify tracks for shuffling\
                       [default=%default].")
 
+    parser.add_option("--num-threads", dest="num_threads", type="int",
+                      help="number of processes to use for shuffling\
+                      clusters [default=%default].")
+
     parser.set_defaults(
         design_file=None,
         output_method="seperate",
@@ -523,7 +460,8 @@ def main(argv=None):
         id_column=None,
         shuffle_suffix=None,
         keep_suffix=None,
-        spike_regex=".*")
+        spike_regex=".*",
+        num_threads=1)
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv, add_output_options=True)
@@ -597,11 +535,12 @@ def main(argv=None):
             raise Exception("no clusters were found, check parameters")
 
         E.info("repeatedly shuffling subcluster regions...")
-        output_indices, counts = shuffleCluster(
+        output_indices, counts = Counts.shuffleCluster(
             initial_bins, change_bins, g_to_spike_tracks, groups,
             options.difference, options.max_spike,
             options.iterations, clusters_dict,
-            options.max_sbin, options.min_sbin, options.width_sbin)
+            options.max_sbin, options.min_sbin, options.width_sbin,
+            num_threads=options.num_threads)
 
     elif options.spike_type == "row":
         E.info("repeatedly shuffling rows...")
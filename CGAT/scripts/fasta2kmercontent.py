@@ -18,10 +18,35 @@ tab-delimited file of kmer counts::
 
 where n is the kmer and contig is the fasta entry.
 
-The user specifies the kmer length that is to be searched. Note that the longer
-the kmer, the longer the script will take to run.
-
-Note the order of output will not necessarily be the same order as the input.
+The user specifies the kmer length that is to be searched. Each
+sequence is scanned once and k-mers are counted at every position,
+i.e., overlapping occurrences are counted. Only upper-case ``A``,
+``C``, ``G`` and ``T`` are counted; k-mers containing any other
+character are ignored.
+
+K-mers are encoded as 2-bit packed integers. Up to a kmer length of
+``--max-dense-kmer-size`` all possible k-mers are output. For longer
+k-mers (up to 31), only k-mers observed in a sequence are output.
+As the counts of all possible k-mers are kept in an array of
+size 4^k, ``--max-dense-kmer-size`` can not be larger than 12.
+
+The layout of the output is chosen with ``--output-layout``:
+
+``kmer``
+   one row per k-mer and one column per sequence. This is the
+   default. Sequences are sorted by name. The counts of all
+   sequences are kept in memory until the end.
+
+``sequence``
+   one row per sequence and one column per k-mer. Rows are
+   written in input order as soon as a sequence has been
+   counted. This layout requires all possible k-mers to be
+   counted (see ``--max-dense-kmer-size``).
+
+``long``
+   one row per sequence and observed k-mer with the columns
+   ``contig``, ``kmer`` and ``count``. Rows are written in input
+   order as soon as a sequence has been counted.
 
 Usage
 -----
@@ -68,8 +93,7 @@ each four base combination out of the total tetranucleotide occurences.
 
 Options
 -------
-Two options control the behaviour of fasta2kmercontent.py; ``--kmer-size`` and
-``--output-proportion``.
+The following options control the behaviour of fasta2kmercontent.py:
 
 ``--kmer-size``::
   The kmer length to count over in the input fasta file
@@ -77,6 +101,13 @@ Two options control the behaviour of fasta2kmercontent.py; ``--kmer-size`` and
 ``--output-proportion``::
   The output values are proportions rather than absolute counts
 
+``--canonical``::
+  Collapse each k-mer with its reverse complement. Counts are reported
+  for the lexicographically smaller of the two.
+
+``--output-layout``::
+  Layout of the output table, see above.
+
 
 Type::
 
@@ -91,10 +122,71 @@ Command line options
 '''
 
 import sys
-import re
+import numpy
 import CGAT.FastaIterator as FastaIterator
-import itertools
 import CGAT.Experiment as E
+import CGAT.scripts._fasta2kmercontent as _fasta2kmercontent
+
+# maximum kmer length that fits into a 64-bit code
+MAX_KMER_SIZE = 31
+
+# maximum kmer length for which counts are kept in an array
+# of all possible kmers (4^12 counts use 128Mb)
+MAX_DENSE_KMER_SIZE = 12
+
+NUCLEOTIDES = "ACGT"
+
+
+def reverseComplementCodes(codes, kmer_size):
+    """return codes of the reverse complement of kmer *codes*."""
+    codes = numpy.asarray(codes, dtype=numpy.uint64)
+    result = numpy.zeros(len(codes), dtype=numpy.uint64)
+    for x in range(kmer_size):
+        base = (codes >> numpy.uint64(2 * x)) & numpy.uint64(3)
+        result |= (numpy.uint64(3) - base) << \
+            numpy.uint64(2 * (kmer_size - x - 1))
+    return result
+
+
+def decodeKmer(code, kmer_size):
+    """return the kmer sequence for a 2-bit packed *code*."""
+    code = int(code)
+    kmer = []
+    for x in range(kmer_size):
+        kmer.append(NUCLEOTIDES[code & 3])
+        code >>= 2
+    return "".join(reversed(kmer))
+
+
+def countKmers(sequence, kmer_size, canonical=False, dense=True):
+    """count kmers in *sequence*.
+
+    If *dense* is True, return an array of counts indexed by kmer code.
+    Otherwise return a tuple of the sorted array of observed kmer codes
+    and their counts.
+
+    If *canonical* is True, kmers are collapsed with their reverse
+    complement and counted under the smaller of the two codes.
+    """
+    codes = _fasta2kmercontent.encodeKmers(sequence, kmer_size, canonical)
+
+    if dense:
+        return numpy.bincount(codes.astype(numpy.int64),
+                              minlength=4 ** kmer_size)
+    else:
+        return numpy.unique(codes, return_counts=True)
+
+
+def formatValues(counts, proportion):
+    """return *counts* as a list of strings.
+
+    If *proportion* is True, counts are divided by their sum.
+    """
+    if proportion:
+        total = counts.sum()
+        return [str(float(x) / total) for x in counts.tolist()]
+    else:
+        return [str(x) for x in counts.tolist()]
 
 
 def main(argv=None):
@@ -117,68 +209,138 @@ def main(argv=None):
         "-p", "--output-proportion", dest="proportion", action="store_true",
         help="output proportions - overides the default output")
 
-    # add common options (-h/--help, ...) and parse command line
-    (options, args) = E.Start(parser, argv=argv)
+    parser.add_option(
+        "--canonical", dest="canonical", action="store_true",
+        help="collapse kmers with their reverse complement "
+        "[default=%default]")
 
-    # do not allow greater than octonucleotide
-    assert options.kmer <= 8, "cannot handle kmer of length %i" % options.kmer
+    parser.add_option(
+        "--max-dense-kmer-size", dest="max_dense_kmer", type="int",
+        help="maximum kmer length for which counts for all possible "
+        "kmers are output. Longer kmers are counted sparsely "
+        "[default=%default]")
 
-    # how we deal with the nucleotides depends on the kmer length
-    nucleotides = []
-    for nucleotide in ["A", "C", "T", "G"]:
-        nucleotides = nucleotides + \
-            [x for x in itertools.repeat(nucleotide, options.kmer)]
+    parser.add_option(
+        "--output-layout", dest="layout", type="choice",
+        choices=("kmer", "sequence", "long"),
+        help="layout of output table. ``sequence`` and ``long`` "
+        "write the counts of each sequence as soon as it has been "
+        "counted, ``kmer`` keeps all counts in memory "
+        "[default=%default]")
+
+    parser.set_defaults(
+        kmer=4,
+        proportion=False,
+        canonical=False,
+        max_dense_kmer=10,
+        layout="kmer")
 
-    E.info("retrieving %imer sequences" % options.kmer)
-    # get all kmer sequences to query
-    kmers = set()
-    for kmer in itertools.permutations(nucleotides, options.kmer):
-        kmers.add(kmer)
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.Start(parser, argv=argv)
 
-    E.info("matching %imers in file" % options.kmer)
-    # count the number of kmers in each sequence
+    if options.kmer < 1 or options.kmer > MAX_KMER_SIZE:
+        raise ValueError("cannot handle kmer of length %i" % options.kmer)
+
+    if options.max_dense_kmer > MAX_DENSE_KMER_SIZE:
+        raise ValueError(
+            "--max-dense-kmer-size=%i is too large, the maximum is %i" %
+            (options.max_dense_kmer, MAX_DENSE_KMER_SIZE))
+
+    dense = options.kmer <= options.max_dense_kmer
+
+    if options.layout == "sequence" and not dense:
+        raise ValueError(
+            "kmers of length %i are longer than --max-dense-kmer-size "
+            "and require --output-layout=long or --output-layout=kmer" %
+            options.kmer)
+
+    # codes of kmers that are output. As nucleotides are
+    # encoded in alphabetical order, sorted codes correspond to
+    # sorted kmers.
+    if dense:
+        rows = numpy.arange(4 ** options.kmer, dtype=numpy.uint64)
+        if options.canonical:
+            rows = rows[rows <= reverseComplementCodes(rows, options.kmer)]
+        index = rows.astype(numpy.int64)
+        kmers = [decodeKmer(x, options.kmer) for x in rows]
+
+    outf = options.stdout
+    if options.layout == "sequence":
+        outf.write("contig\t" + "\t".join(kmers) + "\n")
+    elif options.layout == "long":
+        outf.write("contig\tkmer\t%s\n" %
+                   ("proportion" if options.proportion else "count"))
 
+    E.info("matching %imers in file" % options.kmer)
+    # counts per sequence for the kmer layout
     result = {}
 
     # NB assume that non fasta files are caught by FastaIterator
     total_entries = 0
     for fasta in FastaIterator.iterate(options.stdin):
         total_entries += 1
-        result[fasta.title] = {}
-        for kmer in kmers:
-            counts = [m.start()
-                      for m in re.finditer("".join(kmer), fasta.sequence)]
-            result[fasta.title][kmer] = len(counts)
-
-    E.info("writing results")
-    # write out the results
-    headers = sorted(result.keys())
-    rows = set()
-    for kmer_counts in list(result.values()):
-        for kmer, count in kmer_counts.items():
-            rows.add("".join(kmer))
-
-    # write header row
-    options.stdout.write("kmer\t" + "\t".join(headers) + "\n")
-
-    # output proportions if required - normalises by
-    # sequence length
-    E.info("computing total counts")
-    totals = {}
-    for header in headers:
-        totals[header] = sum([result[header][tuple(row)] for row in rows])
-
-    for row in sorted(rows):
-        if options.proportion:
-            options.stdout.write("\t".join(
-                [row] + [str(float(result[header][tuple(row)]) / totals[header]) for header in headers]) + "\n")
+        counts = countKmers(fasta.sequence,
+                            options.kmer,
+                            canonical=options.canonical,
+                            dense=dense)
+        if dense:
+            codes, counts = rows, counts[index]
+        else:
+            codes, counts = counts
+
+        if options.layout == "sequence":
+            outf.write("\t".join(
+                [fasta.title] + formatValues(counts, options.proportion)) +
+                "\n")
+        elif options.layout == "long":
+            observed = counts > 0
+            codes, counts = codes[observed], counts[observed]
+            for code, value in zip(
+                    codes, formatValues(counts, options.proportion)):
+                outf.write("%s\t%s\t%s\n" % (
+                    fasta.title, decodeKmer(code, options.kmer), value))
         else:
-            options.stdout.write(
-                "\t".join([row] + [str(result[header][tuple(row)]) for header in headers]) + "\n")
+            result[fasta.title] = (codes, counts)
+
+    if options.layout == "kmer":
+        E.info("writing results")
+        headers = sorted(result.keys())
+
+        # build kmer x sequence matrix of counts
+        if not dense:
+            if headers:
+                rows = numpy.unique(numpy.concatenate(
+                    [result[header][0] for header in headers]))
+            else:
+                rows = numpy.zeros(0, dtype=numpy.uint64)
+        matrix = numpy.zeros((len(rows), len(headers)), dtype=numpy.int64)
+        for column, header in enumerate(headers):
+            codes, counts = result.pop(header)
+            matrix[numpy.searchsorted(rows, codes), column] = counts
+
+        # write header row
+        outf.write("kmer\t" + "\t".join(headers) + "\n")
+
+        # output proportions if required - normalises by
+        # sequence length
+        E.info("computing total counts")
+        totals = matrix.sum(axis=0)
+
+        for code, values in zip(rows, matrix.tolist()):
+            kmer = decodeKmer(code, options.kmer)
+            if options.proportion:
+                outf.write("\t".join(
+                    [kmer] + [str(float(value) / total)
+                              for value, total in zip(values, totals)]) +
+                    "\n")
+            else:
+                outf.write(
+                    "\t".join([kmer] + [str(x) for x in values]) + "\n")
 
     E.info("written kmer counts for %i contigs" % total_entries)
     # write footer and output benchmark information.
     E.Stop()
 
+
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
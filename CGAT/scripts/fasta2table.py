@@ -278,6 +278,9 @@ def main(argv=None):
 
         id = rx.search(cur_record.title).groups()[0]
 
+        # encode once for all counters
+        sequence = SequenceProperties.EncodedSequence(sequence)
+
         if options.split_id is True:
             options.stdout.write("%s" % id.split()[0])
         else:
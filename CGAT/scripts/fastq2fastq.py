@@ -108,7 +108,14 @@ The following methods are implemented (``--method``).
 
 ``sort``
 
-    Sort the fastq file by read name.
+    Sort the fastq file by read name. Paired files are sorted
+    together and written in the same order. Sorting is done in
+    bounded memory: records are collected until ``--max-memory``
+    is reached, sorted and written to temporary compressed files
+    in ``--temp-dir``, which are then merged. At most
+    ``--max-merge-runs`` files are merged at the same time, more
+    files are merged in several passes. Identifiers are compared
+    by byte value.
 
 ``renumber-reads``
 
@@ -130,12 +137,142 @@ Command line options
 import os
 import sys
 import re
+import gzip
+import heapq
 import random
+import shutil
+import tempfile
+from six.moves import zip_longest
 import CGAT.IOTools as IOTools
 import CGAT.Experiment as E
 import CGAT.Fastq as Fastq
 import CGAT.Genomics as Genomics
 
+# estimated memory overhead per string when collecting records
+STRING_OVERHEAD = 50
+
+
+def parseMemory(value):
+    """return number of bytes in memory size *value*.
+
+    *value* is a number with an optional suffix K, M or G, for
+    example ``500M`` or ``2G``.
+    """
+    value = str(value).strip().upper()
+    factor = 1
+    for suffix, f in (("K", 2 ** 10), ("M", 2 ** 20), ("G", 2 ** 30)):
+        if value.endswith(suffix):
+            value, factor = value[:-1], f
+            break
+    try:
+        return int(float(value) * factor)
+    except ValueError:
+        raise ValueError("could not parse memory size '%s'" % value)
+
+
+def iterateLines(infile):
+    """iterate over records in a fastq file as tuples of four lines.
+
+    Sequence and quality lines of zero-length reads are empty.
+    """
+    while True:
+        header = infile.readline()
+        if not header:
+            break
+        lines = (header.rstrip("\n"),) + tuple(
+            infile.readline().rstrip("\n") for x in range(3))
+        if not lines[0].startswith("@"):
+            raise ValueError("parsing error: expected '@' in line %s" %
+                             lines[0])
+        if not lines[2].startswith("+"):
+            raise ValueError("parsing error: expected '+' in line %s" %
+                             lines[2])
+        if len(lines[3]) != len(lines[1]):
+            raise ValueError("incomplete entry for %s" % lines[0])
+        yield lines
+
+
+def writeRun(items, tmpdir):
+    """write sorted *items* to a compressed temporary file in
+    *tmpdir*.
+
+    Fields of an item are written on separate lines.
+
+    returns the filename.
+    """
+    handle, filename = tempfile.mkstemp(dir=tmpdir, suffix=".gz")
+    os.close(handle)
+    with gzip.open(filename, "wt", compresslevel=1) as outf:
+        for item in items:
+            outf.write("\n".join(item))
+            outf.write("\n")
+    return filename
+
+
+def iterateRun(filename, nfields):
+    """iterate over items with *nfields* fields in run *filename*."""
+    with gzip.open(filename, "rt") as inf:
+        while True:
+            line = inf.readline()
+            if not line:
+                break
+            yield (line[:-1],) + tuple(
+                inf.readline()[:-1] for x in range(nfields - 1))
+
+
+def sortExternal(items, max_memory, tmpdir=None, max_runs=64):
+    """sort *items* in bounded memory.
+
+    *items* are tuples of strings without newlines, all of the same
+    length. Items are sorted in memory until their estimated size
+    exceeds *max_memory* bytes. Sorted runs are written to temporary
+    files in *tmpdir* and merged.
+
+    At most *max_runs* runs are merged at the same time. If there
+    are more, runs are merged in several passes into new runs.
+
+    yields items in sorted order.
+    """
+    if max_runs < 2:
+        raise ValueError("can not merge fewer than 2 runs at a time")
+
+    tmpdir = tempfile.mkdtemp(dir=tmpdir)
+    runs = []
+    chunk = []
+    size = 0
+    nfields = None
+    try:
+        for item in items:
+            chunk.append(item)
+            size += sum(map(len, item)) + STRING_OVERHEAD * len(item)
+            if size >= max_memory:
+                chunk.sort()
+                runs.append(writeRun(chunk, tmpdir))
+                nfields = len(item)
+                chunk = []
+                size = 0
+
+        # merge oldest runs until the runs on disk and the
+        # last run in memory can be merged at once
+        while len(runs) >= max_runs:
+            E.info("merging %i of %i sorted runs" % (max_runs, len(runs)))
+            merged = writeRun(
+                heapq.merge(*[iterateRun(x, nfields)
+                              for x in runs[:max_runs]]),
+                tmpdir)
+            for x in runs[:max_runs]:
+                os.unlink(x)
+            runs = runs[max_runs:] + [merged]
+
+        chunk.sort()
+        E.info("merging %i sorted runs" % (len(runs) + 1))
+        iterators = [iterateRun(x, nfields) for x in runs]
+        iterators.append(iter(chunk))
+        for item in heapq.merge(*iterators):
+            yield item
+    finally:
+        shutil.rmtree(tmpdir)
+
 
 def main(argv=None):
     """script main.
@@ -207,6 +344,21 @@ def main(argv=None):
         "--grep-pattern", dest="grep_pattern", type="string",
         help="subset to reads matching pattern [default=%default]")
 
+    parser.add_option(
+        "--max-memory", dest="max_memory", type="string",
+        help="memory to use for sorting before records are written to "
+        "temporary files, for example 500M or 2G [default=%default]")
+
+    parser.add_option(
+        "--temp-dir", dest="tmpdir", type="string",
+        help="directory for temporary files when sorting "
+        "[default=%default]")
+
+    parser.add_option(
+        "--max-merge-runs", dest="max_merge_runs", type="int",
+        help="maximum number of temporary files that are merged "
+        "at the same time when sorting [default=%default]")
+
     parser.set_defaults(
         method=None,
         change_format=None,
@@ -217,7 +369,10 @@ def main(argv=None):
         apply=None,
         seed=None,
         renumber_pattern="read_%010i",
-        grep_pattern=".*")
+        grep_pattern=".*",
+        max_memory="1G",
+        max_merge_runs=64,
+        tmpdir=None)
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.Start(parser, argv=argv, add_output_options=True)
@@ -311,43 +466,58 @@ def main(argv=None):
             options.stdout.write("%s\n" % record)
             c.output += 1
 
-    # Need to change this to incorporate both pairs
     elif options.method == "sort":
+        max_memory = parseMemory(options.max_memory)
         if not options.pair:
-            # This is quicker for a single fastq file
-            statement = "paste - - - - | sort -k1,1 -t ' ' | tr '\t' '\n'"
-            os.system(statement)
+            # sort by first word of identifier, keep records as they are
+            records = ((x[0].split(" ")[0],) + x
+                       for x in iterateLines(options.stdin))
+            noutput = 0
+            for record in sortExternal(records, max_memory,
+                                       tmpdir=options.tmpdir,
+                                       max_runs=options.max_merge_runs):
+                options.stdout.write("\n".join(record[1:]) + "\n")
+                noutput += 1
+            c.input = c.output = noutput
         else:
             if not options.output_filename_pattern:
                 raise ValueError(
                     "please specify output filename for second pair "
                     "(--output-filename-pattern)")
-            E.warn(
-                "consider sorting individual fastq files - "
-                "this is memory intensive")
-            entries1 = {}
-            entries2 = {}
 
-            for record1, record2 in zip(
-                    Fastq.iterate(options.stdin),
-                    Fastq.iterate(IOTools.openFile(options.pair))):
-                entries1[
-                    record1.identifier[:-2]] = (record1.seq, record1.quals)
-                entries2[
-                    record2.identifier[:-2]] = (record2.seq, record2.quals)
+            def _iterate(infile):
+                return ((x.identifier[:-2], x.seq, x.quals)
+                        for x in Fastq.iterate(infile))
+
+            # sort both mates separately and merge them in lockstep.
+            # The last run of each mate is kept in memory, so each
+            # gets half of the memory and of the runs merged at once.
+            max_runs = max(2, options.max_merge_runs // 2)
+            sorted1 = sortExternal(_iterate(options.stdin),
+                                   max_memory // 2,
+                                   tmpdir=options.tmpdir,
+                                   max_runs=max_runs)
+            sorted2 = sortExternal(_iterate(IOTools.openFile(options.pair)),
+                                   max_memory // 2,
+                                   tmpdir=options.tmpdir,
+                                   max_runs=max_runs)
 
             outfile1 = options.stdout
             outfile2 = IOTools.openFile(options.output_filename_pattern, "w")
-            assert len(set(entries1.keys()).intersection(
-                set(entries2.keys()))) == len(entries1),\
-                "paired files do not contain the same reads "\
-                "need to reconcile files"
-
-            for entry in sorted(entries1):
-                outfile1.write("@%s/1\n%s\n+\n%s\n" %
-                               (entry, entries1[entry][0], entries1[entry][1]))
-                outfile2.write("@%s/2\n%s\n+\n%s\n" %
-                               (entry, entries2[entry][0], entries2[entry][1]))
+            noutput = 0
+            for record1, record2 in zip_longest(sorted1, sorted2):
+                if record1 is None or record2 is None or \
+                   record1[0] != record2[0]:
+                    raise ValueError(
+                        "paired files do not contain the same reads "
+                        "need to reconcile files")
+                entry, seq1, quals1 = record1
+                entry, seq2, quals2 = record2
+                outfile1.write("@%s/1\n%s\n+\n%s\n" % (entry, seq1, quals1))
+                outfile2.write("@%s/2\n%s\n+\n%s\n" % (entry, seq2, quals2))
+                noutput += 1
+            outfile2.close()
+            c.input = c.output = noutput
 
     elif options.method == "renumber-reads":
         id_count = 1
@@ -25,7 +25,12 @@ reads might be missing from one file but not the other. The reconcile
 method will output two files containing only reads that are common to
 both files.
 
-The two files must be sorted by read identifier.
+The two files do not need to be sorted. If the reads in both files
+are in the same order, the files are reconciled in a single pass.
+Otherwise, 64-bit hashes of the read identifiers of both files are
+collected into sorted arrays in two threads and intersected. Reads
+with a shared hash are then output in the order of the input files.
+Gzip compressed input files are decompressed in separate threads.
 
 Example input, read2 and read3 are only present in either of the
 files:
@@ -86,6 +91,10 @@ Command line options
 
 import sys
 import re
+import itertools
+import numpy
+from multiprocessing.pool import ThreadPool
+from six.moves import zip_longest
 import CGAT.IOTools as IOTools
 import CGAT.Experiment as E
 
@@ -103,6 +112,124 @@ def plain_getter(id):
     return id
 
 
+def openInput(filename):
+    """open *filename* for reading, decompressing gzip compressed files
+    in a separate thread."""
+    return IOTools.openFile(filename, threads=2)
+
+
+def iterateRecords(infile):
+    """iterate over records in *infile* as tuples of four lines."""
+    return zip(infile, infile, infile, infile)
+
+
+def formatRecords(records):
+    """return *records* as text with unix line endings."""
+    records = list(records)
+    text = "".join(itertools.chain.from_iterable(records))
+    if "\r" in text or (text and not text.endswith("\n")):
+        text = "".join(["\n".join([x.rstrip("\r\n") for x in record]) + "\n"
+                        for record in records])
+    return text
+
+
+def getReadId(line, id_getter=plain_getter, chop=False):
+    """return read identifier in header *line*."""
+    r = id_getter(line.split()[0])
+    # decide if to chop read number off
+    if chop:
+        return r[:-1]
+    return r
+
+
+def hashReadIds(lines, id_getter=plain_getter, chop=False):
+    """return array of 64-bit hashes of read identifiers in header
+    *lines*."""
+    if id_getter is plain_getter and not chop:
+        ids = [x.split(None, 1)[0] for x in lines]
+    else:
+        ids = [getReadId(x, id_getter, chop) for x in lines]
+    return numpy.fromiter(map(hash, ids), dtype=numpy.int64, count=len(ids))
+
+
+def writeInLockstep(filename1, filename2, outfile1, outfile2,
+                    id1_getter, id2_getter, chop):
+    """write reads from both files while their identifiers agree.
+
+    returns a tuple with the number of reads written from each file
+    and a flag indicating whether both files were written completely.
+    """
+    nreads = 0
+    with openInput(filename1) as inf1, openInput(filename2) as inf2:
+        for l1, l2 in zip_longest(iterateRecords(inf1),
+                                  iterateRecords(inf2)):
+            if l1 is None or l2 is None or \
+               getReadId(l1[0], id1_getter, chop) != \
+               getReadId(l2[0], id2_getter, chop):
+                return nreads, False
+            outfile1.write(formatRecords((l1,)))
+            outfile2.write(formatRecords((l2,)))
+            nreads += 1
+    return nreads, True
+
+
+def hashIds(filename, id_getter, chop, chunk_size=10000):
+    """collect hashes of read identifiers in *filename*.
+
+    returns a tuple with a sorted array of unique 64-bit hashes and
+    the number of reads.
+    """
+    chunks = []
+    nreads = 0
+    with openInput(filename) as inf:
+        headers = itertools.islice(inf, 0, None, 4)
+        while True:
+            hashes = hashReadIds(list(itertools.islice(headers, chunk_size)),
+                                 id_getter, chop)
+            if len(hashes) == 0:
+                break
+            nreads += len(hashes)
+            chunks.append(numpy.unique(hashes))
+
+    if not chunks:
+        return numpy.zeros(0, dtype=numpy.int64), 0
+    return numpy.unique(numpy.concatenate(chunks)), nreads
+
+
+def writeShared(filename, outfile, shared, id_getter, chop,
+                unpaired_file=None, skip=0, chunk_size=10000):
+    """write reads in *filename* with an identifier hash in the sorted
+    array *shared* to *outfile*.
+
+    Other reads are written to *unpaired_file*, if given. The first
+    *skip* reads are ignored.
+
+    returns the number of reads written to *outfile*.
+    """
+    noutput = 0
+    with openInput(filename) as inf:
+        records = iterateRecords(inf)
+        next(itertools.islice(records, skip, skip), None)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            hashes = hashReadIds([x[0] for x in chunk], id_getter, chop)
+            if len(shared):
+                index = numpy.searchsorted(shared, hashes)
+                index[index == len(shared)] = 0
+                found = shared[index] == hashes
+            else:
+                found = numpy.zeros(len(chunk), dtype=bool)
+
+            outfile.write(formatRecords(itertools.compress(chunk, found)))
+            noutput += numpy.count_nonzero(found)
+            if unpaired_file is not None:
+                unpaired_file.write(
+                    formatRecords(itertools.compress(chunk, ~found)))
+    return noutput
+
+
 def main(argv=None):
     """script main.
 
@@ -178,78 +305,59 @@ def main(argv=None):
 
     if options.method == "reconcile":
 
-        # IMS: switching to no store second set of read names and only use
-        # lazily. Since generators don't have a size must keep track
-        id_lengths = {fn1: 0, fn2: 0}
-
-        def getIds(infile, id_getter=plain_getter):
-            '''return ids in infile.'''
-            aread = infile.readline
-            while True:
-                l = [aread().rstrip("\r\n") for i in range(4)]
-                if not l[0]:
-                    break
-                r = id_getter(l[0].split()[0])
-                # decide if to chop read number off
-                id_lengths[infile.name] += 1
-                if options.chop:
-                    yield r[:-1]
-                else:
-                    yield r
-
-        def write(outfile, infile, take, unpaired_file=None,
-                  id_getter=plain_getter):
-            '''filter fastq files with ids in take.'''
-            aread = infile.readline
-            while True:
-                l = [aread().rstrip("\r\n") for i in range(4)]
-                if not l[0]:
-                    break
-                r = id_getter(l[0].split()[0])
-                if options.chop:
-                    r = r[:-1]
-                if r not in take:
-                    if unpaired_file is None:
-                        continue
-                    else:
-                        unpaired_file.write("\n".join(l) + "\n")
-                else:
-                    outfile.write("\n".join(l) + "\n")
-
-        E.info("reading first in pair")
-        inf1 = IOTools.openFile(fn1)
-        ids1 = set(getIds(inf1, id1_getter))
-
-        E.info("reading second in pair")
-        inf2 = IOTools.openFile(fn2)
-        # IMS: No longer keep as a set, but lazily evaluate into intersection
-        # leads to large memory saving for large inf2, particularly if
-        # inf1 is small.
-        ids2 = getIds(inf2, id2_getter)
-        take = ids1.intersection(ids2)
-
-        E.info("first pair: %i reads, second pair: %i reads, "
-               "shared: %i reads" %
-               (id_lengths[fn1],
-                id_lengths[fn2],
-                len(take)))
-
+        outf1 = IOTools.openFile(options.output_pattern % "1", "w")
+        outf2 = IOTools.openFile(options.output_pattern % "2", "w")
         if options.unpaired:
             unpaired_filename = IOTools.openFile(
                 options.output_pattern % "unpaired", "w")
         else:
             unpaired_filename = None
 
-        with IOTools.openFile(options.output_pattern % "1", "w") as outf:
-            inf = IOTools.openFile(fn1)
-            E.info("writing first in pair")
-            write(outf, inf, take, unpaired_filename, id1_getter)
+        E.info("reading both files in lockstep")
+        nlockstep, complete = writeInLockstep(
+            fn1, fn2, outf1, outf2, id1_getter, id2_getter, options.chop)
+
+        if complete:
+            E.info("reads in both files are in the same order")
+            c.input1 = c.input2 = c.output1 = c.output2 = nlockstep
+        else:
+            E.info("files differ after %i reads, collecting read "
+                   "identifiers" % nlockstep)
+            pool = ThreadPool(2)
+            results = [pool.apply_async(hashIds, (fn, getter, options.chop))
+                       for fn, getter in ((fn1, id1_getter),
+                                          (fn2, id2_getter))]
+            (hashes1, ninput1), (hashes2, ninput2) = \
+                [x.get() for x in results]
+            pool.close()
+            pool.join()
+
+            take = numpy.intersect1d(hashes1, hashes2, assume_unique=True)
+            del hashes1, hashes2
+
+            E.info("first pair: %i reads, second pair: %i reads, "
+                   "shared: %i reads" %
+                   (ninput1, ninput2, len(take)))
 
-        with IOTools.openFile(options.output_pattern % "2", "w") as outf:
-            inf = IOTools.openFile(fn2)
+            E.info("writing first in pair")
+            noutput1 = nlockstep + writeShared(
+                fn1, outf1, take, id1_getter, options.chop,
+                unpaired_filename, skip=nlockstep)
             E.info("writing second in pair")
-            write(outf, inf, take, unpaired_filename, id2_getter)
+            noutput2 = nlockstep + writeShared(
+                fn2, outf2, take, id2_getter, options.chop,
+                unpaired_filename, skip=nlockstep)
+
+            if noutput1 != noutput2:
+                E.warn("different number of reads output for first "
+                       "(%i) and second (%i) in pair. Read identifiers "
+                       "might not be unique" % (noutput1, noutput2))
+
+            c.input1, c.input2 = ninput1, ninput2
+            c.output1, c.output2 = noutput1, noutput2
 
+        outf1.close()
+        outf2.close()
         if options.unpaired:
             unpaired_filename.close()
 
@@ -444,6 +444,19 @@ convention. A summary is `here
 For unstranded protocols, all reads and pairs are considered to matching
 in the sense direction.
 
+Parallel execution
+------------------
+
+With ``--num-threads`` larger than 1, genes or transcripts are sent
+in chunks (``--chunk-size``) to a pool of worker processes. Each
+worker opens its own genome, bam and bigwig files and applies the
+selected counters. Results are collected in input order, so the
+output is identical to a single-process run. The counter
+``read-extension`` writes additional output files and can not be
+used in parallel mode. When reads are sub-sampled with
+``--sample-probability``, each worker process draws its own random
+numbers.
+
 Usage
 -----
 
@@ -459,7 +472,9 @@ Command line options
 '''
 
 import sys
+import copy
 import pysam
+from six import StringIO
 
 import CGAT.Experiment as E
 import CGAT.GTF as GTF
@@ -469,196 +484,13 @@ import CGAT.GeneModelAnalysis as GeneModelAnalysis
 import pyBigWig
 
 
-def main(argv=None):
-
-    parser = E.OptionParser(version="%prog version: $Id$",
-                            usage=globals()["__doc__"])
-
-    parser.add_option("-g", "--genome-file", dest="genome_file", type="string",
-                      help="filename with genome [default=%default].")
-
-    parser.add_option("-q", "--quality-file",
-                      dest="quality_file",
-                      type="string",
-                      help="filename with genomic base quality "
-                      "information [default=%default].")
-
-    parser.add_option("-b", "--bam-file", dest="bam_files",
-                      type="string", metavar="bam",
-                      help="filename with read mapping information. "
-                      "Multiple files can be submitted in a "
-                      "comma-separated list [default=%default].")
-
-    parser.add_option("-i", "--bigwig-file", dest="bigwig_file",
-                      type="string", metavar="bigwig",
-                      help="filename with bigwig information "
-                      "[default=%default].")
-
-    parser.add_option("-f", "--gff-file", dest="filename_gff",
-                      type="string", action="append", metavar='bed',
-                      help="filename with extra gff files. The order "
-                      "is important [default=%default].")
-
-    parser.add_option("--filename-format", dest="filename_format",
-                      type="choice",
-                      choices=("bed", "gff", "gtf"),
-                      help="format of secondary stream [default=%default].")
-
-    parser.add_option("--restrict-source", dest="gff_sources", type="string",
-                      action="append",
-                      help="restrict input to this 'source' in extra "
-                      "gff file (for counter: overlap) [default=%default].")
-
-    parser.add_option("--restrict-feature", dest="gff_features", type="string",
-                      action="append",
-                      help="restrict input to this 'feature' in extra gff "
-                      "file (for counter: overlap) [default=%default].")
-
-    parser.add_option("-r", "--reporter", dest="reporter", type="choice",
-                      choices=("genes", "transcripts"),
-                      help="report results for 'genes' or 'transcripts' "
-                      "[default=%default].")
-
-    parser.add_option("-s", "--section", dest="sections",
-                      type="choice",
-                      action="append",
-                      choices=("exons", "introns"),
-                      help="select range on which counters will operate "
-                      "[default=%default].")
-
-    parser.add_option("-c", "--counter", dest="counters",
-                      type="choice",
-                      action="append",
-                      choices=(	"bigwig-counts",
-                                "binding-pattern",
-                                "classifier",
-                                "classifier-rnaseq",
-                                "classifier-rnaseq-splicing",
-                                "classifier-polii",
-                                "composition-na",
-                                "composition-cpg",
-                                "coverage",
-                                "distance",
-                                "distance-genes",
-                                "distance-tss",
-                                "length",
-                                'neighbours',
-                                "overlap",
-                                "overlap-stranded",
-                                "overlap-transcripts",
-                                "overrun",
-                                "position",
-                                "proximity",
-                                "proximity-exclusive",
-                                "proximity-lengthmatched",
-                                "quality",
-                                "read-coverage",
-                                "read-extension",
-                                "read-overlap",
-                                "read-counts",
-                                "read-fullcounts",
-                                "readpair-counts",
-                                "readpair-fullcounts",
-                                "splice",
-                                "splice-comparison",
-                                "territories"),
-                      help="select counters to apply to input "
-                      "[default=%default].")
-
-    parser.add_option("--add-gtf-source", dest="add_gtf_source",
-                      action="store_true",
-                      help="add gtf field of source to output "
-                      "[default=%default].")
+def buildCounters(options):
+    """build the list of counters selected in *options*.
 
-    parser.add_option("--proximal-distance", dest="proximal_distance",
-                      type="int",
-                      help="distance to be considered proximal to "
-                      "an interval [default=%default].")
-
-    parser.add_option("--multi-mapping-method",
-                      dest="multi_mapping",
-                      type="choice",
-                      choices=('all', 'ignore', 'weight'),
-                      help="how to treat multi-mapping reads in "
-                      "bam-files. Requires "
-                      "the NH flag to be set by the mapper "
-                      "[default=%default].")
-
-    parser.add_option("--use-barcodes",
-                      dest="use_barcodes",
-                      action="store_true",
-                      help="Use barcodes to count unique umi's. "
-                      "UMI's are specified in the read identifier "
-                      "as the last field, where fields are separated "
-                      "by underscores, e.g. "
-                      "@READ:ILLUMINA:STUFF_NAMINGSTUFF_UMI. "
-                      "When true, unique counts are returned. "
-                      "Currently only compatible with count-reads")
-
-    parser.add_option("--sample-probability",
-                      dest="sample_probability",
-                      type="float",
-                      help="Specify the probability of whether any"
-                      "given read or read pair in a file bam is counted"
-                      "Currently only compatible with count-reads")
-
-    parser.add_option("--column-prefix", dest="prefixes",
-                      type="string",
-                      action="append",
-                      help="add prefix to column headers - prefixes "
-                      "are used in the same order as the counters "
-                      "[default=%default].")
-
-    parser.add_option("--library-type",
-                      dest="library_type",
-                      type="choice",
-                      choices=("unstranded",
-                               "firststrand",
-                               "secondstrand",
-                               "fr-unstranded",
-                               "fr-firststrand",
-                               "fr-secondstrand"),
-                      help="library type of reads in bam file. "
-                      "[default=%default]")
-
-    parser.add_option("--min-mapping-quality",
-                      dest="minimum_mapping_quality",
-                      type="float",
-                      help="minimum mapping quality. Reads with a quality "
-                      "score of less will be ignored. "
-                      "[default=%default]")
-
-    parser.set_defaults(
-        genome_file=None,
-        reporter="genes",
-        with_values=True,
-        sections=[],
-        counters=[],
-        filename_gff=[],
-        filename_format=None,
-        gff_features=[],
-        gff_sources=[],
-        add_gtf_source=False,
-        proximal_distance=10000,
-        bam_files=None,
-        multi_mapping='all',
-        library_type='fr-unstranded',
-        prefixes=[],
-        minimum_mapping_quality=0,
-        use_barcodes=False,
-        sample_probability=1.0
-    )
-
-    if not argv:
-        argv = sys.argv
-
-    (options, args) = E.Start(parser, add_output_options=True, argv=argv)
-
-    if options.prefixes:
-        if len(options.prefixes) != len(options.counters):
-            raise ValueError(
-                "if any prefix is given, the number of prefixes "
-                "must be the same as the number of counters")
+    Genome, quality, bam and bigwig files are opened by this
+    function, so that every process calling it obtains its own
+    file handles.
+    """
 
     # get files
     if options.genome_file:
@@ -686,17 +518,6 @@ def main(argv=None):
 
     counters = []
 
-    if not options.sections:
-        E.info("counters will use the default section (exons)")
-        options.sections.append(None)
-
-    if not options.gff_sources:
-        options.gff_sources.append(None)
-    if not options.gff_features:
-        options.gff_features.append(None)
-
-    cc = E.Counter()
-
     for n, c in enumerate(options.counters):
         if options.prefixes:
             prefix = options.prefixes[n]
@@ -900,12 +721,17 @@ def main(argv=None):
                 options=options,
                 prefix=prefix))
 
+    return counters
+
+
+def buildReporter(options):
+    """return header and functions returning the row prefix for
+    the reporter selected in *options*."""
+
     if options.reporter == "genes":
-        iterator = GTF.flat_gene_iterator
         header = ["gene_id"]
         fheader = lambda x: [x[0].gene_id]
     elif options.reporter == "transcripts":
-        iterator = GTF.transcript_iterator
         header = ["transcript_id"]
         fheader = lambda x: [x[0].transcript_id]
 
@@ -915,30 +741,376 @@ def main(argv=None):
     else:
         ffields = lambda x: []
 
-    options.stdout.write("\t".join(
-        header + [x.getHeader() for x in counters]) + "\n")
+    return header, fheader, ffields
 
-    for gffs in iterator(GTF.iterator(options.stdin)):
-        cc.input += 1
 
-        for counter in counters:
-            counter.update(gffs)
+def annotate(gffs, counters, fheader, ffields):
+    """apply *counters* to gene or transcript *gffs*.
 
-        skip = len([x for x in counters if x.skip]) == len(counters)
-        if skip:
-            cc.skipped += 1
-            continue
+    Returns the output row or None if all counters
+    skipped the entry.
+    """
+    for counter in counters:
+        counter.update(gffs)
+
+    skip = len([x for x in counters if x.skip]) == len(counters)
+    if skip:
+        return None
+
+    return "\t".join(
+        fheader(gffs) +
+        ffields(gffs) +
+        [str(counter) for counter in counters])
 
-        options.stdout.write("\t".join(
-            fheader(gffs) +
-            ffields(gffs) +
-            [str(counter) for counter in counters]) + "\n")
 
-        cc.output += 1
+def getWorkerCounters():
+    """return counters and reporter of a worker process.
+
+    Counters are built on first use so that each worker opens
+    its own file handles. Errors during construction are thus
+    reported back to the parent process.
+    """
+    state = E.WORKER_STATE
+    if "counters" not in state:
+        options = state["options"]
+        state["counters"] = buildCounters(options)
+        state["reporter"] = buildReporter(options)
+    return state["counters"], state["reporter"]
+
+
+def describeWorker():
+    """return column headers and names of the counters in a worker."""
+    counters, reporter = getWorkerCounters()
+    return ([x.getHeader() for x in counters],
+            [repr(x) for x in counters])
+
+
+def countChunk(chunk):
+    """apply counters in a worker process to a chunk of genes.
+
+    *chunk* is a list of genes or transcripts, each given as a list
+    of :term:`gtf` formatted lines.
+
+    Returns a tuple of output rows (None for skipped entries) and
+    the counts collected by each counter while processing the chunk.
+    """
+    counters, reporter = getWorkerCounters()
+    header, fheader, ffields = reporter
 
-    E.info("%s" % str(cc))
     for counter in counters:
-        E.info("%s\t%s" % (repr(counter), str(counter.counter)))
+        counter.counter = E.Counter()
+
+    rows = []
+    for lines in chunk:
+        gffs = list(GTF.iterator(
+            StringIO("\n".join(lines) + "\n")))
+        rows.append(annotate(gffs, counters, fheader, ffields))
+
+    return rows, [dict(counter.counter.items()) for counter in counters]
+
+
+def iterateChunks(gene_iterator, chunk_size):
+    """group genes from *gene_iterator* into chunks of *chunk_size*.
+
+    Entries are converted to :term:`gtf` formatted lines so that they
+    can be sent to worker processes.
+    """
+    chunk = []
+    for gffs in gene_iterator:
+        chunk.append([str(x) for x in gffs])
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def main(argv=None):
+
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("-g", "--genome-file", dest="genome_file", type="string",
+                      help="filename with genome [default=%default].")
+
+    parser.add_option("-q", "--quality-file",
+                      dest="quality_file",
+                      type="string",
+                      help="filename with genomic base quality "
+                      "information [default=%default].")
+
+    parser.add_option("-b", "--bam-file", dest="bam_files",
+                      type="string", metavar="bam",
+                      help="filename with read mapping information. "
+                      "Multiple files can be submitted in a "
+                      "comma-separated list [default=%default].")
+
+    parser.add_option("-i", "--bigwig-file", dest="bigwig_file",
+                      type="string", metavar="bigwig",
+                      help="filename with bigwig information "
+                      "[default=%default].")
+
+    parser.add_option("-f", "--gff-file", dest="filename_gff",
+                      type="string", action="append", metavar='bed',
+                      help="filename with extra gff files. The order "
+                      "is important [default=%default].")
+
+    parser.add_option("--filename-format", dest="filename_format",
+                      type="choice",
+                      choices=("bed", "gff", "gtf"),
+                      help="format of secondary stream [default=%default].")
+
+    parser.add_option("--restrict-source", dest="gff_sources", type="string",
+                      action="append",
+                      help="restrict input to this 'source' in extra "
+                      "gff file (for counter: overlap) [default=%default].")
+
+    parser.add_option("--restrict-feature", dest="gff_features", type="string",
+                      action="append",
+                      help="restrict input to this 'feature' in extra gff "
+                      "file (for counter: overlap) [default=%default].")
+
+    parser.add_option("-r", "--reporter", dest="reporter", type="choice",
+                      choices=("genes", "transcripts"),
+                      help="report results for 'genes' or 'transcripts' "
+                      "[default=%default].")
+
+    parser.add_option("-s", "--section", dest="sections",
+                      type="choice",
+                      action="append",
+                      choices=("exons", "introns"),
+                      help="select range on which counters will operate "
+                      "[default=%default].")
+
+    parser.add_option("-c", "--counter", dest="counters",
+                      type="choice",
+                      action="append",
+                      choices=(	"bigwig-counts",
+                                "binding-pattern",
+                                "classifier",
+                                "classifier-rnaseq",
+                                "classifier-rnaseq-splicing",
+                                "classifier-polii",
+                                "composition-na",
+                                "composition-cpg",
+                                "coverage",
+                                "distance",
+                                "distance-genes",
+                                "distance-tss",
+                                "length",
+                                'neighbours',
+                                "overlap",
+                                "overlap-stranded",
+                                "overlap-transcripts",
+                                "overrun",
+                                "position",
+                                "proximity",
+                                "proximity-exclusive",
+                                "proximity-lengthmatched",
+                                "quality",
+                                "read-coverage",
+                                "read-extension",
+                                "read-overlap",
+                                "read-counts",
+                                "read-fullcounts",
+                                "readpair-counts",
+                                "readpair-fullcounts",
+                                "splice",
+                                "splice-comparison",
+                                "territories"),
+                      help="select counters to apply to input "
+                      "[default=%default].")
+
+    parser.add_option("--add-gtf-source", dest="add_gtf_source",
+                      action="store_true",
+                      help="add gtf field of source to output "
+                      "[default=%default].")
+
+    parser.add_option("--proximal-distance", dest="proximal_distance",
+                      type="int",
+                      help="distance to be considered proximal to "
+                      "an interval [default=%default].")
+
+    parser.add_option("--multi-mapping-method",
+                      dest="multi_mapping",
+                      type="choice",
+                      choices=('all', 'ignore', 'weight'),
+                      help="how to treat multi-mapping reads in "
+                      "bam-files. Requires "
+                      "the NH flag to be set by the mapper "
+                      "[default=%default].")
+
+    parser.add_option("--use-barcodes",
+                      dest="use_barcodes",
+                      action="store_true",
+                      help="Use barcodes to count unique umi's. "
+                      "UMI's are specified in the read identifier "
+                      "as the last field, where fields are separated "
+                      "by underscores, e.g. "
+                      "@READ:ILLUMINA:STUFF_NAMINGSTUFF_UMI. "
+                      "When true, unique counts are returned. "
+                      "Currently only compatible with count-reads")
+
+    parser.add_option("--sample-probability",
+                      dest="sample_probability",
+                      type="float",
+                      help="Specify the probability of whether any"
+                      "given read or read pair in a file bam is counted"
+                      "Currently only compatible with count-reads")
+
+    parser.add_option("--column-prefix", dest="prefixes",
+                      type="string",
+                      action="append",
+                      help="add prefix to column headers - prefixes "
+                      "are used in the same order as the counters "
+                      "[default=%default].")
+
+    parser.add_option("--library-type",
+                      dest="library_type",
+                      type="choice",
+                      choices=("unstranded",
+                               "firststrand",
+                               "secondstrand",
+                               "fr-unstranded",
+                               "fr-firststrand",
+                               "fr-secondstrand"),
+                      help="library type of reads in bam file. "
+                      "[default=%default]")
+
+    parser.add_option("--min-mapping-quality",
+                      dest="minimum_mapping_quality",
+                      type="float",
+                      help="minimum mapping quality. Reads with a quality "
+                      "score of less will be ignored. "
+                      "[default=%default]")
+
+    parser.add_option("--num-threads", "--num-processes",
+                      dest="num_threads",
+                      type="int",
+                      help="number of worker processes to use. If larger "
+                      "than 1, genes are counted in parallel "
+                      "[default=%default]")
+
+    parser.add_option("--chunk-size",
+                      dest="chunk_size",
+                      type="int",
+                      help="number of genes or transcripts sent to a "
+                      "worker process at a time [default=%default]")
+
+    parser.set_defaults(
+        genome_file=None,
+        reporter="genes",
+        with_values=True,
+        sections=[],
+        counters=[],
+        filename_gff=[],
+        filename_format=None,
+        gff_features=[],
+        gff_sources=[],
+        add_gtf_source=False,
+        proximal_distance=10000,
+        bam_files=None,
+        multi_mapping='all',
+        library_type='fr-unstranded',
+        prefixes=[],
+        minimum_mapping_quality=0,
+        use_barcodes=False,
+        sample_probability=1.0,
+        num_threads=1,
+        chunk_size=100,
+    )
+
+    if not argv:
+        argv = sys.argv
+
+    (options, args) = E.Start(parser, add_output_options=True, argv=argv)
+
+    if options.prefixes:
+        if len(options.prefixes) != len(options.counters):
+            raise ValueError(
+                "if any prefix is given, the number of prefixes "
+                "must be the same as the number of counters")
+
+    if not options.sections:
+        E.info("counters will use the default section (exons)")
+        options.sections.append(None)
+
+    if not options.gff_sources:
+        options.gff_sources.append(None)
+    if not options.gff_features:
+        options.gff_features.append(None)
+
+    if options.reporter == "genes":
+        iterator = GTF.flat_gene_iterator
+    elif options.reporter == "transcripts":
+        iterator = GTF.transcript_iterator
+
+    header, fheader, ffields = buildReporter(options)
+
+    cc = E.Counter()
+
+    if options.num_threads > 1:
+        if "read-extension" in options.counters:
+            raise ValueError(
+                "counter read-extension can not be run with "
+                "multiple processes")
+
+        # file handles can not be sent to worker processes
+        worker_options = copy.copy(options)
+        for x in ("stdin", "stdout", "stdlog", "stderr"):
+            setattr(worker_options, x, None)
+
+        pool = E.getWorkerPool(options.num_threads,
+                               options=worker_options)
+
+        headers, names = pool.apply(describeWorker)
+        options.stdout.write("\t".join(header + headers) + "\n")
+
+        counter_counts = [E.Counter() for x in names]
+
+        # imap returns results in input order
+        for rows, counts in pool.imap(
+                countChunk,
+                iterateChunks(iterator(GTF.iterator(options.stdin)),
+                              options.chunk_size)):
+            for row in rows:
+                cc.input += 1
+                if row is None:
+                    cc.skipped += 1
+                    continue
+                options.stdout.write(row + "\n")
+                cc.output += 1
+
+            for counter, c in zip(counter_counts, counts):
+                counter += c
+
+        pool.close()
+        pool.join()
+
+        E.info("%s" % str(cc))
+        for name, counter in zip(names, counter_counts):
+            E.info("%s\t%s" % (name, str(counter)))
+    else:
+        counters = buildCounters(options)
+
+        options.stdout.write("\t".join(
+            header + [x.getHeader() for x in counters]) + "\n")
+
+        for gffs in iterator(GTF.iterator(options.stdin)):
+            cc.input += 1
+
+            row = annotate(gffs, counters, fheader, ffields)
+            if row is None:
+                cc.skipped += 1
+                continue
+
+            options.stdout.write(row + "\n")
+            cc.output += 1
+
+        E.info("%s" % str(cc))
+        for counter in counters:
+            E.info("%s\t%s" % (repr(counter), str(counter.counter)))
+
     E.Stop()
 
 if __name__ == "__main__":
@@ -26,6 +26,15 @@ Alternatively, the sequence can be block-compressed using different
 compression methods (gzip, lzo, bzip). These are mostly for research
 purposes.
 
+For workloads with many random accesses, ``--compression=mmap``
+stores the sequences without headers or line breaks together with a
+binary index. The database is memory mapped and fragments are sliced
+directly from the map without file positioning. Supply several
+databases with ``--benchmark`` to compare storage methods::
+
+   python index_fasta.py --benchmark hg19 hg19_mmap
+
+
 See also http://pypi.python.org/pypi/pyfasta for another
 implementation.  Samtools provides similar functionality with the
 ``samtools faidx`` command and block compression has been implemented
@@ -122,7 +131,8 @@ def main(argv=None):
     group = E.OptionGroup(parser, "Bencharking options")
     group.add_option("-b", "--benchmark", dest="benchmark",
                      action="store_true",
-                     help="benchmark time for read access "
+                     help="benchmark time for read access. If several "
+                     "databases are given, report each of them "
                      "[default=%default].")
     group.add_option("--benchmark-num-iterations",
                      dest="benchmark_num_iterations",
@@ -182,7 +192,8 @@ def main(argv=None):
                       ", ".join(translator_choices))
 
     group = E.OptionGroup(parser, 'Compression options')
-    compression_choices = ("lzo", "zlib", "gzip", "dictzip", "bzip2", "debug")
+    compression_choices = ("lzo", "zlib", "gzip", "dictzip", "bzip2", "debug",
+                           "mmap")
     group.add_option("-c", "--compression", dest="compression", type="choice",
                      choices=compression_choices,
                      help="compress database, using specified compression "
@@ -264,6 +275,17 @@ def main(argv=None):
         options.stdout.write(">%s\n%s\n" %
                              (options.extract, sequence))
 
+    elif options.benchmark and len(args) > 1:
+        results = IndexedFasta.benchmarkDatabases(
+            args,
+            num_iterations=options.benchmark_num_iterations,
+            fragment_size=options.benchmark_fragment_size)
+        options.stdout.write("database\tmethod\titer\tsize\ttime\n")
+        for dbname, method, t in results:
+            options.stdout.write("%s\t%s\t%i\t%i\t%f\n" % (
+                dbname, method,
+                options.benchmark_num_iterations,
+                options.benchmark_fragment_size, t))
     elif options.benchmark:
         import timeit
         timer = timeit.Timer(
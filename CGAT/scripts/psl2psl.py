@@ -56,6 +56,13 @@ remove-overlapping-target
    remove all alignments that are not unique with respect to a target segment
    (requires alignments to be sorted by target)
 
+The methods select-query, remove-overlapping-query and
+remove-overlapping-target read the complete input into memory
+column by column (see :func:`Blat.read_columnar`) and select
+alignments with array operations. filter-remove uses the same
+representation to find alignments that do not overlap any interval
+and outputs them without building an alignment.
+
 Usage
 -----
 
@@ -79,6 +86,7 @@ import sys
 import time
 import collections
 import warnings
+import numpy
 import alignlib_lite
 import CGAT.Experiment as E
 import CGAT.Genomics as Genomics
@@ -140,10 +148,10 @@ def readIntervals(infile, options):
     return index
 
 
-def iterator_psl_intervals(options):
-    """iterate over psl file yield an entry together with overlapping entries.
+def readFilterIntervals(options):
+    """return intervals in query and target to filter with.
 
-    returns tuples of (match, list(query_intervals), list(target_intervals))
+    Either index is None if no filename has been given.
     """
 
     if options.filename_filter_query:
@@ -158,6 +166,46 @@ def iterator_psl_intervals(options):
     else:
         intervals_target = None
 
+    return intervals_query, intervals_target
+
+
+def countIntervalOverlaps(intervals, ids, codes, starts, ends):
+    """return array with the number of intervals overlapping each
+    alignment.
+
+    The alignments are given by arrays of interned sequence
+    identifiers (*ids*, *codes*) and coordinates (*starts*, *ends*).
+    """
+
+    counts = numpy.zeros(len(codes), dtype=numpy.int64)
+    if intervals is None or len(codes) == 0:
+        return counts
+
+    order = numpy.argsort(codes, kind="mergesort")
+    sorted_codes = codes[order]
+    present = numpy.unique(sorted_codes)
+    boundaries = numpy.searchsorted(sorted_codes, present, side="left")
+    boundaries = numpy.append(boundaries, len(codes))
+
+    for code, start, end in zip(present, boundaries[:-1], boundaries[1:]):
+        indices = order[start:end]
+        try:
+            counts[indices] = intervals.count_overlaps(
+                ids[code], starts[indices], ends[indices])
+        except KeyError:
+            pass
+
+    return counts
+
+
+def iterator_psl_intervals(options):
+    """iterate over psl file yield an entry together with overlapping entries.
+
+    returns tuples of (match, list(query_intervals), list(target_intervals))
+    """
+
+    intervals_query, intervals_target = readFilterIntervals(options)
+
     iterator = Blat.BlatIterator(options.stdin)
 
     ninput = 0
@@ -220,15 +268,48 @@ def pslFilter(options, keep=True):
     if keep:
         raise NotImplementedError("not implemented")
     else:
-        for match, qx, tx in iterator_psl_intervals(options):
+        intervals_query, intervals_target = readFilterIntervals(options)
+
+        psl = Blat.read_columnar(options.stdin)
+        if options.test:
+            psl = psl.select(numpy.arange(min(len(psl), options.test - 1)))
+        ninput = len(psl)
+
+        # alignments not overlapping any interval are output unchanged
+        overlaps = countIntervalOverlaps(
+            intervals_query, psl.query_ids, psl.query_codes,
+            psl.query_from, psl.query_to) + countIntervalOverlaps(
+            intervals_target, psl.sbjct_ids, psl.sbjct_codes,
+            psl.sbjct_from, psl.sbjct_to)
+
+        last = 0
+        for index in numpy.flatnonzero(overlaps):
+
+            if index > last:
+                psl.select(numpy.arange(last, index)).write(options.stdout)
+                noutput += index - last
+            last = index + 1
+
+            match = psl[index]
+            qx, tx = [], []
+            if intervals_query:
+                try:
+                    qx = list(intervals_query.get(match.mQueryId,
+                                                  match.mQueryFrom,
+                                                  match.mQueryTo))
+                except KeyError:
+                    pass
+
+            if intervals_target:
+                try:
+                    tx = list(intervals_target.get(match.mSbjctId,
+                                                   match.mSbjctFrom,
+                                                   match.mSbjctTo))
+                except KeyError:
+                    pass
 
             map_query2target = match.getMapQuery2Target()
 
-            if not qx and not tx:
-                options.stdout.write(str(match) + "\n")
-                noutput += 1
-                continue
-
             if qx:
                 for qstart, qend, v in qx:
                     if match.strand == "-":
@@ -247,6 +328,10 @@ def pslFilter(options, keep=True):
             else:
                 ndiscarded += 1
 
+        if len(psl) > last:
+            psl.select(numpy.arange(last, len(psl))).write(options.stdout)
+            noutput += len(psl) - last
+
     E.info("ninput=%i, noutput=%i, nskipped=%i, ndiscarded=%i" %
            (ninput, noutput, nskipped, ndiscarded))
 
@@ -692,36 +777,69 @@ def pslComplementQuery(options):
 
 
 def pslSelectQuery(options):
+    """select a single alignment per query.
+
+    Alignments are grouped by runs of consecutive alignments of the
+    same query. The alignment with the most or least matches (or
+    mismatches) in each run is selected. Ties are resolved by taking
+    the last (most) or first (least) alignment in the file. Runs are
+    output in file order.
+    """
 
     ninput, noutput, ndiscarded, nskipped = 0, 0, 0, 0
 
     value, field = options.select.split("-")
 
+    psl = Blat.read_columnar(options.stdin)
+
     if field == "nmatches":
-        f = lambda x: x.mNMatches
+        values = psl.nmatches
     elif field == "nmismatches":
-        f = lambda x: x.mNMisMatches
-
-    for data in Blat.iterator_per_query(Blat.iterator(options.stdin)):
+        values = psl.nmismatches
+
+    # number runs of consecutive alignments of the same query
+    runs = numpy.zeros(len(psl), dtype=numpy.int64)
+    numpy.cumsum(psl.query_codes[1:] != psl.query_codes[:-1],
+                 out=runs[1:])
+
+    # sort by run, value and position in file
+    order = numpy.lexsort((numpy.arange(len(psl)), values, runs))
+    codes = runs[order]
+    if value == "most":
+        selected = numpy.ones(len(codes), dtype=bool)
+        selected[:-1] = codes[:-1] != codes[1:]
+    elif value == "least":
+        selected = numpy.ones(len(codes), dtype=bool)
+        selected[1:] = codes[1:] != codes[:-1]
+    selected = order[selected]
+
+    ninput = len(selected)
+    if options.test:
+        selected = selected[:options.test - 1]
+
+    psl.select(selected).write(options.stdout)
+    noutput = len(selected)
 
-        ninput += 1
-        if options.test and ninput >= options.test:
-            break
+    E.info("ninput=%i, noutput=%i, nskipped=%i, ndiscarded=%i" %
+           (ninput, noutput, nskipped, ndiscarded))
 
-        if ninput % options.report_step == 0:
-            E.info("progress: ninput=%i, noutput=%i" % (ninput, noutput))
 
-        data.sort(key=f)
+def pslRemoveOverlapping(psl, options, by_query=False):
+    """remove alignments that overlap other alignments.
 
-        if value == "most":
-            options.stdout.write("%s\n" % str(data[-1]))
-        elif value == "least":
-            options.stdout.write("%s\n" % str(data[0]))
+    Alignments need to be sorted by query (*by_query*) or target.
+    Returns a :class:`Blat.ColumnarPSL` with the remaining alignments.
+    """
 
-        noutput += 1
+    clusters = Blat.getOverlapClusters(psl,
+                                       options.threshold_merge_distance,
+                                       by_query=by_query)
+    sizes = numpy.bincount(clusters)
+    result = psl.select(sizes[clusters] == 1)
 
-    E.info("ninput=%i, noutput=%i, nskipped=%i, ndiscarded=%i" %
-           (ninput, noutput, nskipped, ndiscarded))
+    E.info("pslRemoveOverlapping: ninput=%i, noutput=%i, ndiscarded=%i" %
+           (len(psl), len(result), len(psl) - len(result)))
+    return result
 
 
 def iterator_filter_overlapping_query(psls, options):
@@ -1042,6 +1160,18 @@ def main(argv=None):
         elif options.header == "full":
             options.stdout.write(Blat.HEADER + "\n")
 
+    if options.methods and all(
+            x in ("remove-overlapping-query", "remove-overlapping-target")
+            for x in options.methods):
+        psl = Blat.read_columnar(options.stdin)
+        for method in options.methods:
+            psl = pslRemoveOverlapping(
+                psl, options,
+                by_query=method == "remove-overlapping-query")
+        psl.write(options.stdout)
+        E.Stop()
+        return
+
     for method in options.methods:
 
         if "map" == method:
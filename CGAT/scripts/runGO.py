@@ -125,6 +125,13 @@ The command below runs a GO analysis, computing an FDR using 10.000 samples::
         --output-filename-pattern='result/%(set)s.%(go)s.%(section)s'
    > go.log
 
+Samples are drawn in batches of ``--sample-batch-size`` samples. The
+GO assignments of the background genes are stored in a sparse matrix
+so that the category counts of a whole batch are computed with a
+single matrix product. Batches can be distributed across several
+processes with ``--num-threads``. Each batch is seeded separately, so
+the results do not depend on the number of processes.
+
 The output will be stored in the directory :file:`result` and output
 files will be created according to the pattern
 ``<set>.<go>.<section>``. ``<set>`` is the gene set that is analysed,
@@ -146,6 +153,22 @@ output are:
 |fg          |assigments for genes in the foreground set    |
 +------------+----------------------------------------------+
 
+Analysing many gene lists
++++++++++++++++++++++++++
+
+All gene lists in ``--genes-tsv-file`` are tested against the same
+GO assignments. Category counts for all gene lists are computed with
+a single sparse matrix product and the probabilities for all gene
+lists and categories are computed together. With ``--num-threads``,
+chunks of gene lists are processed in separate processes.
+
+Reading the GO assignments and the ontology can take a considerable
+amount of time. With ``--cache-dir``, the parsed assignments and
+ontology are stored in a binary cache file and re-used in subsequent
+runs as long as the input files do not change. The cache also stores
+the assignments propagated to ancestral terms with
+``--propagate-ancestors``.
+
 Other options
 +++++++++++++
 
@@ -187,6 +210,44 @@ def connectToEnsembl(options):
     return dbhandle
 
 
+def readAnnotations(filename_input=None,
+                    filename_ontology=None,
+                    propagate=False):
+    '''read GO category assignments and the ontology.
+
+    If *propagate* is set, the ancestral terms of each assigned
+    category are added to the assignments.
+
+    returns a tuple (gene2gos, go2infos, ontology).
+    '''
+    gene2gos, go2infos, ontology = {}, {}, None
+
+    if filename_input:
+        E.info("reading association of categories and genes from %s" %
+               (filename_input))
+        infile = IOTools.openFile(filename_input)
+        gene2gos, go2infos = GO.ReadGene2GOFromFile(infile)
+        infile.close()
+
+    if filename_ontology:
+        E.info("reading ontology from %s" % (filename_ontology))
+        infile = IOTools.openFile(filename_ontology)
+        ontology = GO.readOntology(infile)
+        infile.close()
+
+    if propagate:
+        if ontology is None:
+            raise ValueError(
+                "propagating ancestral terms requires an ontology")
+        E.info("propagating assignments to ancestral terms")
+        ancestors = GO.buildAncestors(ontology)
+        for go_type, gene2go in gene2gos.items():
+            gene2gos[go_type] = GO.propagateGene2GO(
+                gene2go, ancestors, ontology)
+
+    return gene2gos, go2infos, ontology
+
+
 def main(argv=None):
 
     parser = E.OptionParser(
@@ -259,6 +320,26 @@ def main(argv=None):
         "--sample-size", dest="sample", type="int",
         help="do sampling (with # samples) [default=%default].")
 
+    parser.add_option(
+        "--sample-batch-size", dest="sample_batch_size", type="int",
+        help="number of samples to compute together when sampling "
+        "[default=%default].")
+
+    parser.add_option(
+        "--num-threads", "--threads", dest="num_threads", type="int",
+        help="number of processes to use for sampling and for "
+        "analysing gene lists [default=%default].")
+
+    parser.add_option(
+        "--cache-dir", dest="cache_dir", type="string",
+        help="directory to cache GO assignments and ontology in "
+        "between runs [default=%default].")
+
+    parser.add_option(
+        "--propagate-ancestors", dest="propagate", action="store_true",
+        help="add ancestral terms in the ontology to the GO assignments "
+        "of each gene [default=%default].")
+
     parser.add_option(
         "--filename-output-pattern", "--output-filename-pattern",
         dest="output_filename_pattern", type="string",
@@ -320,6 +401,10 @@ def main(argv=None):
                         ontology=[],
                         filename_dump=None,
                         sample=0,
+                        sample_batch_size=100,
+                        num_threads=1,
+                        cache_dir=None,
+                        propagate=False,
                         fdr=False,
                         output_filename_pattern=None,
                         threshold=0.05,
@@ -365,13 +450,18 @@ def main(argv=None):
         sys.exit(0)
 
     #############################################################
-    # read GO categories from file
-    if options.filename_input:
-        E.info("reading association of categories and genes from %s" %
-               (options.filename_input))
-        infile = IOTools.openFile(options.filename_input)
-        gene2gos, go2infos = GO.ReadGene2GOFromFile(infile)
-        infile.close()
+    # read GO categories and ontology from file
+    kwargs = dict(filename_input=options.filename_input,
+                  filename_ontology=options.filename_ontology,
+                  propagate=options.propagate)
+    if options.cache_dir:
+        gene2gos, go2infos, ontology = GO.loadCached(
+            (options.filename_input, options.filename_ontology),
+            readAnnotations,
+            options.cache_dir,
+            **kwargs)
+    else:
+        gene2gos, go2infos, ontology = readAnnotations(**kwargs)
 
     if options.filename_gene2name:
         E.info("reading gene identifier to gene name mapping from %s" %
@@ -387,13 +477,8 @@ def main(argv=None):
         gene2name = dict([(x, x) for x in list(gene2gos.keys())])
 
     #############################################################
-    # read GO ontology from file
+    # substitute GO descriptions from ontology
     if options.filename_ontology:
-        E.info("reading ontology from %s" % (options.filename_ontology))
-
-        infile = IOTools.openFile(options.filename_ontology)
-        ontology = GO.readOntology(infile)
-        infile.close()
 
         def _g():
             return collections.defaultdict(GO.GOInfo)
@@ -505,9 +590,52 @@ def main(argv=None):
                    "to %i categories (%i maps)" % (
                        ngenes, ncategories, nmaps))
 
+        #############################################################
+        # read GO slims and map GO categories to GO slim categories
+        if options.filename_slims:
+            go_slims = GO.GetGOSlims(
+                IOTools.openFile(options.filename_slims, "r"))
+
+            if options.loglevel >= 1:
+                v = set()
+                for x in list(go_slims.values()):
+                    for xx in x:
+                        v.add(xx)
+                options.stdlog.write(
+                    "# read go slims from %s: go=%i, slim=%i\n" %
+                    (options.filename_slims,
+                     len(go_slims),
+                     len(v)))
+
+            if options.filename_map_slims:
+                if options.filename_map_slims == "-":
+                    outfile = options.stdout
+                else:
+                    outfile = IOTools.openFile(
+                        options.filename_map_slims, "w")
+
+                outfile.write("GO\tGOSlim\n")
+                for go, go_slim in sorted(list(go_slims.items())):
+                    outfile.write("%s\t%s\n" % (go, go_slim))
+
+                if outfile != options.stdout:
+                    outfile.close()
+
+            gene2go = GO.MapGO2Slims(gene2go, go_slims, ontology=ontology)
+
+            if options.loglevel >= 1:
+                ngenes, ncategories, nmaps, counts_per_category = \
+                    GO.CountGO(gene2go)
+                options.stdlog.write(
+                    "# after go slim filtering: %i genes mapped to "
+                    "%i categories (%i maps)\n" % (
+                        ngenes, ncategories, nmaps))
+
+        #############################################################
+        # build foreground and background for each gene list
+        analyses = []
         for genelist_name, foreground in sorted(genelists.items()):
 
-            msgs = []
             E.info("processing %s with %i genes" %
                    (genelist_name, len(foreground)))
             ##################################################################
@@ -550,46 +678,21 @@ def main(argv=None):
             # missing = set(genes).difference( set(gene2go.keys()) )
             # assert len(missing) == 0, "%i genes in foreground set without GO annotation: %s" % (len(missing), str(missing))
 
-            #############################################################
-            # read GO slims and map GO categories to GO slim categories
-            if options.filename_slims:
-                go_slims = GO.GetGOSlims(
-                    IOTools.openFile(options.filename_slims, "r"))
-
-                if options.loglevel >= 1:
-                    v = set()
-                    for x in list(go_slims.values()):
-                        for xx in x:
-                            v.add(xx)
-                    options.stdlog.write(
-                        "# read go slims from %s: go=%i, slim=%i\n" %
-                        (options.filename_slims,
-                         len(go_slims),
-                         len(v)))
-
-                if options.filename_map_slims:
-                    if options.filename_map_slims == "-":
-                        outfile = options.stdout
-                    else:
-                        outfile = IOTools.openFile(
-                            options.filename_map_slims, "w")
-
-                    outfile.write("GO\tGOSlim\n")
-                    for go, go_slim in sorted(list(go_slims.items())):
-                        outfile.write("%s\t%s\n" % (go, go_slim))
-
-                    if outfile != options.stdout:
-                        outfile.close()
-
-                gene2go = GO.MapGO2Slims(gene2go, go_slims, ontology=ontology)
-
-                if options.loglevel >= 1:
-                    ngenes, ncategories, nmaps, counts_per_category = \
-                        GO.CountGO(gene2go)
-                    options.stdlog.write(
-                        "# after go slim filtering: %i genes mapped to "
-                        "%i categories (%i maps)\n" % (
-                            ngenes, ncategories, nmaps))
+            analyses.append((genelist_name, foreground, background))
+
+        #############################################################
+        # do the analysis for all gene lists at once
+        E.info("analysing %i gene lists" % len(analyses))
+        all_go_results = GO.analyseGOBatch(
+            gene2go,
+            [x[1] for x in analyses],
+            [x[2] for x in analyses],
+            num_threads=options.num_threads)
+
+        for (genelist_name, foreground, background), go_results in \
+                zip(analyses, all_go_results):
+
+            msgs = []
 
             #############################################################
             # Just dump out the gene list
@@ -645,10 +748,6 @@ def main(argv=None):
             if options.output_filename_pattern:
                 outfile.close()
 
-            #############################################################
-            # do the analysis
-            go_results = GO.AnalyseGO(gene2go, foreground, background)
-
             if len(go_results.mSampleGenes) == 0:
                 E.warn("%s: no genes with GO categories - analysis aborted" %
                        genelist_name)
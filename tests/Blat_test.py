@@ -0,0 +1,91 @@
+"""unit testing module for Blat.py."""
+
+import os
+import unittest
+import numpy
+from six import StringIO
+
+import CGAT.Blat as Blat
+import CGAT.IOTools as IOTools
+
+
+class TestColumnar(unittest.TestCase):
+
+    filename = os.path.join("gff2psl.py", "withoutseqs.psl.gz")
+
+    def setUp(self):
+        self.matches = []
+        with IOTools.openFile(self.filename) as inf:
+            for line in inf:
+                if not line.split("\t")[0].isdigit():
+                    continue
+                match = Blat.Match()
+                match.fromTable(line[:-1].split("\t"))
+                self.matches.append(match)
+        self.psl = Blat.read_columnar(self.filename, chunk_size=7)
+
+    def test_number_of_alignments_is_correct(self):
+        self.assertEqual(len(self.psl), len(self.matches))
+
+    def test_alignments_are_identical(self):
+        for a, b in zip(self.psl, self.matches):
+            self.assertEqual(str(a), str(b))
+            self.assertEqual(a.getBlocks(), b.getBlocks())
+            self.assertAlmostEqual(a.mPid, b.mPid)
+
+    def test_write_is_identical(self):
+        outf = StringIO()
+        self.psl.write(outf)
+        self.assertEqual(outf.getvalue().splitlines(),
+                         [str(x) for x in self.matches])
+
+    def test_select(self):
+        selected = self.psl.select(self.psl.nblocks > 1)
+        self.assertEqual([str(x) for x in selected],
+                         [str(x) for x in self.matches if x.mNBlocks > 1])
+        selected = self.psl.select(numpy.array([3, 1]))
+        self.assertEqual([str(x) for x in selected],
+                         [str(self.matches[3]), str(self.matches[1])])
+
+    def test_parsing_error(self):
+        line = str(self.matches[0]).split("\t")
+        line[17] = "100"
+        self.assertRaises(Blat.ParsingError,
+                          Blat.read_columnar,
+                          StringIO("\t".join(line) + "\n"))
+
+
+class TestOverlapClusters(unittest.TestCase):
+
+    def buildPSL(self, intervals):
+        lines = []
+        for contig, start, end in intervals:
+            lines.append("\t".join(map(str, (
+                10, 0, 0, 0, 0, 0, 0, 0, "+", "query", 100, 0, 10,
+                contig, 1000, start, end, 1, "10,", "0,",
+                "%i," % start))))
+        return Blat.read_columnar(StringIO("\n".join(lines) + "\n"))
+
+    def testClusters(self):
+        psl = self.buildPSL((("chr1", 0, 10),
+                             ("chr1", 5, 20),
+                             ("chr1", 8, 12),
+                             ("chr1", 20, 30),
+                             ("chr2", 25, 30)))
+        self.assertEqual(list(Blat.getOverlapClusters(psl)),
+                         [0, 0, 0, 1, 2])
+        self.assertEqual(list(Blat.getOverlapClusters(psl, 1)),
+                         [0, 0, 0, 0, 1])
+
+    def testUnsorted(self):
+        psl = self.buildPSL((("chr1", 0, 10),
+                             ("chr2", 5, 20),
+                             ("chr1", 8, 12)))
+        self.assertRaises(ValueError, Blat.getOverlapClusters, psl)
+        psl = self.buildPSL((("chr1", 10, 20),
+                             ("chr1", 5, 20)))
+        self.assertRaises(ValueError, Blat.getOverlapClusters, psl)
+
+
+if __name__ == "__main__":
+    unittest.main()
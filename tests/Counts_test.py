@@ -1,4 +1,6 @@
 import unittest
+import random
+import numpy
 import pandas
 import CGAT.Counts as Counts
 
@@ -23,3 +25,52 @@ class TestCountsClass(unittest.TestCase):
         self.assertRaises(
             self.counts.removeSamples,
             min_counts_per_sample='3')
+
+
+class TestShuffleCluster(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        nrows = 2000
+        self.df = pandas.DataFrame(
+            {"contig": ["chr1"] * nrows,
+             "position": numpy.arange(nrows) * 5,
+             "A1": numpy.random.rand(nrows) * 100,
+             "A2": numpy.random.rand(nrows) * 100,
+             "B1": numpy.random.rand(nrows) * 100})
+        self.tracks_map = {"A": ["A1", "A2"], "B": ["B1"]}
+        self.clusters = Counts.findClusters(
+            self.df, 100, 10, self.tracks_map, ["A", "B"])
+        self.i_bins = numpy.arange(0, 100, 10)
+        self.c_bins = numpy.arange(-50, 50, 10)
+
+    def shuffle(self, num_threads=1):
+        random.seed(1)
+        return Counts.shuffleCluster(
+            self.i_bins, self.c_bins, self.tracks_map, ["A", "B"],
+            "relative", 5, 3, self.clusters, 9, 1, 2,
+            num_threads=num_threads)
+
+    def test_spike_ins_are_in_their_bins(self):
+        indices, counts = self.shuffle()
+        self.assertGreater(counts.sum(), 0)
+        self.assertTrue((counts <= 5).all())
+        s_bins = list(range(1, 10, 2))
+        for key, values in indices.items():
+            self.assertEqual(len(values), counts[key])
+            for (c1s, c1e, c2s, c2e, r1s, r1e, r2s, r2e) in values:
+                self.assertTrue(c1s <= r1s <= r1e <= c1e)
+                self.assertTrue(c2s <= r2s <= r2e <= c2e)
+                g1 = self.df.loc[r1s:r1e, ["A1", "A2"]].values.mean()
+                g2 = self.df.loc[r2s:r2e, ["B1"]].values.mean()
+                change_idx, initial_idx = Counts.means2idxarrays(
+                    [g1], [g2], self.i_bins, self.c_bins, "relative")
+                size_idx = numpy.digitize([r1e - r1s], s_bins)
+                self.assertEqual(
+                    (initial_idx[0], change_idx[0], size_idx[0]), key)
+
+    def test_results_do_not_depend_on_number_of_processes(self):
+        indices1, counts1 = self.shuffle()
+        indices2, counts2 = self.shuffle(num_threads=2)
+        self.assertTrue((counts1 == counts2).all())
+        self.assertEqual(indices1, indices2)
@@ -0,0 +1,116 @@
+"""unit testing module for Fastq.py."""
+
+import os
+import unittest
+from math import log
+from six import StringIO
+
+import CGAT.Fastq as Fastq
+import CGAT.IOTools as IOTools
+
+
+class TestBatches(unittest.TestCase):
+
+    filename = os.path.join("fastq2fastq.py",
+                            "WTCHG_45714_249_1_sequence.short.fastq.gz")
+
+    def setUp(self):
+        with IOTools.openFile(self.filename) as inf:
+            self.records = list(Fastq.iterate(inf))
+        with IOTools.openFile(self.filename) as inf:
+            self.batches = list(Fastq.iterate_batches(inf, batch_size=7))
+
+    def test_number_of_records_is_correct(self):
+        self.assertEqual(sum(len(x) for x in self.batches),
+                         len(self.records))
+        self.assertTrue(all(len(x) == 7 for x in self.batches[:-1]))
+
+    def test_records_are_identical(self):
+        records = [r for batch in self.batches for r in batch]
+        self.assertEqual([str(x) for x in records],
+                         [str(x) for x in self.records])
+
+    def test_write_is_identical(self):
+        outf = StringIO()
+        for batch in self.batches:
+            batch.write(outf)
+        self.assertEqual(outf.getvalue(),
+                         "".join("%s\n" % x for x in self.records))
+
+    def test_lengths(self):
+        self.assertEqual(
+            [x for batch in self.batches for x in batch.getLengths()],
+            [len(x.seq) for x in self.records])
+
+    def test_guess_format(self):
+        formats = set(Fastq.RANGES.keys())
+        for record in self.records:
+            formats.intersection_update(record.guessFormat())
+        batch_formats = set(Fastq.RANGES.keys())
+        for batch in self.batches:
+            batch_formats.intersection_update(batch.guessFormat())
+        self.assertEqual(formats, batch_formats)
+
+    def test_conversion(self):
+        records = iter(self.records)
+        for batch in self.batches:
+            batch.format = "phred64"
+            batch.fromPhred(batch.toPhred(), "sanger")
+            for a in batch:
+                b = next(records)
+                b.format = "phred64"
+                b.fromPhred(b.toPhred(), "sanger")
+                self.assertEqual(str(a), str(b))
+
+    def test_parsing_errors(self):
+        self.assertRaises(ValueError, list, Fastq.iterate_batches(
+            StringIO("@a\nACGT\n+\n####\nb\nACGT\n+\n####\n")))
+        self.assertRaises(ValueError, list, Fastq.iterate_batches(
+            StringIO("@a\nACGT\n-\n####\n")))
+        self.assertRaises(ValueError, list, Fastq.iterate_batches(
+            StringIO("@a\nACGT\n+\n")))
+        self.assertRaises(ValueError, list, Fastq.iterate_batches(
+            StringIO("@a\nACGT\n+\n###\n")))
+
+
+class TestQualityTables(unittest.TestCase):
+
+    def test_decode(self):
+        log10x = log(10.0) + .499
+        for x in range(33, 127):
+            for format in ("sanger", "illumina-1.8"):
+                self.assertEqual(Fastq.DECODE_TABLES[format][x], x - 33)
+            self.assertEqual(Fastq.DECODE_TABLES["phred64"][x], x - 64)
+            self.assertEqual(
+                Fastq.DECODE_TABLES["solexa"][x],
+                int(10.0 * log(1.0 + 10 ** (x / 10.0), 10) / log10x))
+
+    def test_encode(self):
+        log10x = log(10.0, 10) / 10.0
+        for x in range(1, 60):
+            table = Fastq.ENCODE_TABLES
+            self.assertEqual(table["sanger"][x + Fastq.SCORE_OFFSET], 33 + x)
+            self.assertEqual(table["phred64"][x + Fastq.SCORE_OFFSET], 64 + x)
+            self.assertEqual(
+                table["solexa"][x + Fastq.SCORE_OFFSET],
+                64 + int(10.0 * (log(10 ** (x * log10x) - 1.0, 10))))
+
+    def test_record_conversion(self):
+        record = Fastq.Record("a", "ACGT", "!5IJ")
+        record.format = "sanger"
+        self.assertEqual(record.toPhred(), [0, 20, 40, 41])
+        record.fromPhred(record.toPhred(), "phred64")
+        self.assertEqual(record.quals, "@Thi")
+
+    def test_unencodable_score_raises(self):
+        with IOTools.openFile(TestBatches.filename) as inf:
+            batch = next(Fastq.iterate_batches(inf, batch_size=1))
+        batch.format = "phred64"
+        self.assertRaises(ValueError, batch.fromPhred,
+                          batch.toPhred() - 100, "sanger")
+        self.assertRaises(ValueError, batch.fromPhred,
+                          batch.toPhred(), "integer")
+
+
+if __name__ == "__main__":
+    unittest.main()
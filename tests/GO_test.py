@@ -0,0 +1,278 @@
+"""test GO analysis."""
+
+import collections
+import optparse
+import unittest
+import random
+import tempfile
+import shutil
+import os
+import numpy
+
+import CGAT.GO as GO
+
+
+class GOTestCase(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.gene2go = {}
+        self.go_ids = ["GO:%07i" % x for x in range(20)]
+        for x in range(200):
+            gene_id = "gene%i" % x
+            if x % 10 == 0:
+                continue
+            self.gene2go[gene_id] = [
+                GO.GOInfo(goid=goid)
+                for goid in random.sample(self.go_ids,
+                                          random.randint(1, 5))]
+        self.background = ["gene%i" % x for x in range(200)]
+
+
+class TestHypergeometric(unittest.TestCase):
+
+    def testTails(self):
+        random.seed(0)
+        params = []
+        for x in range(2000):
+            M = random.randint(1, 2000)
+            n = random.randint(0, M)
+            N = random.randint(0, M)
+            k = random.randint(max(0, N - (M - n)), min(n, N))
+            params.append((k, M, n, N))
+        k, M, n, N = [numpy.array(x) for x in zip(*params)]
+        pover, punder = GO.hypergeometricTails(k, M, n, N)
+        for x, (k, M, n, N) in enumerate(params):
+            self.assertAlmostEqual(
+                pover[x],
+                GO.hypergeometric_Q(k - 1, n, M - n, N) if k > 0 else 1.0,
+                places=8)
+            if k < n and k < N:
+                self.assertAlmostEqual(
+                    punder[x],
+                    GO.hypergeometric_P(k, n, M - n, N),
+                    places=8)
+            else:
+                self.assertAlmostEqual(punder[x], 1.0, places=8)
+
+    def testShape(self):
+        pover, punder = GO.hypergeometricTails(
+            numpy.zeros((3, 4)), 100, numpy.arange(4), [[10], [20], [30]])
+        self.assertEqual(pover.shape, (3, 4))
+        self.assertEqual(punder.shape, (3, 4))
+        self.assertTrue(numpy.all(pover == 1.0))
+
+
+class TestSampling(GOTestCase):
+
+    def testMatrix(self):
+        matrix, go_ids = GO.buildGOMatrix(self.gene2go, self.background)
+        self.assertEqual(matrix.shape, (len(self.background), len(go_ids)))
+        total, counts, genes = GO.GetGOFrequencies(self.gene2go,
+                                                   self.background)
+        self.assertEqual(
+            list(numpy.asarray(matrix.sum(axis=0)).ravel()),
+            [counts[x] for x in go_ids])
+
+    def testProbabilities(self):
+        matrix, go_ids = GO.buildGOMatrix(self.gene2go, self.background)
+        for x in range(10):
+            genes = random.sample(self.background, 30)
+            result = GO.AnalyseGO(self.gene2go, genes, self.background)
+            counts = numpy.zeros(len(go_ids))
+            for go_id, r in result.mResults.items():
+                counts[go_ids.index(go_id)] = r.mSampleCountsCategory
+            pover, punder = GO.computeProbabilities(
+                [counts],
+                [len(result.mSampleGenes)],
+                numpy.asarray(matrix.sum(axis=0)).ravel(),
+                len(result.mBackgroundGenes))
+            for go_id, r in result.mResults.items():
+                column = go_ids.index(go_id)
+                self.assertAlmostEqual(
+                    pover[0, column],
+                    r.mProbabilityOverRepresentation, places=6)
+                self.assertAlmostEqual(
+                    punder[0, column],
+                    r.mProbabilityUnderRepresentation, places=6)
+
+    def testSampleCounts(self):
+        matrix, go_ids = GO.buildGOMatrix(self.gene2go, self.background)
+        has_go = numpy.array([x in self.gene2go for x in self.background])
+        counts, totals = GO.sampleGOCounts(matrix, has_go, 30, 50, 1)
+        self.assertEqual(counts.shape, (50, len(go_ids)))
+        self.assertTrue(numpy.all(totals <= 30))
+        background_counts = numpy.asarray(matrix.sum(axis=0)).ravel()
+        self.assertTrue(numpy.all(counts <= background_counts))
+
+        # same seed gives same samples
+        counts2, totals2 = GO.sampleGOCounts(matrix, has_go, 30, 50, 1)
+        self.assertTrue(numpy.all(counts == counts2))
+
+    def testSampleAll(self):
+        matrix, go_ids = GO.buildGOMatrix(self.gene2go, self.background)
+        has_go = numpy.array([x in self.gene2go for x in self.background])
+        counts, totals = GO.sampleGOCounts(matrix, has_go, 500, 3, 1)
+        background_counts = numpy.asarray(matrix.sum(axis=0)).ravel()
+        for row in counts:
+            self.assertEqual(list(row), list(background_counts))
+        self.assertEqual(list(totals), [len(self.gene2go)] * 3)
+
+    def testEmptyAssignments(self):
+        # genes with empty assignments count towards the totals
+        self.gene2go["gene0"] = []
+        matrix, go_ids = GO.buildGOMatrix(self.gene2go, self.background)
+        has_go = numpy.array([x in self.gene2go for x in self.background])
+        counts, totals = GO.sampleGOCounts(matrix, has_go, 500, 1, 1)
+        total, _, genes = GO.GetGOFrequencies(self.gene2go, self.background)
+        self.assertEqual(totals[0], len(genes))
+
+    def testSamplesThreads(self):
+        # samples do not depend on the number of processes
+        tmpdir = tempfile.mkdtemp()
+        try:
+            go2info = collections.defaultdict(str)
+            foreground = random.sample(self.background, 30)
+            results = []
+            for num_threads in (1, 2):
+                random.seed(1)
+                options = optparse.Values(dict(
+                    sample=25, sample_batch_size=4, num_threads=num_threads,
+                    output_filename_pattern=os.path.join(
+                        tmpdir, "%(go)s.%(section)s")))
+                results.append(GO.getSamples(
+                    self.gene2go, foreground, self.background, options,
+                    "test", go2info))
+            self.assertTrue(numpy.all(results[0][1] == results[1][1]))
+            self.assertEqual(sorted(results[0][0].keys()),
+                             sorted(results[1][0].keys()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestBatch(GOTestCase):
+
+    def setUp(self):
+        GOTestCase.setUp(self)
+        self.genelists = [random.sample(self.background, x)
+                          for x in (5, 20, 50, 100)]
+        # a background with duplicates and a background
+        # without some of the foreground genes
+        self.backgrounds = [self.background,
+                            self.background + self.background[:20],
+                            self.background[:150],
+                            self.background]
+        self.genelists[2] = [x for x in self.genelists[2]
+                             if x in self.backgrounds[2]]
+
+    def checkResults(self, results):
+        self.assertEqual(len(results), len(self.genelists))
+        for result, genes, background in zip(
+                results, self.genelists, self.backgrounds):
+            expected = GO.AnalyseGO(self.gene2go, genes, background)
+            self.assertEqual(sorted(result.mResults.keys()),
+                             sorted(expected.mResults.keys()))
+            for attribute in ("mNumGenes",
+                              "mBackgroundCountsTotal",
+                              "mBackgroundNumCategories",
+                              "mSampleCountsTotal",
+                              "mSampleNumCategories"):
+                self.assertEqual(getattr(result, attribute),
+                                 getattr(expected, attribute))
+            self.assertEqual(result.mSampleGenes, expected.mSampleGenes)
+            self.assertEqual(result.mBackgroundGenes,
+                             expected.mBackgroundGenes)
+            for go_id, e in expected.mResults.items():
+                r = result.mResults[go_id]
+                for attribute in ("mSampleCountsCategory",
+                                  "mSampleCountsTotal",
+                                  "mBackgroundCountsCategory",
+                                  "mBackgroundCountsTotal",
+                                  "mRatio"):
+                    self.assertEqual(getattr(r, attribute),
+                                     getattr(e, attribute))
+                for attribute in ("mProbabilityOverRepresentation",
+                                  "mProbabilityUnderRepresentation",
+                                  "mPValue"):
+                    self.assertAlmostEqual(getattr(r, attribute),
+                                           getattr(e, attribute),
+                                           places=6)
+
+    def testBatch(self):
+        self.checkResults(GO.analyseGOBatch(
+            self.gene2go, self.genelists, self.backgrounds))
+
+    def testBatchChunks(self):
+        self.checkResults(GO.analyseGOBatch(
+            self.gene2go, self.genelists, self.backgrounds,
+            num_threads=2, chunk_size=1))
+
+    def testBatchEmptyAssignments(self):
+        self.gene2go["gene0"] = []
+        self.genelists[0].append("gene0")
+        self.checkResults(GO.analyseGOBatch(
+            self.gene2go, self.genelists, self.backgrounds))
+
+
+class TestOntology(unittest.TestCase):
+
+    def setUp(self):
+        self.ontology = {}
+        for goid, parents in (("GO:1", []),
+                              ("GO:2", ["GO:1"]),
+                              ("GO:3", ["GO:1"]),
+                              ("GO:4", ["GO:2", "GO:3"]),
+                              ("GO:5", ["GO:4"])):
+            entry = GO.GOEntry()
+            entry.mId = goid
+            entry.mName = "term %s" % goid
+            entry.mIsA = ["%s ! term %s" % (x, x) for x in parents]
+            self.ontology[goid] = entry
+
+    def testAncestors(self):
+        ancestors = GO.buildAncestors(self.ontology)
+        self.assertEqual(ancestors["GO:1"], set())
+        self.assertEqual(ancestors["GO:4"], set(["GO:1", "GO:2", "GO:3"]))
+        self.assertEqual(ancestors["GO:5"],
+                         set(["GO:1", "GO:2", "GO:3", "GO:4"]))
+
+    def testPropagate(self):
+        gene2go = {"gene1": [GO.GOInfo("GO:5")],
+                   "gene2": [GO.GOInfo("GO:2"), GO.GOInfo("GO:1")]}
+        ancestors = GO.buildAncestors(self.ontology)
+        result = GO.propagateGene2GO(gene2go, ancestors, self.ontology)
+        self.assertEqual(sorted([x.mGOId for x in result["gene1"]]),
+                         ["GO:1", "GO:2", "GO:3", "GO:4", "GO:5"])
+        self.assertEqual(sorted([x.mGOId for x in result["gene2"]]),
+                         ["GO:1", "GO:2"])
+        # input is not modified
+        self.assertEqual(len(gene2go["gene1"]), 1)
+
+    def testCached(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmpdir, "source.txt")
+            with open(source, "w") as outf:
+                outf.write("1")
+            calls = []
+
+            def _build(**kwargs):
+                calls.append(kwargs)
+                return GO.buildAncestors(self.ontology)
+
+            cache_dir = os.path.join(tmpdir, "cache")
+            for x in range(2):
+                ancestors = GO.loadCached((source, None), _build,
+                                          cache_dir, option=1)
+                self.assertEqual(ancestors,
+                                 GO.buildAncestors(self.ontology))
+            self.assertEqual(calls, [{"option": 1}])
+
+            GO.loadCached((source, None), _build, cache_dir, option=2)
+            self.assertEqual(len(calls), 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,5 +18,49 @@ class TestIteration(unittest.TestCase):
                          100)
 
 
+class TestColumnar(unittest.TestCase):
+
+    filename = os.path.join("data", "hg19.small.gtf.gz")
+
+    def setUp(self):
+        with IOTools.openFile(self.filename) as inf:
+            self.records = list(GTF.iterator(inf))
+        self.gtf = GTF.read_columnar(self.filename)
+
+    def test_number_of_records_is_correct(self):
+        self.assertEqual(len(self.gtf), len(self.records))
+
+    def test_fields_are_identical(self):
+        for a, b in zip(self.gtf, self.records):
+            self.assertEqual(
+                (a.contig, a.source, a.feature, a.start, a.end,
+                 a.score, a.strand, a.frame, a.gene_id, a.transcript_id),
+                (b.contig, b.source, b.feature, b.start, b.end,
+                 b.score, b.strand, b.frame, b.gene_id, b.transcript_id))
+            self.assertEqual(a["exon_number"], b["exon_number"])
+
+    def test_output_is_identical(self):
+        for a, b in zip(self.gtf, self.records):
+            self.assertEqual(str(a), str(b))
+
+    def test_transcript_iterator(self):
+        observed = [[(x.transcript_id, x.start) for x in t]
+                    for t in GTF.transcript_iterator(iter(self.gtf))]
+        expected = [[(x.transcript_id, x.start) for x in t]
+                    for t in GTF.transcript_iterator(iter(self.records))]
+        self.assertEqual(observed, expected)
+
+    def test_flat_gene_iterator(self):
+        observed = [len(x) for x in GTF.flat_gene_iterator(self.gtf)]
+        expected = [len(x) for x in GTF.flat_gene_iterator(self.records)]
+        self.assertEqual(observed, expected)
+
+    def test_select(self):
+        exon = self.gtf.getCode("features", "exon")
+        selected = self.gtf.select(self.gtf.feature_codes == exon)
+        expected = [str(x) for x in self.records if x.feature == "exon"]
+        self.assertEqual([str(x) for x in selected], expected)
+
+
 if __name__ == "__main__":
     unittest.main()
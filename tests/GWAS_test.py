@@ -0,0 +1,92 @@
+'''unit testing module for genotype counting in GWAS.py'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import CGAT.GWAS as GWAS
+
+
+class TestGenotypeCounting(unittest.TestCase):
+
+    genotypes = [["11", "12", "22", "00"],
+                 ["12", "1 2", "22", "21"],
+                 ["22", "22", "11", "00"]]
+
+    phenotypes = [1, 2, 2]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ped_file = os.path.join(self.tmpdir, "test.ped")
+        self.map_file = os.path.join(self.tmpdir, "test.map")
+
+        with open(self.ped_file, "w") as outf:
+            for x, genos in enumerate(self.genotypes):
+                outf.write("\t".join(
+                    ["F%i" % x, "I%i" % x, "0", "0", "1",
+                     str(self.phenotypes[x])] + genos) + "\n")
+
+        with open(self.map_file, "w") as outf:
+            for x in range(len(self.genotypes[0])):
+                outf.write("1\trs%i\t0\t%i\n" % (x, x * 100))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testEncodeGenotypes(self):
+        self.assertEqual(
+            list(GWAS.encodeGenotypes(["00", "11", "12", "21", "22"])),
+            [0, 1, 2, 2, 3])
+
+    def testEncodeGenotypesFailsOnNucleotides(self):
+        self.assertRaises(ValueError,
+                          GWAS.encodeGenotypes, ["AA", "AG"])
+
+    def testCountGenotypesIsIndependentOfChunkSize(self):
+        counts, nsamples = GWAS.countGenotypes(self.ped_file)
+        self.assertEqual(nsamples, 3)
+        self.assertEqual(counts.tolist(),
+                         [[0, 0, 0, 2],
+                          [1, 0, 1, 0],
+                          [1, 2, 0, 1],
+                          [1, 1, 2, 0]])
+
+        for chunk_size in (1, 2):
+            c, n = GWAS.countGenotypes(self.ped_file,
+                                       chunk_size=chunk_size)
+            self.assertTrue(np.array_equal(c, counts))
+            self.assertEqual(n, nsamples)
+
+    def testCountGenotypesWithSamples(self):
+        counts, nsamples = GWAS.countGenotypes(self.ped_file,
+                                               samples=set(["I0"]))
+        self.assertEqual(nsamples, 1)
+        self.assertEqual(counts[:, 0].tolist(), [0, 1, 0, 0])
+
+    def testCountByVariantAllele(self):
+        mafs = GWAS.countByVariantAllele(self.ped_file, self.map_file)
+        self.assertEqual(list(mafs.index), ["rs0", "rs1", "rs2", "rs3"])
+        self.assertAlmostEqual(mafs.loc["rs0", "MAF"], 0.5)
+        self.assertEqual(mafs.loc["rs2", "A2_HOMS"], 2)
+        self.assertEqual(mafs.loc["rs1", "A2_HETS"], 2)
+
+    def testParsePed(self):
+        ped_frame = GWAS.parsePed(self.ped_file)
+        self.assertEqual(list(ped_frame["IID"]), ["I0", "I1", "I2"])
+        self.assertEqual(list(ped_frame["GENOS"][1]),
+                         ["12", "12", "22", "12"])
+
+    def testParsePedWithNucleotides(self):
+        with open(self.ped_file, "w") as outf:
+            outf.write("F0\tI0\t0\t0\t1\t1\tAA\tA G\t00\n")
+            outf.write("F1\tI1\t0\t0\t2\t2\tAC\tGG\tTT\n")
+        ped_frame = GWAS.parsePed(self.ped_file)
+        self.assertEqual(list(ped_frame["IID"]), ["I0", "I1"])
+        self.assertEqual(list(ped_frame["PHEN"]), [1, 2])
+        self.assertEqual(list(ped_frame["GENOS"][0]), ["AA", "AG", "00"])
+        self.assertEqual(list(ped_frame["GENOS"][1]), ["AC", "GG", "TT"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+"""test compressed file access in IOTools."""
+
+import unittest
+import tempfile
+import shutil
+import gzip
+import os
+
+import pysam
+
+import CGAT.IOTools as IOTools
+
+
+class TestCompressedFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test.bed.gz")
+        # sorted intervals, large enough to span multiple blocks
+        self.lines = ["chr%i\t%i\t%i\tinterval%i\n" %
+                      (c, x * 10, x * 10 + 5, x)
+                      for c in range(1, 4) for x in range(20000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        IOTools.setCompressionThreads(1)
+
+    def writeLines(self, threads):
+        with IOTools.openFile(self.filename, "w", threads=threads) as outf:
+            for line in self.lines:
+                outf.write(line)
+
+    def testThreadedWriteCanBeReadWithGzip(self):
+        self.writeLines(threads=4)
+        with gzip.open(self.filename, "rt") as inf:
+            self.assertEqual(inf.readlines(), self.lines)
+
+    def testThreadedReadOfGzipFile(self):
+        self.writeLines(threads=1)
+        with IOTools.openFile(self.filename, threads=4) as inf:
+            self.assertEqual(list(inf), self.lines)
+
+    def testThreadedWriteAndRead(self):
+        IOTools.setCompressionThreads(4)
+        self.writeLines(threads=None)
+        with IOTools.openFile(self.filename) as inf:
+            self.assertEqual(list(inf), self.lines)
+
+    def testThreadedWriteIsBGZF(self):
+        self.writeLines(threads=4)
+        with open(self.filename, "rb") as inf:
+            data = inf.read()
+        self.assertEqual(data[12:14], b"BC")
+        self.assertTrue(data.endswith(IOTools.BGZF_EOF))
+        pysam.tabix_index(self.filename, preset="bed")
+        tabix = pysam.TabixFile(self.filename)
+        self.assertEqual(len(list(tabix.fetch("chr2", 1000, 1100))), 10)
+
+    def testAppend(self):
+        self.writeLines(threads=4)
+        with IOTools.openFile(self.filename, "a", threads=4) as outf:
+            outf.write("chr4\t1\t2\tappended\n")
+        with gzip.open(self.filename, "rt") as inf:
+            self.assertEqual(inf.readlines(),
+                             self.lines + ["chr4\t1\t2\tappended\n"])
+
+    def testWriterUsesRequestedThreads(self):
+        IOTools.setCompressionThreads(2)
+        writer = IOTools.BGZFWriter(self.filename, threads=3)
+        self.assertEqual(writer.max_pending, 12)
+        self.assertTrue(writer.pool is IOTools.getCompressionPool(3))
+        writer.close()
+        writer = IOTools.BGZFWriter(self.filename)
+        self.assertEqual(writer.max_pending, 8)
+        self.assertTrue(writer.pool is IOTools.getCompressionPool(2))
+        writer.close()
+
+    def testWritersSharePool(self):
+        IOTools.closeCompressionPools()
+        pool = IOTools.getCompressionPool(4)
+        self.writeLines(threads=4)
+        self.assertTrue(IOTools.getCompressionPool(4) is pool)
+        with gzip.open(self.filename, "rt") as inf:
+            self.assertEqual(inf.readlines(), self.lines)
+
+    def testWriteAfterClosingPools(self):
+        self.writeLines(threads=4)
+        pool = IOTools.getCompressionPool(4)
+        IOTools.closeCompressionPools()
+        self.assertFalse(IOTools.getCompressionPool(4) is pool)
+        self.writeLines(threads=4)
+        with gzip.open(self.filename, "rt") as inf:
+            self.assertEqual(inf.readlines(), self.lines)
+
+    def testEmptyFile(self):
+        IOTools.openFile(self.filename, "w", threads=4).close()
+        with IOTools.openFile(self.filename, threads=4) as inf:
+            self.assertEqual(list(inf), [])
+
+
+class TestCached(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        self.source = os.path.join(self.tmpdir, "source")
+        with open(self.source, "w") as outf:
+            outf.write("1")
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, **kwargs):
+        self.calls.append(kwargs)
+        return {"result": kwargs}
+
+    def testResultIsCached(self):
+        for x in range(2):
+            self.assertEqual(
+                IOTools.cached([self.source, None], self.build,
+                               self.cache_dir, "test.%s", option=1),
+                {"result": {"option": 1}})
+        self.assertEqual(self.calls, [{"option": 1}])
+        IOTools.cached([self.source], self.build,
+                       self.cache_dir, "test.%s", option=2)
+        self.assertEqual(len(self.calls), 2)
+
+    def testFailedSaveRemovesTemporaryFile(self):
+        def save(result, filename):
+            with open(filename, "w") as outf:
+                outf.write("partial")
+            raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, IOTools.cached,
+                          [self.source], self.build, self.cache_dir,
+                          "test.%s", save=save)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+"""test IndexedGenome indices."""
+
+import unittest
+import random
+import tempfile
+import shutil
+import os
+import numpy
+
+import CGAT.IndexedGenome as IndexedGenome
+
+
+class TestSaveLoad(unittest.TestCase):
+
+    index_class = IndexedGenome.IndexedGenome
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "index.ncl")
+        random.seed(0)
+        self.intervals = []
+        for contig in ("chr1", "chr2", "chrX"):
+            for x in range(500):
+                start = random.randint(0, 100000)
+                end = start + random.randint(1, 5000)
+                self.intervals.append(
+                    (contig, start, end, "%s_%i" % (contig, x)))
+        self.queries = [(contig, x, x + 1000)
+                        for contig in ("chr1", "chr2", "chrX")
+                        for x in range(0, 110000, 5000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def buildIndex(self):
+        index = self.index_class()
+        for contig, start, end, value in self.intervals:
+            if self.index_class.with_values:
+                index.add(contig, start, end, value)
+            else:
+                index.add(contig, start, end)
+        return index
+
+    def getResults(self, index):
+        return [sorted(index.get(contig, start, end))
+                for contig, start, end in self.queries]
+
+    def testRoundTrip(self):
+        index = self.buildIndex()
+        index.save(self.filename)
+        for mmap in (True, False):
+            loaded = self.index_class.load(self.filename, mmap=mmap)
+            self.assertEqual(len(loaded), len(index))
+            self.assertEqual(self.getResults(loaded), self.getResults(index))
+
+    def testSaveLoaded(self):
+        self.buildIndex().save(self.filename)
+        loaded = self.index_class.load(self.filename)
+        filename = os.path.join(self.tmpdir, "copy.ncl")
+        loaded.save(filename)
+        self.assertEqual(
+            self.getResults(self.index_class.load(filename)),
+            self.getResults(self.buildIndex()))
+
+    def testLoadedIndexCanNotBeExtended(self):
+        self.buildIndex().save(self.filename)
+        loaded = self.index_class.load(self.filename)
+        if self.index_class.with_values:
+            self.assertRaises(AssertionError, loaded.add, "chr1", 1, 2, "x")
+        else:
+            self.assertRaises(AssertionError, loaded.add, "chr1", 1, 2)
+
+    def testInvalidFile(self):
+        with open(self.filename, "w") as outf:
+            outf.write("chr1\t1\t2\n")
+        self.assertRaises(ValueError, self.index_class.load, self.filename)
+
+    def testCached(self):
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        source = os.path.join(self.tmpdir, "source.txt")
+        with open(source, "w") as outf:
+            outf.write("1")
+
+        calls = []
+
+        def _build(**kwargs):
+            calls.append(kwargs)
+            return self.buildIndex()
+
+        expected = self.getResults(self.buildIndex())
+        for x in range(2):
+            index = IndexedGenome.cached(source, _build, cache_dir,
+                                         index_class=self.index_class,
+                                         option=1)
+            self.assertEqual(self.getResults(index), expected)
+        self.assertEqual(calls, [{"option": 1}])
+
+        # different options and a modified file require a rebuild
+        IndexedGenome.cached(source, _build, cache_dir,
+                             index_class=self.index_class,
+                             option=2)
+        self.assertEqual(len(calls), 2)
+        with open(source, "w") as outf:
+            outf.write("12")
+        IndexedGenome.cached(source, _build, cache_dir,
+                             index_class=self.index_class,
+                             option=1)
+        self.assertEqual(len(calls), 3)
+
+
+class TestSaveLoadSimple(TestSaveLoad):
+
+    index_class = IndexedGenome.Simple
+
+    def testWrongType(self):
+        self.buildIndex().save(self.filename)
+        self.assertRaises(ValueError,
+                          IndexedGenome.IndexedGenome.load,
+                          self.filename)
+
+
+class TestSaveLoadQuicksect(TestSaveLoad):
+
+    index_class = IndexedGenome.Quicksect
+
+    # quicksect indices are rebuilt when loading
+    testLoadedIndexCanNotBeExtended = None
+
+    def testWrongType(self):
+        IndexedGenome.IndexedGenome().save(self.filename)
+        self.assertRaises(ValueError,
+                          IndexedGenome.Quicksect.load,
+                          self.filename)
+
+
+class TestBatchQueries(unittest.TestCase):
+
+    index_class = IndexedGenome.IndexedGenome
+
+    def setUp(self):
+        random.seed(0)
+        self.index = self.index_class()
+        for x in range(2000):
+            start = random.randint(0, 100000)
+            end = start + random.randint(1, 5000)
+            self.index.add("chr1", start, end, x)
+        self.starts = numpy.array(
+            [random.randint(0, 110000) for x in range(3000)])
+        self.ends = self.starts + numpy.array(
+            [random.randint(1, 2000) for x in range(3000)])
+
+    def testGetMany(self):
+        offsets, indices = self.index.get_many(
+            "chr1", self.starts, self.ends)
+        self.assertEqual(len(offsets), len(self.starts) + 1)
+        for x, (start, end) in enumerate(zip(self.starts, self.ends)):
+            expected = sorted(
+                [v for s, e, v in self.index.get("chr1", start, end)])
+            observed = sorted(self.index.getValues(
+                "chr1", indices[offsets[x]:offsets[x + 1]]))
+            self.assertEqual(observed, expected)
+
+    def testCountOverlaps(self):
+        counts = self.index.count_overlaps("chr1", self.starts, self.ends)
+        expected = [len(list(self.index.get("chr1", start, end)))
+                    for start, end in zip(self.starts, self.ends)]
+        self.assertEqual(list(counts), expected)
+
+    def testEmptyQueries(self):
+        offsets, indices = self.index.get_many(
+            "chr1", [10, 100, 50], [10, 50, 20000])
+        self.assertEqual(list(offsets[:3]), [0, 0, 0])
+        self.assertEqual(
+            list(self.index.count_overlaps("chr1", [10, 100], [10, 50])),
+            [0, 0])
+
+    def testMismatchingQueries(self):
+        self.assertRaises(ValueError, self.index.get_many,
+                          "chr1", [1, 2], [3])
+
+    def testMissingContig(self):
+        self.assertRaises(KeyError, self.index.get_many,
+                          "chr2", [1], [3])
+
+    def testLargeNumberOfHits(self):
+        # more hits per query than the internal buffer size
+        offsets, indices = self.index.get_many("chr1", [0], [200000])
+        self.assertEqual(sorted(indices), list(range(2000)))
+
+
+class TestBatchQueriesQuicksect(TestBatchQueries):
+
+    index_class = IndexedGenome.Quicksect
+
+
+if __name__ == "__main__":
+    unittest.main()
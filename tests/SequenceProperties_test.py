@@ -0,0 +1,128 @@
+"""unit testing module for SequenceProperties.py."""
+
+import random
+import unittest
+import itertools
+
+import Bio.Alphabet.IUPAC
+
+import CGAT.Genomics as Genomics
+import CGAT.SequenceProperties as SequenceProperties
+
+
+class TestEncodedSequence(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.sequence = "".join(random.choice("ACGTacgtNX-")
+                                for x in range(3 * 500))
+        self.encoded = SequenceProperties.EncodedSequence(self.sequence)
+
+    def testIsString(self):
+        self.assertEqual(self.encoded, self.sequence)
+        self.assertEqual(self.encoded.upper(), self.sequence.upper())
+        self.assertEqual(len(self.encoded), len(self.sequence))
+
+    def testCountCharacters(self):
+        for upper in (False, True):
+            sequence = self.sequence
+            if upper:
+                sequence = sequence.upper()
+            counts, others = self.encoded.countCharacters("ACGTa",
+                                                          upper=upper)
+            self.assertEqual(counts, [sequence.count(x) for x in "ACGTa"])
+            self.assertEqual(others, len(sequence) - sum(counts))
+
+    def testCountDinucleotides(self):
+        counts, others = self.encoded.countDinucleotides("ACGT")
+        s = self.sequence
+        pairs = [s[x:x + 2] for x in range(len(s) - 1)]
+        for a, b in itertools.product("ACGT", repeat=2):
+            self.assertEqual(counts[a + b], pairs.count(a + b))
+        self.assertEqual(others, len(pairs) - sum(counts.values()))
+
+    def testCountCodons(self):
+        for upper in (False, True):
+            sequence = self.sequence
+            if upper:
+                sequence = sequence.upper()
+            codons = [sequence[x:x + 3]
+                      for x in range(0, len(sequence), 3)]
+            expected = dict((x, codons.count(x)) for x in set(codons))
+            self.assertEqual(self.encoded.countCodons(upper=upper),
+                             expected)
+
+    def testIncompleteCodon(self):
+        encoded = SequenceProperties.EncodedSequence("AAACCCG")
+        self.assertRaises(ValueError, encoded.countCodons)
+
+    def testShortSequences(self):
+        for sequence in ("", "A"):
+            encoded = SequenceProperties.EncodedSequence(sequence)
+            counts, others = encoded.countDinucleotides("ACGT")
+            self.assertEqual(sum(counts.values()), 0)
+            self.assertEqual(others, 0)
+        self.assertEqual(
+            SequenceProperties.EncodedSequence("").countCodons(), {})
+
+
+class TestSharedSequence(unittest.TestCase):
+
+    def testSameFields(self):
+        '''counters give the same result for encoded and plain
+        sequences.'''
+        random.seed(0)
+        sequence = "".join(random.choice("ACGT") for x in range(3 * 200))
+        encoded = SequenceProperties.EncodedSequence(sequence)
+        for counter in (SequenceProperties.SequencePropertiesNA,
+                        SequenceProperties.SequencePropertiesDN,
+                        SequenceProperties.SequencePropertiesCpg,
+                        SequenceProperties.SequencePropertiesGaps,
+                        SequenceProperties.SequencePropertiesDegeneracy,
+                        SequenceProperties.SequencePropertiesAA,
+                        SequenceProperties.SequencePropertiesCodons,
+                        SequenceProperties.SequencePropertiesCodonUsage):
+            a, b = counter(), counter()
+            a.loadSequence(sequence)
+            b.loadSequence(encoded)
+            self.assertEqual(a.getFields(), b.getFields())
+
+    def testAminoAcids(self):
+        '''amino acid counts are the same as translating codon by
+        codon.'''
+        random.seed(0)
+        sequence = "".join(random.choice("ACGT") for x in range(3 * 200))
+        expected = dict(
+            (x, 0) for x in Bio.Alphabet.IUPAC.extended_protein.letters)
+        for x in range(0, len(sequence), 3):
+            expected[Genomics.MapCodon2AA(sequence[x:x + 3])] += 1
+        for s in (sequence, SequenceProperties.EncodedSequence(sequence)):
+            counter = SequenceProperties.SequencePropertiesAA()
+            counter.loadSequence(s)
+            self.assertEqual(counter.mCountsAA, expected)
+
+    def testIncompleteCodon(self):
+        '''sequences with an incomplete codon are rejected.'''
+        for counter in (SequenceProperties.SequencePropertiesDegeneracy,
+                        SequenceProperties.SequencePropertiesAA,
+                        SequenceProperties.SequencePropertiesCodons,
+                        SequenceProperties.SequencePropertiesCodonUsage):
+            for s in ("AAACCCG",
+                      SequenceProperties.EncodedSequence("AAACCCG")):
+                self.assertRaises(ValueError, counter().loadSequence, s)
+
+    def testGaps(self):
+        s = SequenceProperties.SequencePropertiesGaps()
+        s.loadSequence("NNACGNNNTTxN")
+        self.assertEqual(s.ngaps, 7)
+        self.assertEqual(s.ngap_regions, 3)
+        self.assertEqual(s.nseq_regions, 2)
+
+    def testCpG(self):
+        s = SequenceProperties.SequencePropertiesCpg()
+        s.loadSequence("ACGCGTTA")
+        self.assertEqual(s.getFields()[0], "2")
+
+
+if __name__ == "__main__":
+    unittest.main()
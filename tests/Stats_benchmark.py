@@ -0,0 +1,50 @@
+"""benchmark multiple testing correction in Stats.py.
+
+Compares the run time of the numpy implementations of p-value
+adjustment and q-value computation against the corresponding
+R functions (p.adjust and qvalue)::
+
+   python tests/Stats_benchmark.py
+
+"""
+
+import sys
+import time
+import numpy
+import CGAT.Stats as Stats
+from rpy2.robjects import r as R
+import rpy2.robjects as ro
+
+
+def timeit(f, *args, **kwargs):
+    '''return time in seconds for calling *f*.'''
+    start = time.time()
+    f(*args, **kwargs)
+    return time.time() - start
+
+
+def main(sizes=(10000, 100000, 1000000)):
+
+    R.library("qvalue")
+    sys.stdout.write("function\tsize\tdtype\tpython\tR\n")
+    for size in sizes:
+        pvalues = numpy.random.uniform(size=size)
+        rpvalues = ro.FloatVector(pvalues)
+        for method in ("BH", "BY", "holm"):
+            t_r = timeit(R['p.adjust'], rpvalues, method=method)
+            for dtype in (numpy.float64, numpy.float32):
+                t_py = timeit(Stats.adjustPValues,
+                              pvalues.astype(dtype), method)
+                sys.stdout.write("adjustPValues-%s\t%i\t%s\t%f\t%f\n" %
+                                 (method, size, numpy.dtype(dtype).name,
+                                  t_py, t_r))
+
+        t_r = timeit(R.qvalue, rpvalues)
+        for dtype in (numpy.float64, numpy.float32):
+            t_py = timeit(Stats.doFDRPython, pvalues.astype(dtype))
+            sys.stdout.write("doFDRPython\t%i\t%s\t%f\t%f\n" %
+                             (size, numpy.dtype(dtype).name, t_py, t_r))
+
+
+if __name__ == "__main__":
+    main()
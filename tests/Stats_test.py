@@ -440,5 +440,105 @@ class TestPValueAdust(unittest.TestCase):
     def testNone(self):
         self.check("none")
 
+
+def adjustPValuesNaive(pvalues, method):
+    '''straightforward implementation of p-value adjustment.'''
+    n = len(pvalues)
+    result = []
+    for x in pvalues:
+        if method == "BH":
+            r = min(float(n) * y / sum(1 for z in pvalues if z <= y)
+                    for y in pvalues if y >= x)
+        elif method == "holm":
+            r = max((n - sum(1 for z in pvalues if z < y)) * y
+                    for y in pvalues if y <= x)
+        result.append(min(r, 1.0))
+    return result
+
+
+class TestPValueAdjustVectorised(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        # many ties
+        self.pvalues = numpy.round(
+            numpy.concatenate([rng.uniform(size=200),
+                               rng.beta(0.2, 5, size=200)]), 2)
+
+    def check(self, method, dtype):
+        pvalues = self.pvalues.astype(dtype)
+        b = Stats.adjustPValues(pvalues, method=method)
+        self.assertEqual(b.dtype, dtype)
+        a = adjustPValuesNaive(list(pvalues.astype(numpy.float64)), method)
+        self.assertTrue(numpy.allclose(a, b, rtol=1e-6))
+
+    def testBH(self):
+        self.check("BH", numpy.float64)
+
+    def testHolm(self):
+        self.check("holm", numpy.float64)
+
+    def testFloat32(self):
+        self.check("BH", numpy.float32)
+
+    def testUnknownMethod(self):
+        self.assertRaises(ValueError,
+                          Stats.adjustPValues, self.pvalues, "unknown")
+
+    def testMissingValues(self):
+        # missing values are kept and count towards the number
+        # of comparisons, as in the previous implementation
+        pvalues = [0.01, numpy.nan, 0.5, 0.02, 0.03]
+        expected = {
+            "bonferroni": [0.05, numpy.nan, 1.0, 0.1, 0.15],
+            "holm": [0.05, numpy.nan, 1.0, 0.08, 0.09],
+            "hochberg": [0.04, numpy.nan, 0.5, 0.06, 0.06],
+            "BH": [0.025, numpy.nan, 0.5, 0.02 * 5 / 3, 0.0375],
+            "BY": [0.025 * 137 / 60, numpy.nan, 0.5 * 137 / 60,
+                   0.02 * 5 / 3 * 137 / 60, 0.0375 * 137 / 60],
+            "none": pvalues}
+        for method, values in expected.items():
+            b = Stats.adjustPValues(pvalues, method=method)
+            self.assertTrue(
+                numpy.allclose(b, numpy.minimum(values, 1.0),
+                               equal_nan=True),
+                "%s: %s != %s" % (method, b, values))
+
+    def testQValuesWithTies(self):
+        pvalues = self.pvalues
+        m = len(pvalues)
+        result = Stats.doFDRPython(pvalues, pi0=1.0)
+        # with pi0 = 1, q-values are identical to BH adjusted p-values
+        self.assertTrue(numpy.allclose(
+            result.mQValues, Stats.adjustPValues(pvalues, "BH")))
+        # tied p-values receive the same q-value
+        for x in numpy.unique(pvalues):
+            self.assertEqual(len(set(result.mQValues[pvalues == x])), 1)
+        self.assertEqual(len(result.mQValues), m)
+
+    def testQValuesFloat32(self):
+        pvalues = self.pvalues.astype(numpy.float32)
+        a = Stats.doFDRPython(pvalues)
+        b = Stats.doFDRPython(pvalues.astype(numpy.float64))
+        self.assertEqual(a.mQValues.dtype, numpy.float32)
+        self.assertAlmostEqual(a.mPi0, b.mPi0, places=5)
+        self.assertTrue(numpy.allclose(a.mQValues, b.mQValues, atol=1e-6))
+
+    def testRobustQValuesFloat32(self):
+        # 1 - p is 1 in single precision for these p-values
+        pvalues = numpy.array([1e-9, 1e-8, 2e-8, 4e-8], dtype=numpy.float32)
+        a = Stats.doFDRPython(pvalues, pi0=1.0, robust=True)
+        b = Stats.doFDRPython(pvalues.astype(numpy.float64),
+                              pi0=1.0, robust=True)
+        self.assertTrue(numpy.allclose(a.mQValues, b.mQValues))
+        self.assertTrue(numpy.allclose(a.mQValues, 0.25))
+
+    def testPi0Lambda(self):
+        vlambda = numpy.arange(0, 0.95, 0.05)
+        observed = Stats.estimatePi0Lambda(numpy.sort(self.pvalues), vlambda)
+        expected = [numpy.mean(self.pvalues >= x) / (1.0 - x)
+                    for x in vlambda]
+        self.assertTrue(numpy.allclose(observed, expected))
+
 if __name__ == "__main__":
     unittest.main()
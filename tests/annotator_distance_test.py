@@ -0,0 +1,128 @@
+"""unit testing module for the samplers in annotator_distance.py."""
+
+import random
+import unittest
+
+import numpy
+import scipy.stats
+
+import CGAT.scripts.annotator_distance as annotator_distance
+
+
+def samplePermutation(lengths, work_start, free_length):
+    """sample a single permutation as done before batch sampling."""
+    lengths = list(lengths)
+    random.shuffle(lengths)
+    points = sorted(random.randint(0, free_length)
+                    for x in range(len(lengths) + 1))
+    start, last, simulated = work_start, 0, []
+    for x in range(len(lengths)):
+        start += points[x] - last
+        simulated.append((start, start + lengths[x]))
+        start += lengths[x]
+        last = points[x]
+    return simulated
+
+
+def sampleGaps(lengths, gaps, work_start):
+    """sample a single arrangement of gaps as done before batch
+    sampling."""
+    gaps = list(gaps)
+    random.shuffle(gaps)
+    start, simulated = work_start, []
+    for x in range(len(lengths)):
+        start += gaps[x]
+        simulated.append((start, start + lengths[x]))
+        start += lengths[x]
+    return simulated
+
+
+class TestSamplers(unittest.TestCase):
+
+    work_start, work_end = 1000, 5000
+    observed = [(1100, 1200), (1250, 1300), (2000, 2400),
+                (2410, 2500), (4000, 4050)]
+    num_samples = 2000
+
+    def setUp(self):
+        random.seed(1)
+        self.rng = numpy.random.RandomState(1)
+        self.lengths = [end - start for start, end in self.observed]
+
+    def checkSamples(self, starts, ends):
+        self.assertEqual(starts.shape, (self.num_samples, len(self.observed)))
+        self.assertTrue((starts >= self.work_start).all())
+        self.assertTrue((ends <= self.work_end).all())
+        # segments are sorted and do not overlap
+        self.assertTrue((starts[:, 1:] >= ends[:, :-1]).all())
+        # segment lengths are preserved in each sample
+        self.assertTrue((numpy.sort(ends - starts, axis=1) ==
+                         sorted(self.lengths)).all())
+
+    def assertSameDistribution(self, a, b):
+        self.assertGreater(scipy.stats.ks_2samp(a, b)[1], 0.001)
+
+    def testPermutation(self):
+        sampler = annotator_distance.SamplerPermutation(
+            self.observed, self.work_start, self.work_end)
+        starts, ends = sampler.sampleMany(self.num_samples, self.rng)
+        self.checkSamples(starts, ends)
+
+        expected = [samplePermutation(self.lengths, self.work_start,
+                                      sampler.mFreeLength)
+                    for x in range(self.num_samples)]
+        # length and position of the first and last segment
+        for column in (0, -1):
+            self.assertSameDistribution(
+                (ends - starts)[:, column],
+                [x[column][1] - x[column][0] for x in expected])
+            self.assertSameDistribution(
+                starts[:, column], [x[column][0] for x in expected])
+
+    def testGaps(self):
+        sampler = annotator_distance.SamplerGaps(
+            self.observed, self.work_start, self.work_end)
+        starts, ends = sampler.sampleMany(self.num_samples, self.rng)
+        self.checkSamples(starts, ends)
+
+        # gaps between segments are a permutation of the observed gaps
+        gaps = numpy.concatenate(
+            (starts[:, :1] - self.work_start,
+             starts[:, 1:] - ends[:, :-1],
+             self.work_end - ends[:, -1:]), axis=1)
+        self.assertTrue((numpy.sort(gaps, axis=1) ==
+                         sorted(sampler.mGapLengths)).all())
+
+        expected = [sampleGaps(self.lengths, sampler.mGapLengths,
+                               self.work_start)
+                    for x in range(self.num_samples)]
+        for column in (0, -1):
+            self.assertSameDistribution(
+                starts[:, column], [x[column][0] for x in expected])
+
+    def testBlocks(self):
+        sampler = annotator_distance.SamplerBlocks(
+            self.observed, self.work_start, self.work_end, max_gap=20)
+        starts, ends = sampler.sampleMany(self.num_samples, self.rng)
+        self.checkSamples(starts, ends)
+
+        # segments (2000, 2400) and (2410, 2500) form a block and
+        # keep their arrangement
+        lengths = ends - starts
+        rows = numpy.arange(self.num_samples)
+        first = numpy.argmax(lengths == 400, axis=1)
+        self.assertTrue((lengths[rows, first + 1] == 90).all())
+        self.assertTrue(
+            (starts[rows, first + 1] - starts[rows, first] == 410).all())
+
+    def testSeedDeterminesSamples(self):
+        sampler = annotator_distance.SamplerPermutation(
+            self.observed, self.work_start, self.work_end)
+        a = sampler.sampleMany(10, numpy.random.RandomState(2))
+        b = sampler.sampleMany(10, numpy.random.RandomState(2))
+        self.assertTrue((a[0] == b[0]).all())
+        self.assertTrue((a[1] == b[1]).all())
+
+
+if __name__ == "__main__":
+    unittest.main()